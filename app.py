@@ -11,15 +11,110 @@ from email.message import EmailMessage
 from flask import jsonify
 from email.utils import formataddr
 import os
-from random import randint
+from random import randint, Random
 from datetime import timedelta
 import traceback
 from sqlalchemy import func
+import re
+import time
+import threading
+from contextlib import contextmanager
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy import insert, update, tuple_, bindparam
+import click
+import csv
+import io
+import json
+import hashlib
+import uuid
+import math
+import sqlite3
+import gzip
+import mimetypes
+from flask import send_from_directory, stream_template
+import bisect
+import heapq
+import itertools
+from collections import namedtuple
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm.exc import StaleDataError
+from collections import OrderedDict
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal
 
 app = Flask(__name__)
 app.config.from_pyfile('config.py')
+app.config.from_envvar('APP_SETTINGS', silent=True)  # overrides, e.g. the test database
 db = SQLAlchemy(app)
 
+# Bumped whenever journeys, slots or fares change; fragment cache keys include it
+reference_data_version = 0
+
+
+# 🧩 Template caching
+# Compiled templates are kept in a bytecode cache directory shared by every
+# worker, and {% cache key, ttl %}...{% endcache %} caches rendered fragments
+# per reference-data version, so an admin edit invalidates them all at once.
+class FragmentCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, ttl, render):
+        cache_key = (reference_data_version, key)
+        now = time.monotonic()
+        with self._lock:
+            hit = self._entries.get(cache_key)
+            if hit and (hit[0] is None or hit[0] > now):
+                self._entries.move_to_end(cache_key)
+                return hit[1]
+
+        html = render()
+        with self._lock:
+            self._entries[cache_key] = (now + ttl if ttl else None, html)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+fragment_cache = FragmentCache()
+
+
+class FragmentCacheExtension(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render_cached', args), [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, key, ttl, caller):
+        return fragment_cache.get_or_render(key, ttl, caller)
+
+
+app.jinja_env.add_extension(FragmentCacheExtension)
+_bytecode_dir = app.config.get('JINJA_BYTECODE_CACHE_DIR') or os.path.join(app.instance_path, 'jinja_cache')
+os.makedirs(_bytecode_dir, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(_bytecode_dir)
+
 from functools import wraps
 
 def admin_required(f):
@@ -49,12 +144,21 @@ class JourneySlot(db.Model):
 
 
 
+class City(db.Model):
+    __tablename__ = 'cities'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    name_key = db.Column(db.String(100), nullable=False, unique=True)  # normalize_city(name)
+
 class Journey(db.Model):
     __tablename__ = 'journeys'
     id = db.Column(db.Integer, primary_key=True)
-    departure_city = db.Column(db.String(100))
+    departure_city = db.Column(db.String(100))  # display names, kept in step with the city ids
     arrival_city = db.Column(db.String(100))
+    departure_city_id = db.Column(db.Integer, db.ForeignKey('cities.id'))
+    arrival_city_id = db.Column(db.Integer, db.ForeignKey('cities.id'))
     base_fare = db.Column(db.Float)
+    __table_args__ = (db.Index('ix_journeys_route', 'departure_city_id', 'arrival_city_id', unique=True),)
 
 class SeatType(db.Model):
     __tablename__ = 'seat_types'
@@ -74,6 +178,8 @@ class Booking(db.Model):
     seats_booked = db.Column(db.Integer, default=1)  # 🆕
     status = db.Column(db.String(20), default='paid')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')  # bumped by every change
+    seat_numbers = db.Column(db.String(255))  # e.g. "41,42", given out when the booking is paid
 
 
 class Cancellation(db.Model):
@@ -88,7 +194,1527 @@ class Discount(db.Model):
     days_before = db.Column(db.Integer)
     discount_percent = db.Column(db.Integer)
 
-def send_cancellation_email(user_email, user_name, booking_id, route, travel_date, charge_amount):
+class BookingArchive(db.Model):
+    __tablename__ = 'bookings_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # same id as the live booking
+    user_id = db.Column(db.Integer, index=True)
+    journey_id = db.Column(db.Integer)
+    seat_type_id = db.Column(db.Integer)
+    slot_id = db.Column(db.Integer)
+    travel_date = db.Column(db.Date, index=True)
+    final_price = db.Column(db.Float)
+    seats_booked = db.Column(db.Integer)
+    status = db.Column(db.String(20))
+    created_at = db.Column(db.DateTime)
+    version = db.Column(db.Integer)
+    seat_numbers = db.Column(db.String(255))
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class MaintenanceJob(db.Model):
+    __tablename__ = 'maintenance_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.Text, default='{}')  # JSON
+    status = db.Column(db.String(20), default='pending', index=True)  # pending, running, done, failed
+    processed = db.Column(db.Integer, default=0)
+    total = db.Column(db.Integer)  # rows to process, where known up front
+    last_id = db.Column(db.Integer, default=0)  # resume point
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+class LeaderboardSnapshot(db.Model):
+    __tablename__ = 'leaderboard_snapshots'
+    id = db.Column(db.Integer, primary_key=True)
+    payload = db.Column(db.Text().with_variant(db.Text(length=2**32 - 1), 'mysql'))  # JSON
+    taken_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    endpoint = db.Column(db.String(100), nullable=False)
+    key = db.Column(db.String(100), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)  # NULL while the first request is still running
+    response_body = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    __table_args__ = (db.UniqueConstraint('user_id', 'endpoint', 'key', name='uq_idempotency_key'),)
+
+
+class BookingEvent(db.Model):
+    __tablename__ = 'booking_events'
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)  # the log offset
+    event_type = db.Column(db.String(20), nullable=False)  # see BOOKING_EVENT_TYPES
+    booking_id = db.Column(db.Integer, nullable=False, index=True)
+    # The booking as it is after the event (as it was, for removals)
+    user_id = db.Column(db.Integer)
+    journey_id = db.Column(db.Integer)
+    seat_type_id = db.Column(db.Integer)
+    slot_id = db.Column(db.Integer)
+    travel_date = db.Column(db.Date)
+    final_price = db.Column(db.Float)
+    seats_booked = db.Column(db.Integer)
+    status = db.Column(db.String(20))
+    amount = db.Column(db.Float)  # cancellation charge, price change
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SeatMap(db.Model):
+    __tablename__ = 'seat_maps'
+    id = db.Column(db.Integer, primary_key=True)
+    slot_id = db.Column(db.Integer, nullable=False)
+    travel_date = db.Column(db.Date, nullable=False)
+    seat_type_id = db.Column(db.Integer, nullable=False)
+    taken = db.Column(db.LargeBinary, nullable=False, default=b'')  # bit n set = seat n + 1 taken
+    version = db.Column(db.Integer, nullable=False, default=1)
+    __table_args__ = (db.UniqueConstraint('slot_id', 'travel_date', 'seat_type_id', name='uq_seat_map'),)
+
+
+class CacheVersion(db.Model):
+    __tablename__ = 'cache_versions'
+    namespace = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# 🔍 Query monitor (debug mode / CI)
+# Every statement run through an engine is timed and grouped per request by
+# its normalized SQL, so N+1 loops and slow queries show up in the log with
+# the app.py line that issued them.
+_SQL_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SQL_PARAMS = re.compile(r"%\(\w+\)s|%s|:\w+|\?")
+_SQL_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SQL_SPACES = re.compile(r"\s+")
+_query_budgets = threading.local()
+
+
+def normalize_sql(statement):
+    """Reduce a statement to its shape: literals and bind params become ``?``."""
+    sql = _SQL_STRINGS.sub('?', statement)
+    sql = _SQL_NUMBERS.sub('?', sql)
+    sql = _SQL_PARAMS.sub('?', sql)
+    sql = _SQL_IN_LISTS.sub('(?)', sql)
+    return _SQL_SPACES.sub(' ', sql).strip()
+
+
+def _query_origin():
+    """Innermost app.py frame outside the monitor itself, as ``app.py:123 in view``."""
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename == __file__ and not frame.name.startswith(('_query', '_after_cursor')):
+            return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+    return "<outside app.py>"
+
+
+def _active_query_logs():
+    logs = list(getattr(_query_budgets, 'stack', []))
+    if has_app_context() and g.get('_query_log') is not None:
+        logs.append(g._query_log)
+    return logs
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if _active_query_logs():
+        conn.info.setdefault('_query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    logs = _active_query_logs()
+    started = conn.info.get('_query_started')
+    if not logs or not started:
+        return
+    elapsed_ms = (time.perf_counter() - started.pop()) * 1000
+    entry = {
+        'sql': normalize_sql(statement),
+        'ms': elapsed_ms,
+        'origin': _query_origin(),
+    }
+    for log in logs:
+        log.append(entry)
+
+
+def _query_monitor_enabled():
+    return app.debug or app.config.get('QUERY_MONITOR', False)
+
+
+def report_queries(queries, label):
+    """Log repeated-shape (N+1) and slow statements; returns the warnings."""
+    warnings = []
+    threshold = app.config.get('N_PLUS_ONE_THRESHOLD', 5)
+    slow_ms = app.config.get('SLOW_QUERY_MS', 100)
+
+    groups = {}
+    for q in queries:
+        groups.setdefault(q['sql'], []).append(q)
+
+    for sql, runs in groups.items():
+        if len(runs) >= threshold:
+            origins = sorted({q['origin'] for q in runs})
+            warnings.append(f"N+1 suspected in {label}: {len(runs)}x [{sql}] from {', '.join(origins)}")
+        for q in runs:
+            if q['ms'] >= slow_ms:
+                warnings.append(f"Slow query in {label}: {q['ms']:.1f} ms [{sql}] from {q['origin']}")
+
+    for w in warnings:
+        app.logger.warning(w)
+    return warnings
+
+
+@app.before_request
+def _query_monitor_start():
+    if _query_monitor_enabled():
+        g._query_log = []
+
+
+@app.after_request
+def _query_monitor_report(response):
+    queries = g.get('_query_log')
+    if queries is not None:
+        report_queries(queries, f"{request.method} {request.path}")
+        response.headers['X-Query-Count'] = str(len(queries))
+    return response
+
+
+@contextmanager
+def query_budget(max_queries):
+    """Fail when the block issues more than ``max_queries`` statements.
+
+    Meant for tests, e.g.::
+
+        with query_budget(3):
+            client.get('/my-bookings')
+    """
+    queries = []
+    stack = getattr(_query_budgets, 'stack', None)
+    if stack is None:
+        stack = _query_budgets.stack = []
+    stack.append(queries)
+    try:
+        yield queries
+    finally:
+        stack.remove(queries)
+
+    if len(queries) > max_queries:
+        report_queries(queries, 'query budget')
+        listing = "\n".join(f"  {q['origin']}: {q['sql']}" for q in queries)
+        raise AssertionError(f"Expected at most {max_queries} queries, got {len(queries)}:\n{listing}")
+
+
+# 🔬 Request profiler
+# An admin adds ?profile=1 (or an ``X-Profile: 1`` header) to a request to
+# profile it, and PROFILE_SAMPLE_EVERY = N profiles one in N of all
+# requests. pyinstrument is used when installed (HTML flame graph);
+# otherwise a thread samples the request's stack every PROFILE_INTERVAL_MS
+# and writes a speedscope file. Only the newest PROFILE_MAX_FILES profiles
+# are kept, and the file name records when, how long and which endpoint, so
+# the admin page needs nothing but a directory listing.
+try:
+    from pyinstrument import Profiler as InstrumentProfiler
+except ImportError:  # optional, falls back to StackSampler
+    InstrumentProfiler = None
+
+_PROFILE_NAME = re.compile(r'(\d+)-(\d+)ms-([A-Z]+)-([\w.]+)\.(html|speedscope\.json)')
+_profile_counter = itertools.count(1)
+
+
+def profile_dir():
+    path = app.config.get('PROFILE_DIR') or os.path.join(app.instance_path, 'profiles')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval; exports speedscope JSON."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.frames = {}
+        self.samples = []
+        self.weights = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_name, code.co_filename, code.co_firstlineno)
+                stack.append(self.frames.setdefault(key, len(self.frames)))
+                frame = frame.f_back
+            stack.reverse()
+            self.samples.append(stack)
+            self.weights.append((now - last) * 1000)
+            last = now
+
+    def speedscope(self, name):
+        frames = [{'name': fn, 'file': filename, 'line': line} for fn, filename, line in self.frames]
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'app.py StackSampler',
+            'shared': {'frames': frames},
+            'profiles': [{
+                'type': 'sampled', 'name': name, 'unit': 'milliseconds',
+                'startValue': 0, 'endValue': sum(self.weights),
+                'samples': self.samples, 'weights': self.weights,
+            }],
+        }
+
+
+def _should_profile():
+    if request.endpoint in (None, 'static') or not app.config.get('PROFILER_ENABLED', True):
+        return False
+    if session.get('role') == 'admin' and '1' in (request.args.get('profile'), request.headers.get('X-Profile')):
+        return True
+    every = app.config.get('PROFILE_SAMPLE_EVERY', 0)
+    return every > 0 and next(_profile_counter) % every == 0
+
+
+def prune_profiles(path, keep):
+    names = sorted(name for name in os.listdir(path) if _PROFILE_NAME.fullmatch(name))
+    for name in names[:max(len(names) - keep, 0)]:
+        try:
+            os.remove(os.path.join(path, name))
+        except FileNotFoundError:  # another worker got there first
+            pass
+
+
+def save_profile(profiler, elapsed_ms):
+    """Write the finished profile to the profile directory; returns its file name."""
+    stamp = f"{int(time.time() * 1000)}-{elapsed_ms:.0f}ms-{request.method}-{request.endpoint}"
+    label = f"{request.method} {request.full_path.rstrip('?')} ({elapsed_ms:.0f} ms)"
+    if isinstance(profiler, StackSampler):
+        name, content = f"{stamp}.speedscope.json", json.dumps(profiler.speedscope(label))
+    else:
+        name, content = f"{stamp}.html", profiler.output_html()
+
+    path = profile_dir()
+    with open(os.path.join(path, name), 'w', encoding='utf-8') as f:
+        f.write(content)
+    prune_profiles(path, app.config.get('PROFILE_MAX_FILES', 200))
+    return name
+
+
+@app.before_request
+def _profiler_start():
+    if not _should_profile():
+        return
+    interval = app.config.get('PROFILE_INTERVAL_MS', 1) / 1000
+    if InstrumentProfiler is not None:
+        profiler = InstrumentProfiler(interval=interval, async_mode='disabled')
+    else:
+        profiler = StackSampler(threading.get_ident(), interval)
+    g._profiler = profiler
+    g._profile_started = time.perf_counter()
+    profiler.start()
+
+
+def _profiler_stop():
+    profiler = g.pop('_profiler', None)
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+
+@app.after_request
+def _profiler_save(response):
+    profiler = _profiler_stop()
+    if profiler is not None:
+        try:
+            name = save_profile(profiler, (time.perf_counter() - g._profile_started) * 1000)
+            response.headers['X-Profile'] = name
+            print(f"🔬 Saved profile {name}")
+        except OSError as e:
+            print(f"❌ Failed to save profile: {e}")
+    return response
+
+
+@app.teardown_request
+def _profiler_teardown(exc):
+    _profiler_stop()  # the request failed before after_request ran
+
+
+def list_profiles():
+    """Saved profiles, newest first, as dicts with name/created/ms/method/endpoint/route."""
+    rules = {}
+    for rule in app.url_map.iter_rules():
+        rules.setdefault(rule.endpoint, rule.rule)
+    profiles = []
+    for name in os.listdir(profile_dir()):
+        match = _PROFILE_NAME.fullmatch(name)
+        if match:
+            stamp, ms, method, endpoint, _ = match.groups()
+            profiles.append({
+                'name': name, 'created': datetime.fromtimestamp(int(stamp) / 1000), 'ms': int(ms),
+                'method': method, 'endpoint': endpoint, 'route': rules.get(endpoint, endpoint),
+            })
+    profiles.sort(key=lambda p: p['created'], reverse=True)
+    return profiles
+
+
+# 📣 Cache invalidation bus
+# In-process caches (fragments, city index, route graph, booking details)
+# live in every worker on every node. A write that makes them stale bumps
+# its namespace in cache_versions; each worker reads that small table at
+# most every CACHE_BUS_POLL_SECONDS (one primary-key scan at the start of a
+# request) and runs the handlers of any namespace whose version moved.
+class CacheBus:
+    def __init__(self):
+        self._handlers = {}  # namespace -> [callable]
+        self._seen = {}  # namespace -> last version handled here
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, namespace, handler):
+        self._handlers.setdefault(namespace, []).append(handler)
+
+    def bump(self, namespace):
+        """Tell every worker that ``namespace`` changed (commits). Returns the new version.
+
+        Call it after committing the change and before refreshing local caches,
+        so this process doesn't run its own handlers again on the next check.
+        """
+        for _ in range(3):
+            result = db.session.execute(
+                update(CacheVersion).where(CacheVersion.namespace == namespace)
+                .values(version=CacheVersion.version + 1, updated_at=datetime.utcnow()),
+                execution_options={'synchronize_session': False}
+            )
+            if result.rowcount == 0:
+                db.session.add(CacheVersion(namespace=namespace, version=1))
+                try:
+                    db.session.flush()
+                except IntegrityError:  # another worker created the row first
+                    db.session.rollback()
+                    continue
+            version = db.session.scalar(db.select(CacheVersion.version).where(CacheVersion.namespace == namespace))
+            db.session.commit()
+            with self._lock:
+                self._seen[namespace] = version
+            return version
+        raise RuntimeError(f"Could not bump cache version for {namespace}")
+
+    def check(self, force=False):
+        """Run the handlers of namespaces changed by other workers since the last check."""
+        now = time.monotonic()
+        poll = app.config.get('CACHE_BUS_POLL_SECONDS', 1)
+        if not force and self._checked is not None and now - self._checked < poll:
+            return []
+        self._checked = now
+
+        versions = dict(db.session.execute(db.select(CacheVersion.namespace, CacheVersion.version)).all())
+        changed = []
+        with self._lock:
+            for namespace, version in versions.items():
+                if self._seen.get(namespace) != version:
+                    self._seen[namespace] = version
+                    changed.append(namespace)
+        for namespace in changed:
+            for handler in self._handlers.get(namespace, []):
+                handler()
+        return changed
+
+
+cache_bus = CacheBus()
+
+
+@app.before_request
+def _check_cache_bus():
+    if request.endpoint != 'static':
+        cache_bus.check()
+
+
+# 💺 Seat inventory
+# A slot holds the seats of its seat maps added up, so slot-wide seat counts
+# and the seat maps agree
+SLOT_CAPACITY = sum(app.config.get('SEAT_MAP_LAYOUT', {}).values())
+SEAT_HOLDING_STATUSES = ('paid',)
+BOOKING_WINDOW_DAYS = 120  # how far ahead travel can be booked
+
+
+def booked_seats(slot_dates):
+    """Seats held per ``(slot_id, travel_date)`` by paid bookings, in one query."""
+    slot_dates = list(slot_dates)
+    if not slot_dates:
+        return {}
+
+    rows = db.session.execute(
+        db.select(Booking.slot_id, Booking.travel_date, func.sum(Booking.seats_booked))
+        .where(
+            tuple_(Booking.slot_id, Booking.travel_date).in_(slot_dates),
+            Booking.status.in_(SEAT_HOLDING_STATUSES)
+        )
+        .group_by(Booking.slot_id, Booking.travel_date)
+    )
+    return {(slot_id, travel_date): int(total or 0) for slot_id, travel_date, total in rows}
+
+
+# 🪑 Seat maps
+# Each (slot, travel date, seat type) has a bitset of taken seats, stored
+# little-endian in seat_maps.taken: ceil(seats / 8) bytes, 19 for the
+# default 140-seat layout. Seats are numbered row by row, SEAT_MAP_ROW_WIDTH
+# to a row. A block of N adjacent free seats is found with shifts and ANDs
+# over the whole map, and releasing seats clears their bits. Maps are
+# written with compare-and-swap on their version, in the same transaction
+# as the booking, and created on first use (or in bulk by
+# ``flask seatmaps init``).
+from functools import lru_cache
+
+
+def seat_map_capacity(seat_type_name):
+    """Seats of ``seat_type_name`` on every slot; 0 for types missing from SEAT_MAP_LAYOUT."""
+    return app.config.get('SEAT_MAP_LAYOUT', {}).get(seat_type_name, 0)
+
+
+def decode_seats(data):
+    return int.from_bytes(data or b'', 'little')
+
+
+def encode_seats(bits, capacity):
+    return bits.to_bytes((capacity + 7) // 8, 'little')
+
+
+def seat_numbers_of(mask):
+    """Bitmask -> 1-based seat numbers."""
+    numbers = []
+    while mask:
+        low = mask & -mask
+        numbers.append(low.bit_length())
+        mask ^= low
+    return numbers
+
+
+def seats_mask(numbers):
+    mask = 0
+    for number in numbers:
+        mask |= 1 << (number - 1)
+    return mask
+
+
+def parse_seat_numbers(value):
+    """``"3,4"`` / ``[3, 4]`` -> ``[3, 4]``; raises ValueError on anything else."""
+    if isinstance(value, str):
+        value = [part for part in value.split(',') if part.strip()]
+    return [int(number) for number in value or []]
+
+
+@lru_cache(maxsize=256)
+def _block_starts(capacity, row_width, n):
+    """Bit i set where an n-seat block starting at seat i fits in one row (or, for n wider
+    than a row, in the map)."""
+    mask = 0
+    for i in range(capacity - n + 1):
+        if n > row_width or i % row_width + n <= row_width:
+            mask |= 1 << i
+    return mask
+
+
+def pick_seats(taken, capacity, n, row_width):
+    """Mask of seats for ``n`` passengers: the first block of ``n`` adjacent free seats,
+    otherwise the first ``n`` free seats. None if fewer than ``n`` are free."""
+    free = ~taken & ((1 << capacity) - 1)
+    if bin(free).count('1') < n:
+        return None
+
+    # runs has bit i set while seats i .. i+span-1 are all free; double span up to n
+    runs, span = free, 1
+    while span < n:
+        step = min(span, n - span)
+        runs &= runs >> step
+        span += step
+    starts = runs & _block_starts(capacity, row_width, n)
+    if starts:
+        first = (starts & -starts).bit_length() - 1
+        return ((1 << n) - 1) << first
+
+    mask = 0
+    for _ in range(n):
+        low = free & -free
+        mask |= low
+        free ^= low
+    return mask
+
+
+def _existing_seat_map(session, slot_id, travel_date, seat_type_id):
+    seat_type = session.get(SeatType, seat_type_id)
+    capacity = seat_map_capacity(seat_type.type_name if seat_type else None)
+    seat_map = session.execute(
+        db.select(SeatMap).where(SeatMap.slot_id == slot_id, SeatMap.travel_date == travel_date,
+                                 SeatMap.seat_type_id == seat_type_id)
+        .execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+    return seat_map, capacity
+
+
+def _legacy_seating(session, slot_id, travel_date, seat_type_id, capacity):
+    """``(taken, {booking: "n,n"})`` for a map that doesn't exist yet: the seats already
+    held, plus the seats it would give paid bookings made before seat maps existed."""
+    holders = session.scalars(
+        db.select(Booking).where(Booking.slot_id == slot_id, Booking.travel_date == travel_date,
+                                 Booking.seat_type_id == seat_type_id,
+                                 Booking.status.in_(SEAT_HOLDING_STATUSES))
+        .order_by(Booking.id)
+    ).all()
+    taken = 0
+    for booking in holders:
+        if booking.seat_numbers:
+            taken |= seats_mask(parse_seat_numbers(booking.seat_numbers))
+    assigned = {}
+    for booking in holders:
+        if not booking.seat_numbers:
+            mask = pick_seats(taken, capacity, booking.seats_booked, app.config.get('SEAT_MAP_ROW_WIDTH', 4))
+            if mask is None:
+                break  # oversold before seat maps; leave the rest unassigned
+            taken |= mask
+            assigned[booking] = ','.join(map(str, seat_numbers_of(mask)))
+    return taken, assigned
+
+
+def load_seat_map(session, slot_id, travel_date, seat_type_id):
+    """``(SeatMap, capacity)``, creating the map on first use.
+
+    A new map also gives seats to paid bookings made before seat maps
+    existed. Raises StaleDataError if another request created it first.
+    """
+    # The booking being seated may be pending or just marked paid; it must not be
+    # mistaken for one of the older bookings below
+    with session.no_autoflush:
+        seat_map, capacity = _existing_seat_map(session, slot_id, travel_date, seat_type_id)
+        if seat_map is not None:
+            return seat_map, capacity
+
+        taken, assigned = _legacy_seating(session, slot_id, travel_date, seat_type_id, capacity)
+        for booking, numbers in assigned.items():
+            booking.seat_numbers = numbers
+        seat_map = SeatMap(slot_id=slot_id, travel_date=travel_date, seat_type_id=seat_type_id,
+                           taken=encode_seats(taken, capacity), version=1)
+        session.add(seat_map)
+        try:
+            session.flush()
+        except IntegrityError:
+            raise StaleDataError(f"Seat map for slot {slot_id} on {travel_date} created concurrently")
+        return seat_map, capacity
+
+
+def peek_seat_map(session, slot_id, travel_date, seat_type_id):
+    """``(taken, capacity)`` without writing: a missing map is worked out in memory."""
+    seat_map, capacity = _existing_seat_map(session, slot_id, travel_date, seat_type_id)
+    if seat_map is not None:
+        return decode_seats(seat_map.taken), capacity
+    return _legacy_seating(session, slot_id, travel_date, seat_type_id, capacity)[0], capacity
+
+
+def _swap_seat_map(session, seat_map, taken, capacity):
+    result = session.execute(
+        update(SeatMap).where(SeatMap.id == seat_map.id, SeatMap.version == seat_map.version)
+        .values(taken=encode_seats(taken, capacity), version=seat_map.version + 1),
+        execution_options={'synchronize_session': False}
+    )
+    if result.rowcount != 1:
+        raise StaleDataError(f"Seat map {seat_map.id} changed concurrently")
+
+
+def assign_seats(session, slot_id, travel_date, seat_type_id, count, wanted=None):
+    """Take ``count`` seats (the ``wanted`` seat numbers, or the best free block).
+
+    Returns ``(error, "n,n,...")``. Doesn't commit; raises StaleDataError on
+    a concurrent change, for :func:`retry_on_conflict`.
+    """
+    seat_map, capacity = load_seat_map(session, slot_id, travel_date, seat_type_id)
+    if not capacity:
+        app.logger.warning(f"Seat type {seat_type_id} is missing from SEAT_MAP_LAYOUT; refusing to sell it")
+        return "That seat type isn't sold on this service.", None
+    taken = decode_seats(seat_map.taken)
+    if wanted:
+        if len(set(wanted)) != count or not all(1 <= number <= capacity for number in wanted):
+            return f"Pick {count} different seat(s) between 1 and {capacity}.", None
+        mask = seats_mask(wanted)
+        if mask & taken:
+            return "Some of those seats have just been taken, please pick again.", None
+    else:
+        mask = pick_seats(taken, capacity, count, app.config.get('SEAT_MAP_ROW_WIDTH', 4))
+        if mask is None:
+            return "Not enough seats of that type left on this slot.", None
+
+    _swap_seat_map(session, seat_map, taken | mask, capacity)
+    return None, ','.join(map(str, seat_numbers_of(mask)))
+
+
+def release_seats(session, slot_id, travel_date, seat_type_id, seat_numbers):
+    """Give ``seat_numbers`` back to the map. Doesn't commit."""
+    if not seat_numbers:
+        return
+    seat_map, capacity = load_seat_map(session, slot_id, travel_date, seat_type_id)
+    taken = decode_seats(seat_map.taken) & ~seats_mask(parse_seat_numbers(seat_numbers))
+    _swap_seat_map(session, seat_map, taken, capacity)
+
+
+def assign_booking_seats(session, booking, wanted=None):
+    """Seat a booking that is about to be paid; returns an error message or None."""
+    error, numbers = assign_seats(session, booking.slot_id, booking.travel_date, booking.seat_type_id,
+                                  booking.seats_booked, wanted)
+    if not error:
+        booking.seat_numbers = numbers
+    return error
+
+
+# ⚡ Hot queries
+# Statements run on nearly every request are built once, here, with named
+# bound parameters. A prebuilt statement memoizes its cache key, so each
+# execution is a compiled-cache lookup plus the parameter values, instead of
+# rebuilding an ORM query and generating a cache key for it (or compiling
+# it, on a cache miss). ``flask bench queries`` measures the difference.
+SEATS_HELD = db.select(func.coalesce(func.sum(Booking.seats_booked), 0)).where(
+    Booking.slot_id == bindparam('slot_id'), Booking.travel_date == bindparam('travel_date'),
+    Booking.status.in_(SEAT_HOLDING_STATUSES)
+)
+
+CART_COUNT = db.select(func.count(Booking.id)).where(
+    Booking.user_id == bindparam('user_id'), Booking.status == 'unpaid'
+)
+
+MY_BOOKINGS = db.select(
+    Booking.id, Booking.travel_date, Booking.final_price, Booking.status,
+    Journey.departure_city, Journey.arrival_city,
+    JourneySlot.departure_time.label('slot_departure'), JourneySlot.arrival_time.label('slot_arrival'),
+    SeatType.type_name.label('seat_type'),
+).join(Journey, Booking.journey_id == Journey.id) \
+ .join(JourneySlot, Booking.slot_id == JourneySlot.id) \
+ .join(SeatType, Booking.seat_type_id == SeatType.id) \
+ .where(Booking.user_id == bindparam('user_id')) \
+ .order_by(Booking.created_at.desc())
+
+BOOKING_DETAILS = db.select(
+    Booking.id, Booking.user_id, User.name, User.email, Booking.journey_id, Journey.departure_city,
+    Journey.arrival_city, Booking.slot_id, JourneySlot.departure_time, JourneySlot.arrival_time,
+    Booking.seat_type_id, SeatType.type_name, Booking.travel_date, Booking.final_price,
+    Booking.seats_booked, Booking.status, Booking.created_at, Booking.seat_numbers,
+).join(User, Booking.user_id == User.id) \
+ .join(Journey, Booking.journey_id == Journey.id) \
+ .join(SeatType, Booking.seat_type_id == SeatType.id) \
+ .join(JourneySlot, Booking.slot_id == JourneySlot.id) \
+ .where(Booking.id.in_(bindparam('booking_ids', expanding=True)))
+
+
+# ✏️ Booking changes
+# Changes to a booking are compare-and-swap UPDATEs (WHERE id = ? AND
+# version = ?) that bump its version, so a concurrent edit, cancellation or
+# checkout makes the later writer re-read and try again instead of
+# silently overwriting, without holding row locks. A move to another date
+# re-checks the seats in the same statement.
+BookingChange = namedtuple('BookingChange', [
+    'booking_id', 'user_id', 'journey_id', 'slot_id', 'created_at', 'old_date', 'new_date',
+    'seat_type', 'final_price', 'price_change',
+])
+
+
+def retry_on_conflict(attempt):
+    """Run ``attempt`` until it doesn't raise StaleDataError (at most BOOKING_UPDATE_RETRIES times)."""
+    retries = app.config.get('BOOKING_UPDATE_RETRIES', 3)
+    for n in range(retries):
+        try:
+            return attempt()
+        except StaleDataError:
+            db.session.rollback()
+            if n == retries - 1:
+                raise
+            time.sleep(0.005 * (n + 1) * (1 + Random().random()))
+
+
+def seats_left_after(slot_id, travel_date, seats, booking_id):
+    """SQL condition: ``seats`` more fit on (slot, date) besides ``booking_id``'s own."""
+    other = aliased(Booking)
+    held = db.select(func.coalesce(func.sum(other.seats_booked), 0).label('held')).where(
+        other.slot_id == slot_id,
+        other.travel_date == travel_date,
+        other.status.in_(SEAT_HOLDING_STATUSES),
+        other.id != booking_id,
+    ).subquery()  # a derived table, so MySQL allows it inside an UPDATE of the same table
+    return db.select(held.c.held).scalar_subquery() + seats <= SLOT_CAPACITY
+
+
+def _compare_and_swap(booking, values, *conditions):
+    """Apply ``values`` if the booking is still at the version we read. Returns False if a
+    condition failed; raises StaleDataError if someone else changed the booking."""
+    booking_id, version = booking.id, booking.version
+    result = db.session.execute(
+        update(Booking).where(Booking.id == booking_id, Booking.version == version, *conditions)
+        .values(version=version + 1, **values),
+        execution_options={'synchronize_session': False}
+    )
+    if result.rowcount == 1:
+        db.session.commit()
+        return True
+
+    current = db.session.scalar(db.select(Booking.version).where(Booking.id == booking_id))
+    db.session.rollback()
+    if current != version:
+        raise StaleDataError(f"Booking {booking_id} changed concurrently")
+    return False
+
+
+def _fresh_booking(booking_id):
+    return db.session.execute(
+        db.select(Booking).where(Booking.id == booking_id).execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+
+
+def change_booking(booking_id, user_id, new_date, new_seat_id):
+    """Move a paid booking to ``new_date``/``new_seat_id``. Returns ``(error, BookingChange)``."""
+    def attempt():
+        booking = _fresh_booking(booking_id)
+        if booking is None or booking.user_id != user_id or booking.status != 'paid':
+            return "Unauthorized or booking not active", None
+
+        journey = db.session.get(Journey, booking.journey_id)
+        new_seat = db.session.get(SeatType, new_seat_id)
+        if new_seat is None:
+            return "Invalid seat type.", None
+
+        # Calculate new price with discount logic
+        days_diff = (new_date - date.today()).days
+        discount = 0
+        if 91 <= days_diff <= 120:
+            discount = 0.30
+        elif 80 <= days_diff <= 90:
+            discount = 0.20
+        elif 60 <= days_diff <= 79:
+            discount = 0.10
+        elif 45 <= days_diff <= 59:
+            discount = 0.05
+
+        base_price = journey.base_fare * new_seat.multiplier
+        final_price = round(base_price * (1 - discount), 2)
+
+        change = BookingChange(booking.id, booking.user_id, booking.journey_id, booking.slot_id,
+                               booking.created_at, booking.travel_date, new_date, new_seat.type_name,
+                               final_price, final_price - booking.final_price)
+        conditions = [Booking.status == 'paid']
+        if new_date != booking.travel_date:
+            conditions.append(seats_left_after(booking.slot_id, new_date, booking.seats_booked, booking.id))
+
+        values = {'travel_date': new_date, 'seat_type_id': new_seat_id, 'final_price': final_price}
+        if (new_date, new_seat_id) != (booking.travel_date, booking.seat_type_id):
+            release_seats(db.session, booking.slot_id, booking.travel_date, booking.seat_type_id,
+                          booking.seat_numbers)
+            error, values['seat_numbers'] = assign_seats(db.session, booking.slot_id, new_date, new_seat_id,
+                                                         booking.seats_booked)
+            if error:
+                db.session.rollback()
+                return error, None
+        if not _compare_and_swap(booking, values, *conditions):
+            return "Not enough seats left on that date.", None
+        return None, change
+
+    return retry_on_conflict(attempt)
+
+
+# 📜 Booking event log
+# Every booking state change is appended to booking_events with a snapshot
+# of the booking, so availability and report totals can be rebuilt by
+# replaying the log, and consumers can follow it by offset (the event id).
+# Requests hand their events to one writer thread per process, which
+# inserts whatever has queued up (across concurrent requests) in a single
+# transaction and then wakes the waiting requests: one commit per batch
+# instead of one per request. Maintenance jobs write their events in the
+# same transaction as the rows they remove.
+BOOKING_EVENT_TYPES = ('created', 'paid', 'updated', 'cancelled', 'cart_removed', 'deleted', 'archived')
+REMOVAL_EVENT_TYPES = ('cart_removed', 'deleted', 'archived')
+BOOKING_EVENT_FIELDS = ('user_id', 'journey_id', 'seat_type_id', 'slot_id', 'travel_date', 'final_price',
+                        'seats_booked', 'status')
+
+
+def booking_event(event_type, booking, amount=None, **changes):
+    """An event row for ``booking`` (a Booking or BookingDetail), with ``changes`` applied."""
+    row = {field: getattr(booking, field) for field in BOOKING_EVENT_FIELDS}
+    row.update(changes)
+    row.update(event_type=event_type, booking_id=booking.id, amount=amount, created_at=datetime.utcnow())
+    return row
+
+
+def booking_events_from_select(event_type, where):
+    """INSERT ... SELECT of ``event_type`` events for the bookings matching ``where``."""
+    return insert(BookingEvent).from_select(
+        ['event_type', 'booking_id', *BOOKING_EVENT_FIELDS, 'created_at'],
+        db.select(db.literal(event_type), Booking.id, *[getattr(Booking, f) for f in BOOKING_EVENT_FIELDS],
+                  db.literal(datetime.utcnow(), db.DateTime)).where(where)
+    )
+
+
+class BookingEventLog:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.dropped_batches = 0  # appends that failed or weren't confirmed in time
+        self.dropped_events = 0
+
+    def append(self, rows):
+        """Write ``rows`` (one transaction's events) and wait until they are committed.
+
+        Returns False if they could not be written; the booking change itself
+        has already been committed by then, so callers carry on.
+        """
+        rows = list(rows)
+        if not rows:
+            return True
+        if not app.config.get('BOOKING_EVENTS_GROUP_COMMIT', True):
+            ok = self._write(rows)
+        else:
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name='booking-events', daemon=True)
+                    self._thread.start()
+            item = {'rows': rows, 'done': threading.Event(), 'ok': False}
+            self._queue.put(item)
+            item['done'].wait(app.config.get('BOOKING_EVENTS_TIMEOUT_SECONDS', 5))
+            ok = item['ok']
+        if not ok:
+            self._dropped(rows)
+        return ok
+
+    def _dropped(self, rows):
+        with self._lock:
+            self.dropped_batches += 1
+            self.dropped_events += len(rows)
+        events = ', '.join(f"{row['event_type']} #{row['booking_id']}" for row in rows[:10])
+        print(f"❌ Booking events not confirmed ({self.dropped_events} so far in this process): {events}"
+              f"{' …' if len(rows) > 10 else ''}")
+
+    def _write(self, rows):
+        try:
+            db.session.execute(insert(BookingEvent), rows)
+            db.session.commit()
+            return True
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Failed to write {len(rows)} booking event(s): {e}")
+            return False
+
+    def _run(self):
+        max_rows = app.config.get('BOOKING_EVENTS_BATCH_SIZE', 500)
+        linger = app.config.get('BOOKING_EVENTS_LINGER_MS', 2) / 1000
+        with app.app_context():
+            while True:
+                batch = [self._queue.get()]
+                rows = list(batch[0]['rows'])
+                deadline = time.monotonic() + linger
+                while len(rows) < max_rows:
+                    try:
+                        item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    batch.append(item)
+                    rows.extend(item['rows'])
+
+                ok = self._write(rows)
+                db.session.remove()
+                for item in batch:
+                    item['ok'] = ok
+                    item['done'].set()
+
+
+booking_event_log = BookingEventLog()
+
+
+def read_booking_events(after=0, limit=1000, settle_seconds=None):
+    """Events with an offset above ``after``, oldest first.
+
+    Events younger than ``settle_seconds`` are held back: writers in other
+    processes may still commit a lower offset, and a consumer that had moved
+    past it would never see it.
+    """
+    if settle_seconds is None:
+        settle_seconds = app.config.get('BOOKING_EVENTS_SETTLE_SECONDS', 2)
+    query = db.select(BookingEvent).where(BookingEvent.id > after).order_by(BookingEvent.id).limit(limit)
+    if settle_seconds:
+        query = query.where(BookingEvent.created_at <= datetime.utcnow() - timedelta(seconds=settle_seconds))
+    return db.session.scalars(query).all()
+
+
+def booking_event_dict(event):
+    row = {field: getattr(event, field) for field in ('id', 'event_type', 'booking_id', *BOOKING_EVENT_FIELDS,
+                                                      'amount', 'created_at')}
+    row['travel_date'] = event.travel_date.isoformat() if event.travel_date else None
+    row['created_at'] = event.created_at.isoformat() if event.created_at else None
+    return row
+
+
+class BookingEventReplay:
+    """Folds the event log into current bookings, seat availability and report totals.
+
+    ``offset`` is the last event applied, so a replay can be resumed with
+    :meth:`consume` as new events arrive.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.bookings = {}  # booking id -> latest snapshot (dict)
+        self.seats = {}  # (slot_id, travel_date) -> seats held by paid bookings
+        self.monthly_sales = {}  # 'YYYY-MM' of travel date -> paid revenue
+        self.customers = {}  # user_id -> [paid revenue, paid bookings]
+        self.routes = {}  # journey_id -> [paid revenue, paid bookings]
+        self.cancelled = [0, 0.0]  # [count, value lost]
+
+    def _count(self, snapshot, sign):
+        if snapshot['status'] in SEAT_HOLDING_STATUSES:
+            key = (snapshot['slot_id'], snapshot['travel_date'])
+            self.seats[key] = self.seats.get(key, 0) + sign * snapshot['seats_booked']
+        if snapshot['status'] == 'paid':
+            price = snapshot['final_price'] or 0
+            month = snapshot['travel_date'].strftime('%Y-%m')
+            self.monthly_sales[month] = self.monthly_sales.get(month, 0) + sign * price
+            for totals, key in ((self.customers, snapshot['user_id']), (self.routes, snapshot['journey_id'])):
+                entry = totals.setdefault(key, [0.0, 0])
+                entry[0] += sign * price
+                entry[1] += sign
+        elif snapshot['status'] == 'cancelled':
+            self.cancelled[0] += sign
+            self.cancelled[1] += sign * (snapshot['final_price'] or 0)
+
+    def apply(self, event):
+        previous = self.bookings.pop(event.booking_id, None)
+        if previous is not None:
+            self._count(previous, -1)
+        if event.event_type not in REMOVAL_EVENT_TYPES:
+            snapshot = {field: getattr(event, field) for field in BOOKING_EVENT_FIELDS}
+            self.bookings[event.booking_id] = snapshot
+            self._count(snapshot, 1)
+        self.offset = event.id
+
+    def consume(self, batch_size=5000, settle_seconds=None, progress=None):
+        """Apply every event after ``offset``; returns how many were applied."""
+        applied = 0
+        while True:
+            events = read_booking_events(self.offset, batch_size, settle_seconds)
+            for event in events:
+                self.apply(event)
+            applied += len(events)
+            db.session.expunge_all()
+            if progress and events:
+                progress(self)
+            if len(events) < batch_size:
+                return applied
+
+    def aggregates(self):
+        def nonzero(totals):
+            return {key: value for key, value in totals.items() if value}
+        return {
+            'seats': nonzero(self.seats),
+            'monthly_sales': {month: round(total, 2) for month, total in self.monthly_sales.items()
+                              if round(total, 2)},
+            'customers': {key: (round(v[0], 2), v[1]) for key, v in self.customers.items() if v[1]},
+            'routes': {key: (round(v[0], 2), v[1]) for key, v in self.routes.items() if v[1]},
+            'cancelled': (self.cancelled[0], round(self.cancelled[1], 2)),
+        }
+
+
+def live_booking_aggregates():
+    """The same totals as :meth:`BookingEventReplay.aggregates`, read from the bookings table."""
+    paid = Booking.status == 'paid'
+    seats = db.session.execute(
+        db.select(Booking.slot_id, Booking.travel_date, func.sum(Booking.seats_booked))
+        .where(Booking.status.in_(SEAT_HOLDING_STATUSES)).group_by(Booking.slot_id, Booking.travel_date)
+    )
+    monthly = {}
+    for travel_date, total in db.session.execute(
+        db.select(Booking.travel_date, func.sum(Booking.final_price)).where(paid).group_by(Booking.travel_date)
+    ):
+        month = travel_date.strftime('%Y-%m')
+        monthly[month] = monthly.get(month, 0) + (total or 0)
+
+    def paid_totals(column):
+        rows = db.session.execute(
+            db.select(column, func.sum(Booking.final_price), func.count(Booking.id)).where(paid).group_by(column)
+        )
+        return {key: (round(total or 0, 2), count) for key, total, count in rows}
+
+    cancelled = db.session.execute(
+        db.select(func.count(Booking.id), func.sum(Booking.final_price)).where(Booking.status == 'cancelled')
+    ).one()
+    return {
+        'seats': {(slot_id, travel_date): int(total) for slot_id, travel_date, total in seats if total},
+        'monthly_sales': {month: round(total, 2) for month, total in monthly.items() if round(total, 2)},
+        'customers': paid_totals(Booking.user_id),
+        'routes': paid_totals(Booking.journey_id),
+        'cancelled': (cancelled[0], round(cancelled[1] or 0, 2)),
+    }
+
+
+@app.route('/admin/events')
+@admin_required
+def booking_events_feed():
+    """JSON page of the event log: ``?after=<offset>&limit=``; pass ``next`` back as ``after``."""
+    try:
+        after = int(request.args.get('after', 0))
+        limit = min(max(int(request.args.get('limit', 1000)), 1), 10000)
+    except ValueError:
+        return jsonify({'error': 'after and limit must be integers'}), 400
+    events = read_booking_events(after, limit)
+    return jsonify({'events': [booking_event_dict(e) for e in events],
+                    'next': events[-1].id if events else after,
+                    'dropped_events': booking_event_log.dropped_events})
+
+
+@app.cli.group()
+def events():
+    """Read, replay and backfill the booking event log."""
+
+
+@events.command('tail')
+@click.option('--after', default=0, show_default=True, help='Offset to start after.')
+@click.option('--limit', default=1000, show_default=True)
+@click.option('--follow', is_flag=True, help='Keep polling for new events.')
+def events_tail(after, limit, follow):
+    """Print events after an offset as JSON lines."""
+    while True:
+        batch = read_booking_events(after, limit)
+        for event in batch:
+            click.echo(json.dumps(booking_event_dict(event)))
+        after = batch[-1].id if batch else after
+        db.session.expunge_all()
+        if not follow:
+            return
+        if len(batch) < limit:
+            time.sleep(1)
+
+
+def _diff_aggregates(replayed, live, shown=5):
+    problems = []
+    for name in replayed:
+        if name == 'cancelled':
+            if replayed[name] != live[name]:
+                problems.append(f"cancelled: replay {replayed[name]}, live {live[name]}")
+            continue
+        keys = sorted(set(replayed[name]) | set(live[name]), key=str)
+        wrong = [k for k in keys if replayed[name].get(k) != live[name].get(k)]
+        for key in wrong[:shown]:
+            problems.append(f"{name}[{key}]: replay {replayed[name].get(key)}, live {live[name].get(key)}")
+        if len(wrong) > shown:
+            problems.append(f"{name}: {len(wrong) - shown} more difference(s)")
+    return problems
+
+
+@events.command('replay')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='Load the replay state from this file and save it back, to replay incrementally.')
+@click.option('--batch-size', default=5000, show_default=True)
+@click.option('--verify', is_flag=True, help='Compare the totals with the bookings table.')
+def events_replay(checkpoint, batch_size, verify):
+    """Rebuild seat availability and report totals from the event log."""
+    import pickle
+
+    replay = BookingEventReplay()
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint, 'rb') as f:
+            replay = pickle.load(f)
+        click.echo(f"Resuming after offset {replay.offset}")
+
+    started = time.perf_counter()
+    applied = replay.consume(batch_size, settle_seconds=0 if verify else None,
+                             progress=lambda r: click.echo(f"  offset {r.offset}"))
+    click.echo(f"Applied {applied} event(s) in {time.perf_counter() - started:.1f} s, now at offset {replay.offset}")
+
+    if checkpoint:
+        with open(checkpoint, 'wb') as f:
+            pickle.dump(replay, f)
+
+    totals = replay.aggregates()
+    click.echo(f"{len(replay.bookings)} booking(s), {sum(totals['seats'].values())} seat(s) held on "
+               f"{len(totals['seats'])} slot date(s), £{sum(totals['monthly_sales'].values()):.2f} paid, "
+               f"{totals['cancelled'][0]} cancelled (£{totals['cancelled'][1]:.2f})")
+    if verify:
+        problems = _diff_aggregates(totals, live_booking_aggregates())
+        for problem in problems:
+            click.echo(f"  ❌ {problem}")
+        if problems:
+            raise click.ClickException("Replayed totals don't match the bookings table.")
+        click.echo("✅ Replayed totals match the bookings table.")
+
+
+@events.command('backfill')
+@click.option('--batch-size', default=5000, show_default=True)
+def events_backfill(batch_size):
+    """Add a 'created' event for every booking that has no events yet (run once after upgrading)."""
+    top = db.session.scalar(db.select(func.max(Booking.id))) or 0
+    added = 0
+    for start in range(0, top, batch_size):
+        logged = db.select(BookingEvent.booking_id).where(BookingEvent.booking_id.between(start + 1, start + batch_size))
+        result = db.session.execute(booking_events_from_select(
+            'created', Booking.id.between(start + 1, start + batch_size) & Booking.id.not_in(logged)
+        ))
+        db.session.commit()
+        added += result.rowcount
+    click.echo(f"Added {added} event(s).")
+
+
+# 📡 Live seat availability
+# One publisher per process fans remaining-seat counts out to the
+# Server-Sent Events streams on the booking page. Writers call
+# ``seat_feed.publish`` after committing; the count for a (slot, date) is
+# read once and pushed to every listener, so idle streams cost no queries.
+# A background refresh picks up changes made by other processes.
+class SeatFeed:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # (slot_id, travel_date) -> set of queues
+        self._last_sent = {}
+        self._refresher = None
+
+    def subscribe(self, key):
+        listener = queue.Queue(maxsize=1)  # only the latest count matters
+        with self._lock:
+            self._subscribers.setdefault(key, set()).add(listener)
+        self._start_refresher()
+        return listener
+
+    def unsubscribe(self, key, listener):
+        with self._lock:
+            listeners = self._subscribers.get(key)
+            if listeners is None:
+                return
+            listeners.discard(listener)
+            if not listeners:
+                del self._subscribers[key]
+                self._last_sent.pop(key, None)
+
+    def listener_count(self):
+        with self._lock:
+            return sum(len(listeners) for listeners in self._subscribers.values())
+
+    def publish(self, slot_dates, only_changed=False):
+        """Push the current remaining seats for each watched (slot_id, travel_date)."""
+        if not self._subscribers:
+            return 0
+        with self._lock:
+            keys = [key for key in set(slot_dates) if key in self._subscribers]
+        if not keys:
+            return 0
+
+        held = booked_seats(keys)
+        sent = 0
+        with self._lock:
+            for key in keys:
+                remaining = max(SLOT_CAPACITY - held.get(key, 0), 0)
+                if only_changed and self._last_sent.get(key) == remaining:
+                    continue
+                self._last_sent[key] = remaining
+                for listener in self._subscribers.get(key, ()):
+                    try:
+                        listener.get_nowait()
+                    except queue.Empty:
+                        pass
+                    listener.put_nowait(remaining)
+                    sent += 1
+        return sent
+
+    def refresh(self):
+        with self._lock:
+            keys = list(self._subscribers)
+        return self.publish(keys, only_changed=True)
+
+    def _start_refresher(self):
+        interval = app.config.get('SEAT_FEED_REFRESH_SECONDS', 10)
+        if not interval:
+            return
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, args=(interval,),
+                                               name='seat-feed-refresh', daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    self.refresh()
+            except Exception:
+                traceback.print_exc()
+
+
+seat_feed = SeatFeed()
+
+
+def publish_seat_changes(bookings):
+    """Notify seat listeners about the (slot, date) of each booking."""
+    seat_feed.publish((b.slot_id, b.travel_date) for b in bookings)
+
+
+# 🧾 Booking details
+# Receipts, the admin booking search and receipt e-mails all show the same
+# booking + customer + route + slot + seat type view. It is loaded with one
+# joined query into an immutable record and kept in an LRU cache; writes
+# that change any part of it invalidate the affected entries, and a short
+# TTL bounds staleness from writes made by other processes.
+BookingDetail = namedtuple('BookingDetail', [
+    'id', 'user_id', 'user_name', 'user_email', 'journey_id', 'departure_city', 'arrival_city',
+    'slot_id', 'departure_time', 'arrival_time', 'seat_type_id', 'seat_type', 'travel_date',
+    'final_price', 'seats_booked', 'status', 'created_at', 'seat_numbers',
+])
+
+
+def booking_detail_from(booking, user, journey, seat, slot):
+    return BookingDetail(
+        booking.id, user.id, user.name, user.email, journey.id, journey.departure_city, journey.arrival_city,
+        slot.id, slot.departure_time, slot.arrival_time, seat.id, seat.type_name, booking.travel_date,
+        booking.final_price, booking.seats_booked, booking.status, booking.created_at, booking.seat_numbers,
+    )
+
+
+def load_booking_details(booking_ids):
+    rows = db.session.execute(BOOKING_DETAILS, {'booking_ids': list(booking_ids)})
+    return {row[0]: BookingDetail(*row) for row in rows}
+
+
+class BookingDetailCache:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # booking id -> (expires, BookingDetail)
+        self._generation = 0  # bumped by every invalidation, so in-flight loads can't store stale rows
+        self._lock = threading.Lock()
+
+    def get_many(self, booking_ids):
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for booking_id in set(booking_ids):
+                hit = self._entries.get(booking_id)
+                if hit and hit[0] > now:
+                    self._entries.move_to_end(booking_id)
+                    found[booking_id] = hit[1]
+                else:
+                    missing.append(booking_id)
+            generation = self._generation
+
+        if missing:
+            loaded = load_booking_details(missing)
+            found.update(loaded)
+            expires = now + app.config.get('BOOKING_DETAIL_TTL_SECONDS', 60)
+            with self._lock:
+                if generation == self._generation:
+                    for booking_id, detail in loaded.items():
+                        self._entries[booking_id] = (expires, detail)
+                        self._entries.move_to_end(booking_id)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+        return found
+
+    def invalidate(self, booking_ids):
+        with self._lock:
+            self._generation += 1
+            for booking_id in booking_ids:
+                self._entries.pop(booking_id, None)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._generation += 1
+            for booking_id in [b for b, (_, d) in self._entries.items() if d.user_id == user_id]:
+                del self._entries[booking_id]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+booking_details = BookingDetailCache(max_entries=app.config.get('BOOKING_DETAIL_CACHE_SIZE', 10000))
+cache_bus.subscribe('booking_details', booking_details.clear)  # profile edits in other workers
+
+
+def booking_detail(booking_id):
+    """The :class:`BookingDetail` for one booking, or ``None``."""
+    return booking_details.get_many([booking_id]).get(booking_id)
+
+
+# 🔁 Idempotency keys
+# Booking-creating endpoints accept an ``Idempotency-Key`` header (or an
+# ``idempotency_key`` field). The first request claims the key through the
+# unique constraint; replays get the stored response back and never reach
+# the view, and a duplicate arriving while the first is still running gets
+# a 409 instead of creating a second booking.
+_idempotency_last_purge = 0.0
+
+
+def _idempotency_request_hash(payload):
+    payload = {k: v for k, v in payload.items() if k != 'idempotency_key'}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def purge_expired_idempotency_keys(force=False):
+    """Drop keys older than ``IDEMPOTENCY_TTL_HOURS`` (at most once a minute per worker)."""
+    global _idempotency_last_purge
+    now = time.monotonic()
+    if not force and now - _idempotency_last_purge < 60:
+        return
+    _idempotency_last_purge = now
+
+    cutoff = datetime.utcnow() - timedelta(hours=app.config.get('IDEMPOTENCY_TTL_HOURS', 24))
+    db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.created_at < cutoff))
+    db.session.commit()
+
+
+def idempotent(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        payload = request.get_json(silent=True) or request.form.to_dict()
+        key = request.headers.get('Idempotency-Key') or payload.get('idempotency_key')
+        if not key or 'user_id' not in session:
+            return f(*args, **kwargs)
+        if len(key) > 100:
+            return jsonify({'success': False, 'message': 'Idempotency-Key too long'}), 400
+
+        purge_expired_idempotency_keys()
+
+        request_hash = _idempotency_request_hash(payload)
+        record = IdempotencyKey(
+            user_id=session['user_id'],
+            endpoint=request.endpoint,
+            key=key,
+            request_hash=request_hash
+        )
+        db.session.add(record)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            existing = IdempotencyKey.query.filter_by(
+                user_id=session['user_id'], endpoint=request.endpoint, key=key
+            ).first()
+
+            if existing is None:
+                return jsonify({'success': False, 'message': 'Request in progress, retry shortly'}), 409, \
+                    {'Retry-After': '1'}
+            if existing.request_hash != request_hash:
+                return jsonify({'success': False, 'message': 'Idempotency-Key reused for a different request'}), 422
+            if existing.status_code is None:
+                return jsonify({'success': False, 'message': 'Request in progress, retry shortly'}), 409, \
+                    {'Retry-After': '1'}
+
+            response = make_response(existing.response_body, existing.status_code)
+            response.mimetype = 'application/json'
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        record_id = record.id
+        g.idempotent_committed = False
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            if g.idempotent_committed:
+                db.session.execute(
+                    update(IdempotencyKey).where(IdempotencyKey.id == record_id)
+                    .values(status_code=500, response_body=json.dumps(
+                        {'success': False, 'message': 'Saved, but the response failed; check your bookings'}))
+                )
+            else:
+                db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.id == record_id))
+            db.session.commit()
+            raise
+
+        if response.status_code >= 500 and not g.idempotent_committed:
+            # Let the client retry failures instead of replaying them, unless something
+            # was committed: a retry would then do it twice
+            db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.id == record_id))
+        else:
+            db.session.execute(
+                update(IdempotencyKey)
+                .where(IdempotencyKey.id == record_id)
+                .values(status_code=response.status_code, response_body=response.get_data(as_text=True))
+            )
+        db.session.commit()
+        return response
+    return decorated_function
+
+
+def mark_committed():
+    """Tell :func:`idempotent` this request has committed its change."""
+    if has_app_context():
+        g.idempotent_committed = True
+
+
+# ✉️ Outgoing mail
+# Receipts and notifications are handed to a background sender so no
+# request (sync or async) waits on SMTP. The sender drains the queue in
+# batches of up to MAIL_BATCH_SIZE over one SMTP connection. Set
+# MAIL_QUEUE_ENABLED = False to send inline instead.
+def deliver_mail(batch):
+    """Send ``(message, sent_note, failed_note)`` items over one SMTP connection."""
+    try:
+        with SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT']) as smtp:
+            smtp.starttls()
+            smtp.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+            for msg, sent_note, failed_note in batch:
+                try:
+                    smtp.send_message(msg)
+                    print(sent_note)
+                except Exception as e:
+                    print(failed_note, e)
+    except Exception as e:
+        for _, _, failed_note in batch:
+            print(failed_note, e)
+
+
+class MailQueue:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def send(self, msg, sent_note="✅ Email sent.", failed_note="❌ Failed to send email:"):
+        if not app.config.get('MAIL_QUEUE_ENABLED', True):
+            deliver_mail([(msg, sent_note, failed_note)])
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='mail-sender', daemon=True)
+                self._thread.start()
+        self._queue.put((msg, sent_note, failed_note))
+
+    def _run(self):
+        batch_size = app.config.get('MAIL_BATCH_SIZE', 20)
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                deliver_mail(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def wait(self):
+        """Block until everything queued so far has been sent (or failed)."""
+        self._queue.join()
+
+
+mail_queue = MailQueue()
+
+
+def send_cancellation_email(user_email, user_name, booking_id, route, travel_date, charge_amount, reason=None):
+    reason_note = f"\n{reason}\n" if reason else ""
     msg = EmailMessage()
     msg['Subject'] = f"Booking #{booking_id} Cancelled – Horizon Travels"
     msg['From'] = formataddr(("Horizon Travels", app.config['MAIL_USERNAME']))
@@ -98,7 +1724,7 @@ def send_cancellation_email(user_email, user_name, booking_id, route, travel_dat
 Hi {user_name},
 
 Your booking (#{booking_id}) has been cancelled.
-
+{reason_note}
 🔹 Route: {route}
 🔹 Travel Date: {travel_date}
 🔹 Cancellation Fee: £{charge_amount:.2f}
@@ -109,14 +1735,7 @@ If you have any questions, please reach out to our support team.
 — Horizon Travels Team
 """)
 
-    try:
-        with SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT']) as smtp:
-            smtp.starttls()
-            smtp.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-            smtp.send_message(msg)
-        print("✅ Cancellation email sent.")
-    except Exception as e:
-        print("❌ Failed to send cancellation email:", e)
+    mail_queue.send(msg, "✅ Cancellation email sent.", "❌ Failed to send cancellation email:")
 
 def send_verification_code(email, name, code):
     msg = EmailMessage()
@@ -134,10 +1753,7 @@ This code is valid for 10 minutes.
 – Horizon Travels Security Team
 """)
 
-    with SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT']) as smtp:
-        smtp.starttls()
-        smtp.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-        smtp.send_message(msg)
+    mail_queue.send(msg, "✅ Verification code sent.", "❌ Failed to send verification code:")
 
 
 def send_thank_you_email(email, name):
@@ -158,16 +1774,281 @@ Safe travels!
 - The Horizon Travels Team
 """)
 
+    mail_queue.send(msg, "✅ Thank-you email sent successfully.", "❌ Failed to send email:")
+
+
+# 🚦 Rate limiting
+# Token buckets per user and per client IP, configured per endpoint in
+# RATE_LIMITS. Bucket state lives in a small SQLite file so every worker
+# process on the host draws from the same buckets.
+class TokenBucketStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=2, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS hits (endpoint TEXT, outcome TEXT, hits INTEGER, "
+                "PRIMARY KEY (endpoint, outcome))"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, endpoint, buckets):
+        """Take one token from every ``(key, burst, per_second)`` bucket, or none of them.
+
+        Returns ``(0, None)`` when allowed, otherwise the seconds until a
+        token frees up and the key of the bucket that ran dry.
+        """
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            refreshed = []
+            wait, limited_by = 0, None
+            for key, burst, per_second in buckets:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * per_second)
+                if tokens < 1 and (1 - tokens) / per_second > wait:
+                    wait, limited_by = (1 - tokens) / per_second, key
+                refreshed.append((key, tokens))
+
+            if not wait:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                    [(key, tokens - 1, now) for key, tokens in refreshed]
+                )
+            outcome = 'allowed' if not wait else 'limited_' + limited_by.split(':', 1)[0]
+            conn.execute(
+                "INSERT INTO hits (endpoint, outcome, hits) VALUES (?, ?, 1) "
+                "ON CONFLICT (endpoint, outcome) DO UPDATE SET hits = hits + 1",
+                (endpoint, outcome)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait, limited_by
+
+    def counters(self):
+        return self._connect().execute(
+            "SELECT endpoint, outcome, hits FROM hits ORDER BY endpoint, outcome"
+        ).fetchall()
+
+    def purge(self, older_than=24 * 3600):
+        self._connect().execute("DELETE FROM buckets WHERE updated < ?", (time.time() - older_than,))
+
+
+rate_limit_store = TokenBucketStore(
+    app.config.get('RATE_LIMIT_STORE') or os.path.join(app.instance_path, 'ratelimit.sqlite')
+)
+
+
+def rate_limit_wait(endpoint, method, user_id, remote_addr):
+    """Seconds the caller must wait before ``endpoint`` may be hit again, or None."""
+    rule = app.config.get('RATE_LIMITS', {}).get(endpoint)
+    if not rule or not app.config.get('RATE_LIMIT_ENABLED', True):
+        return None
+    if 'methods' in rule and method not in rule['methods']:
+        return None
+
+    buckets = []
+    if 'per_user' in rule and user_id is not None:
+        burst, per_minute = rule['per_user']
+        buckets.append((f"user:{user_id}:{endpoint}", burst, per_minute / 60))
+    if 'per_ip' in rule:
+        burst, per_minute = rule['per_ip']
+        buckets.append((f"ip:{remote_addr}:{endpoint}", burst, per_minute / 60))
+    if not buckets:
+        return None
+
     try:
-        with SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT']) as smtp:
-            smtp.starttls()
-            smtp.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-            smtp.send_message(msg)
-        print("✅ Thank-you email sent successfully.")
-    except Exception as e:
-        print("❌ Failed to send email:", e)
+        wait, _ = rate_limit_store.take(endpoint, buckets)
+        if randint(1, 1000) == 1:
+            rate_limit_store.purge()
+    except sqlite3.Error as e:
+        # Never take the site down because the limiter store is busy
+        print("❌ Rate limiter unavailable:", e)
+        return None
+    return wait or None
+
+
+@app.before_request
+def apply_rate_limits():
+    wait = rate_limit_wait(request.endpoint, request.method, session.get('user_id'), request.remote_addr)
+    if not wait:
+        return None
+
+    headers = {'Retry-After': str(math.ceil(wait))}
+    if request.is_json:
+        return jsonify({'success': False, 'message': 'Too many requests, please slow down.'}), 429, headers
+    return "Too many requests, please slow down.", 429, headers
 
 
+@app.route('/admin/metrics/rate-limits')
+@admin_required
+def rate_limit_metrics():
+    rows = rate_limit_store.counters()
+    if request.args.get('format') == 'prometheus':
+        lines = [
+            "# HELP ht_rate_limit_requests_total Requests seen by the rate limiter.",
+            "# TYPE ht_rate_limit_requests_total counter",
+        ]
+        lines += [
+            f'ht_rate_limit_requests_total{{endpoint="{endpoint}",outcome="{outcome}"}} {hits}'
+            for endpoint, outcome, hits in rows
+        ]
+        return "\n".join(lines) + "\n", 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    counters = {}
+    for endpoint, outcome, hits in rows:
+        counters.setdefault(endpoint, {})[outcome] = hits
+    return jsonify(counters)
+
+
+# 📦 Fingerprinted static assets
+# ``flask build-assets`` copies everything under static/ to static/dist/ with
+# a content hash in the name, plus .gz (and .br, if the brotli package is
+# installed) siblings for text files. url_for('static', ...) then points at
+# the hashed copies, which are served with far-future immutable caching and
+# the best precompressed variant the client accepts.
+ASSET_DIST_DIR = 'dist'
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html', '.map')
+
+try:
+    import brotli
+except ImportError:  # optional, .br files are skipped without it
+    brotli = None
+
+
+def _asset_manifest_path():
+    return os.path.join(app.static_folder, ASSET_DIST_DIR, 'manifest.json')
+
+
+def load_asset_manifest():
+    try:
+        with open(_asset_manifest_path(), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+asset_manifest = load_asset_manifest()
+
+
+def build_assets():
+    """Fingerprint and precompress static files; returns the new manifest."""
+    dist = os.path.join(app.static_folder, ASSET_DIST_DIR)
+    os.makedirs(dist, exist_ok=True)
+    manifest = {}
+
+    for root, dirs, files in os.walk(app.static_folder):
+        if os.path.abspath(root) == os.path.abspath(app.static_folder):
+            dirs[:] = [d for d in dirs if d != ASSET_DIST_DIR]
+        for name in files:
+            source = os.path.join(root, name)
+            rel = os.path.relpath(source, app.static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            stem, ext = os.path.splitext(rel)
+            hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+            target = os.path.join(dist, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+
+            if ext.lower() in COMPRESSIBLE_EXTENSIONS:
+                with open(target + '.gz', 'wb') as f:
+                    f.write(gzip.compress(data, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    with open(target + '.br', 'wb') as f:
+                        f.write(brotli.compress(data, quality=11))
+
+            manifest[rel] = f"{ASSET_DIST_DIR}/{hashed}"
+
+    with open(_asset_manifest_path(), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress everything under static/."""
+    global asset_manifest
+    asset_manifest = build_assets()
+    for source, hashed in sorted(asset_manifest.items()):
+        click.echo(f"{source} -> {hashed}")
+    if brotli is None:
+        click.echo("brotli not installed, only gzip variants were written.")
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and values.get('filename') in asset_manifest:
+        values['filename'] = asset_manifest[values['filename']]
+
+
+def serve_static(filename):
+    if not filename.startswith(ASSET_DIST_DIR + '/') or filename.endswith(('.gz', '.br')):
+        return app.send_static_file(filename)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = None
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[encoding] and \
+                os.path.isfile(os.path.join(app.static_folder, filename + suffix)):
+            response = send_from_directory(app.static_folder, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = app.send_static_file(filename)
+
+    # The name changes whenever the content does, so it can be cached forever
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response
+
+
+app.view_functions['static'] = serve_static
+
+
+@app.after_request
+def compress_response(response):
+    """Optionally gzip dynamic HTML/JSON responses (COMPRESS_RESPONSES)."""
+    if not app.config.get('COMPRESS_RESPONSES', False):
+        return response
+    if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in ('text/html', 'application/json') or response.status_code < 200 \
+            or response.status_code >= 300:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+
+    data = response.get_data()
+    if len(data) < app.config.get('COMPRESS_MIN_SIZE', 500):
+        return response
+
+    response.set_data(gzip.compress(data, compresslevel=app.config.get('COMPRESS_LEVEL', 6)))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 
 @app.route('/')
 def index():
@@ -229,7 +2110,7 @@ def login():
         password = request.form['password']
         user = User.query.filter_by(email=email).first()
 
-        if user and check_password_hash(user.password, password):
+        if user and user.role != 'deleted' and check_password_hash(user.password, password):
             session['user_id'] = user.id
             session['user_name'] = user.name
             session['role'] = user.role
@@ -258,10 +2139,6 @@ def booking():
     if 'user_id' not in session:
         return redirect('/login')
 
-    journeys = Journey.query.all()
-    seats = SeatType.query.all()
-    slots = JourneySlot.query.all()  # ✅ Get all journey slots
-
     if request.method == 'POST':
         journey_id = int(request.form['journey_id'])
         seat_type_id = int(request.form['seat_type_id'])
@@ -276,10 +2153,8 @@ def booking():
         if not slot:
             return "Invalid slot selection."
 
-        # Check availability
-        total_booked = db.session.query(
-            db.func.sum(Booking.seats_booked)
-        ).filter_by(slot_id=slot_id).scalar() or 0
+        # Check availability for this slot on the chosen date
+        total_booked = db.session.scalar(SEATS_HELD, {'slot_id': slot_id, 'travel_date': travel_date})
 
         days_diff = (travel_date - date.today()).days
         if days_diff > 120:
@@ -313,7 +2188,7 @@ def booking():
                 </body>
                 """
 
-        available = 140- total_booked
+        available = SLOT_CAPACITY - total_booked
         if seats_booked > available:
             return f"""
             <body style='background-color: #FCDC73;'>
@@ -372,10 +2247,12 @@ def booking():
             journey_id=journey_id,
             seat_type_id=seat.id,
             slot_id=slot_id,
-            seats_booked=seats_booked
+            seats_booked=seats_booked,
+            idempotency_key=uuid.uuid4().hex
         )
 
-    return render_template('booking.html', journeys=journeys, seats=seats, slots=slots)
+    # Journeys load lazily inside the template's cached route list
+    return render_template('booking.html', journeys=lambda: Journey.query.all(), seats=SeatType.query.all())
 
 @app.route('/profile', methods=['GET', 'POST'])
 def profile():
@@ -421,6 +2298,8 @@ def profile():
                 user.name = new_name
                 user.email = new_email
                 session['user_name'] = new_name
+                booking_details.invalidate_user(user.id)
+                cache_bus.bump('booking_details')
 
             elif change_type == 'password':
                 current = changes.get('current_password')
@@ -448,6 +2327,31 @@ def profile():
 
 
 
+def send_combined_email(user_email, pdf_data, booking_ids):
+    refs = ", ".join(f"#{booking_id}" for booking_id in booking_ids)
+
+    msg = EmailMessage()
+    msg['Subject'] = f"Your Horizon Travels Receipt ({len(booking_ids)} bookings)"
+    msg['From'] = formataddr(("Horizon Travels", app.config['MAIL_USERNAME']))
+    msg['To'] = user_email
+
+    msg.set_content(f"""\
+Hi there,
+
+Thank you for your booking with Horizon Travels! 🎉
+Please find the receipts for your bookings ({refs}) attached as one PDF.
+
+We look forward to having you onboard!
+
+– Horizon Travels Team
+""")
+
+    msg.add_attachment(pdf_data, maintype='application', subtype='pdf', filename='receipt_combined.pdf')
+
+    mail_queue.send(msg, "✅ Combined PDF receipt email sent successfully.",
+                    "❌ Failed to send combined PDF receipt:")
+
+
 def send_email(user_email, pdf_data, booking_id):
     msg = EmailMessage()
     msg['Subject'] = f"Your Horizon Travels Receipt #{booking_id}"
@@ -468,22 +2372,33 @@ We look forward to having you onboard!
     # Attach PDF
     msg.add_attachment(pdf_data, maintype='application', subtype='pdf', filename=f'receipt_{booking_id}.pdf')
 
-    try:
-        with SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT']) as smtp:
-            smtp.starttls()
-            smtp.login(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-            smtp.send_message(msg)
-        print("✅ PDF receipt email sent successfully.")
-    except Exception as e:
-        print("❌ Failed to send PDF receipt:", e)
+    mail_queue.send(msg, "✅ PDF receipt email sent successfully.", "❌ Failed to send PDF receipt:")
 
 
-def generate_pdf_receipt(buffer, booking, user, journey, seat, slot):
+def generate_pdf_receipt(buffer, detail):
     from reportlab.pdfgen import canvas
-    from datetime import datetime
 
     pdf = canvas.Canvas(buffer, pagesize=(600, 800))
-    pdf.setTitle(f"Horizon Receipt #{booking.id}")
+    pdf.setTitle(f"Horizon Receipt #{detail.id}")
+    draw_receipt_page(pdf, detail)
+    pdf.save()
+    buffer.seek(0)
+
+
+def generate_combined_pdf_receipt(buffer, details):
+    """One PDF with a receipt page per :class:`BookingDetail` in ``details``."""
+    from reportlab.pdfgen import canvas
+
+    pdf = canvas.Canvas(buffer, pagesize=(600, 800))
+    pdf.setTitle("Horizon Receipt " + ", ".join(f"#{detail.id}" for detail in details))
+    for detail in details:
+        draw_receipt_page(pdf, detail)
+    pdf.save()
+    buffer.seek(0)
+
+
+def draw_receipt_page(pdf, detail):
+    from datetime import datetime
 
     # === 🖼 Logo + Heading ===
     logo_path = "static/images/horizon_logo.png"
@@ -501,17 +2416,19 @@ def generate_pdf_receipt(buffer, booking, user, journey, seat, slot):
     pdf.line(40, 685, 560, 685)
 
     data_table = [
-        ["Booking ID", f"{booking.id}"],
-        ["Passenger Name", user.name],
-        ["Email", user.email],
-        ["Travel Date", str(booking.travel_date)],
-        ["From", journey.departure_city],
-        ["To", journey.arrival_city],
-        ["Departure Time", slot.departure_time.strftime('%H:%M')],
-        ["Arrival Time", slot.arrival_time.strftime('%H:%M')],
-        ["Seat Type", seat.type_name],
-        ["Total Paid", f"£{booking.final_price:.2f}"]
+        ["Booking ID", f"{detail.id}"],
+        ["Passenger Name", detail.user_name],
+        ["Email", detail.user_email],
+        ["Travel Date", str(detail.travel_date)],
+        ["From", detail.departure_city],
+        ["To", detail.arrival_city],
+        ["Departure Time", detail.departure_time.strftime('%H:%M')],
+        ["Arrival Time", detail.arrival_time.strftime('%H:%M')],
+        ["Seat Type", detail.seat_type],
+        ["Total Paid", f"£{detail.final_price:.2f}"]
     ]
+    if detail.seat_numbers:
+        data_table.insert(-1, ["Seats", detail.seat_numbers.replace(',', ', ')])
 
     y_start = 660
     row_height = 22
@@ -532,11 +2449,52 @@ def generate_pdf_receipt(buffer, booking, user, journey, seat, slot):
     pdf.drawString(40, 65, "Questions? Contact us at support@horizontravels.com")
 
     pdf.showPage()
-    pdf.save()
-    buffer.seek(0)
+
+
+def booking_from_json(user_id, data, status):
+    """A new :class:`Booking` from the booking form's JSON (raises on bad values)."""
+    return Booking(
+        user_id=user_id,
+        journey_id=int(data['journey_id']),
+        seat_type_id=int(data['seat_type_id']),
+        travel_date=datetime.strptime(data['travel_date'], '%Y-%m-%d').date(),
+        final_price=float(data['final_price']),
+        slot_id=int(data['slot_id']),
+        seats_booked=int(data['seats_booked']),
+        status=status
+    )
+
+
+def add_booking(session, booking, wanted=None):
+    """Add a new booking to ``session``, seating it if it is paid. Returns an error message or None."""
+    session.add(booking)
+    if booking.status in SEAT_HOLDING_STATUSES:
+        return assign_booking_seats(session, booking, wanted)
+    return None
+
+
+def booking_saved(booking):
+    """Follow-up for a newly saved booking: event log, live seats, leaderboards and, once paid,
+    the receipt. The booking is committed by now, so failures are logged, not raised."""
+    try:
+        booking_event_log.append([booking_event('created', booking)])
+        publish_seat_changes([booking])
+        if booking.status != 'paid':
+            return
+
+        record_paid_booking(booking)
+        # ✅ PAID: Generate receipt and email
+        detail = booking_detail(booking.id)
+        buffer = BytesIO()
+        generate_pdf_receipt(buffer, detail)
+        send_email(detail.user_email, buffer.read(), detail.id)
+    except Exception:
+        print(f"❌ Follow-up for booking {booking.id} failed:")
+        traceback.print_exc()
 
 
 @app.route('/confirm-booking', methods=['POST'])
+@idempotent
 def confirm_booking():
     if 'user_id' not in session:
         return jsonify({'success': False, 'message': 'Unauthorized'}), 401
@@ -554,84 +2512,28 @@ def confirm_booking():
         if not slot_id_raw or not seats_raw:
             return jsonify({'success': False, 'message': 'Missing slot or seat count'}), 400
 
-        booking = Booking(
-            user_id=session['user_id'],
-            journey_id=int(data['journey_id']),
-            seat_type_id=int(data['seat_type_id']),
-            travel_date=datetime.strptime(data['travel_date'], '%Y-%m-%d').date(),
-            final_price=float(data['final_price']),
-            slot_id=int(slot_id_raw),
-            seats_booked=int(seats_raw),
-            status='unpaid' if is_pay_later else 'paid'
-        )
-        db.session.add(booking)
-        db.session.commit()
-
-        if is_pay_later:
-            return jsonify({'success': True, 'redirect_url': '/cart'})  # ✅ Go to cart instead of receipt
-
-        # ✅ PAID: Generate receipt and email
-        journey_id = int(data['journey_id'])
-        seat_type_id = int(data['seat_type_id'])
-        slot_id = int(slot_id_raw)
-        user = User.query.get(session['user_id'])
-        journey = db.session.get(Journey, journey_id)
-        seat = db.session.get(SeatType, seat_type_id)
-        slot = db.session.get(JourneySlot, slot_id)
-
-        buffer = BytesIO()
-        pdf = canvas.Canvas(buffer, pagesize=(600, 800))
-        pdf.setTitle(f"Horizon Receipt #{booking.id}")
-
-        logo_path = "static/images/horizon_logo.png"
-        pdf.drawImage(logo_path, 40, 730, width=70, height=40, preserveAspectRatio=True)
-        pdf.setFont("Helvetica-Bold", 16)
-        pdf.drawString(120, 745, "Horizon Travels")
-        pdf.setFont("Helvetica", 10)
-        pdf.drawString(120, 730, "Booking Receipt")
-        pdf.drawRightString(570, 745, f"Date: {datetime.today().strftime('%Y-%m-%d')}")
-
-        pdf.setFont("Helvetica-Bold", 12)
-        pdf.drawString(40, 690, "Receipt Summary")
-        pdf.setLineWidth(0.5)
-        pdf.line(40, 685, 560, 685)
-
-        data_table = [
-            ["Booking ID", f"{booking.id}"],
-            ["Passenger Name", user.name],
-            ["Email", user.email],
-            ["Travel Date", str(booking.travel_date)],
-            ["From", journey.departure_city],
-            ["To", journey.arrival_city],
-            ["Departure Time", slot.departure_time.strftime('%H:%M')],
-            ["Arrival Time", slot.arrival_time.strftime('%H:%M')],
-            ["Seat Type", seat.type_name],
-            ["Total Paid", f"£{booking.final_price:.2f}"]
-        ]
-
-        y_start = 660
-        row_height = 22
-        pdf.setFont("Helvetica", 10)
-
-        for label, value in data_table:
-            pdf.setFillColorRGB(0.95, 0.95, 0.95)
-            pdf.rect(40, y_start - row_height + 4, 240, row_height, fill=True, stroke=False)
-            pdf.setFillColorRGB(1, 1, 1)
-            pdf.rect(280, y_start - row_height + 4, 280, row_height, fill=False, stroke=False)
-            pdf.setFillColorRGB(0, 0, 0)
-            pdf.drawString(50, y_start, label)
-            pdf.drawString(290, y_start, str(value))
-            y_start -= row_height
+        wanted = parse_seat_numbers(data.get('seat_numbers'))
 
-        pdf.setFont("Helvetica-Oblique", 9)
-        pdf.drawString(40, 80, "Thank you for booking with Horizon Travels! ✈️")
-        pdf.drawString(40, 65, "Questions? Contact us at support@horizontravels.com")
+        def attempt():
+            booking = booking_from_json(session['user_id'], data, 'unpaid' if is_pay_later else 'paid')
+            error = add_booking(db.session, booking, wanted)
+            if error:
+                db.session.rollback()
+                return error, None
+            db.session.commit()
+            mark_committed()
+            return None, booking
 
-        pdf.showPage()
-        pdf.save()
-        buffer.seek(0)
+        try:
+            error, booking = retry_on_conflict(attempt)
+        except StaleDataError:
+            return jsonify({'success': False, 'message': 'Seats are changing fast, please try again.'}), 409
+        if error:
+            return jsonify({'success': False, 'message': error}), 409
+        booking_saved(booking)
 
-        send_email(user.email, buffer.read(), booking.id)
+        if is_pay_later:
+            return jsonify({'success': True, 'redirect_url': '/cart'})  # ✅ Go to cart instead of receipt
 
         return jsonify({
             'success': True,
@@ -651,20 +2553,8 @@ def receipt(booking_id):
     if 'user_id' not in session:
         return redirect('/login')
 
-    booking = db.session.query(
-        Booking,
-        Journey,
-        SeatType,
-        User,
-        JourneySlot
-    ).join(Journey, Booking.journey_id == Journey.id)\
-    .join(SeatType, Booking.seat_type_id == SeatType.id)\
-    .join(User, Booking.user_id == User.id)\
-    .join(JourneySlot, Booking.slot_id == JourneySlot.id)\
-    .filter(Booking.id == booking_id, Booking.user_id == session['user_id'])\
-    .first()
-
-    if not booking:
+    booking = booking_detail(booking_id)
+    if not booking or booking.user_id != session['user_id']:
         return "Booking not found or unauthorized.", 404
 
     return render_template('receipt.html', booking=booking)
@@ -674,20 +2564,8 @@ def download_receipt(booking_id):
     if 'user_id' not in session:
         return redirect('/login')
 
-    booking = db.session.query(
-        Booking,
-        Journey,
-        SeatType,
-        User,
-        JourneySlot
-    ).join(Journey, Booking.journey_id == Journey.id) \
-     .join(SeatType, Booking.seat_type_id == SeatType.id) \
-     .join(User, Booking.user_id == User.id) \
-     .join(JourneySlot, Booking.slot_id == JourneySlot.id) \
-     .filter(Booking.id == booking_id, Booking.user_id == session['user_id']) \
-     .first()
-
-    if not booking:
+    booking = booking_detail(booking_id)
+    if not booking or booking.user_id != session['user_id']:
         return "Unauthorized", 403
 
     buffer = BytesIO()
@@ -715,16 +2593,16 @@ def download_receipt(booking_id):
         pdf.drawString(200, y, str(value))
         y -= spacing
 
-    row("Booking ID", booking.Booking.id)
-    row("Name", booking.User.name)
-    row("Email", booking.User.email)
-    row("Route", f"{booking.Journey.departure_city} → {booking.Journey.arrival_city}")
-    row("Departure Time", booking.JourneySlot.departure_time.strftime("%H:%M"))
-    row("Arrival Time", booking.JourneySlot.arrival_time.strftime("%H:%M"))
-    row("Travel Date", booking.Booking.travel_date.strftime('%Y-%m-%d'))
-    row("Seat Type", booking.SeatType.type_name)
-    row("Status", booking.Booking.status)
-    row("Total Price", f"£{booking.Booking.final_price:.2f}")
+    row("Booking ID", booking.id)
+    row("Name", booking.user_name)
+    row("Email", booking.user_email)
+    row("Route", f"{booking.departure_city} → {booking.arrival_city}")
+    row("Departure Time", booking.departure_time.strftime("%H:%M"))
+    row("Arrival Time", booking.arrival_time.strftime("%H:%M"))
+    row("Travel Date", booking.travel_date.strftime('%Y-%m-%d'))
+    row("Seat Type", booking.seat_type)
+    row("Status", booking.status)
+    row("Total Price", f"£{booking.final_price:.2f}")
 
     pdf.setFont("Helvetica-Oblique", 10)
     pdf.drawString(50, y - 20, "Thank you for booking with Horizon Travels! ✈️")
@@ -735,7 +2613,7 @@ def download_receipt(booking_id):
 
     return make_response(buffer.read(), {
         'Content-Type': 'application/pdf',
-        'Content-Disposition': f'attachment; filename=receipt_{booking.Booking.id}.pdf'
+        'Content-Disposition': f'attachment; filename=receipt_{booking.id}.pdf'
     })
 
 
@@ -747,22 +2625,7 @@ def my_bookings():
 
     user_id = session['user_id']
 
-    raw_bookings = db.session.query(
-        Booking.id,
-        Booking.travel_date,
-        Booking.final_price,
-        Booking.status,
-        Journey.departure_city,
-        Journey.arrival_city,
-        JourneySlot.departure_time.label('slot_departure'),
-        JourneySlot.arrival_time.label('slot_arrival'),
-        SeatType.type_name.label('seat_type')
-    ).join(Journey, Booking.journey_id == Journey.id) \
-     .join(JourneySlot, Booking.slot_id == JourneySlot.id) \
-     .join(SeatType, Booking.seat_type_id == SeatType.id) \
-     .filter(Booking.user_id == user_id) \
-     .order_by(Booking.created_at.desc()) \
-     .all()
+    raw_bookings = db.session.execute(MY_BOOKINGS, {'user_id': user_id}).all()
 
     bookings = []
     for index, row in enumerate(raw_bookings, start=1):
@@ -787,27 +2650,47 @@ def cancel_booking(booking_id):
     if 'user_id' not in session:
         return redirect('/login')
 
-    booking = Booking.query.get_or_404(booking_id)
-
-    if booking.user_id != session['user_id']:
-        return "Unauthorized", 403
-
-    days_left = (booking.travel_date - date.today()).days
-    original_price = booking.final_price
+    def attempt():
+        booking = _fresh_booking(booking_id)
+        if booking is None:  # deleted since (e.g. by a maintenance job)
+            return ("Booking not found", 404), None
+        if booking.user_id != session['user_id']:
+            return ("Unauthorized", 403), None
+        if booking.status == 'cancelled':
+            return ("Booking already cancelled", 409), None
+
+        days_left = (booking.travel_date - date.today()).days
+        original_price = booking.final_price
+
+        cancellation_rule = (
+            Cancellation.query
+            .filter(Cancellation.days_before <= days_left)
+            .order_by(Cancellation.days_before.desc())
+            .first()
+        )
 
-    cancellation_rule = (
-        Cancellation.query
-        .filter(Cancellation.days_before <= days_left)
-        .order_by(Cancellation.days_before.desc())
-        .first()
-    )
+        charge_percent = cancellation_rule.charge_percent if cancellation_rule else 100
+        charge = round((charge_percent / 100) * original_price, 2)
 
-    charge_percent = cancellation_rule.charge_percent if cancellation_rule else 100
-    charge = round((charge_percent / 100) * original_price, 2)
+        # Update booking status, unless it changed since we priced the cancellation
+        was_paid = booking.status == 'paid'
+        release_seats(db.session, booking.slot_id, booking.travel_date, booking.seat_type_id, booking.seat_numbers)
+        if not _compare_and_swap(booking, {'status': 'cancelled'}, Booking.status != 'cancelled'):
+            return ("Booking already cancelled", 409), None
+        return None, (booking, charge, was_paid)
 
-    # Update booking status
-    booking.status = 'cancelled'
-    db.session.commit()
+    try:
+        error, cancelled = retry_on_conflict(attempt)
+    except StaleDataError:
+        return "This booking is being changed elsewhere, please try again.", 409
+    if error:
+        return error
+    booking, charge, was_paid = cancelled
+    booking_event_log.append([booking_event('cancelled', booking, amount=charge, status='cancelled')])
+    booking_details.invalidate([booking_id])
+    publish_seat_changes([booking])
+    if was_paid:
+        record_paid_booking(booking, sign=-1)
 
     # Send cancellation email
     user = db.session.get(User, booking.user_id)
@@ -837,7 +2720,7 @@ def update_booking(booking_id):
     if 'user_id' not in session:
         return redirect('/login')
 
-    booking = Booking.query.get_or_404(booking_id)
+    booking = db.get_or_404(Booking, booking_id)
 
     # Only allow update by owner and only if not cancelled
     if booking.user_id != session['user_id'] or booking.status != 'paid':
@@ -849,38 +2732,25 @@ def update_booking(booking_id):
         new_date = datetime.strptime(request.form['travel_date'], '%Y-%m-%d').date()
         new_seat_id = int(request.form['seat_type_id'])
 
-        # Get related objects
-        journey = db.session.get(Journey, booking.journey_id)
-        new_seat = db.session.get(SeatType, new_seat_id)
-
-
-        # Calculate new price with discount logic
-        days_diff = (new_date - date.today()).days
-        discount = 0
-        if 91 <= days_diff <= 120:
-            discount = 0.30
-        elif 80 <= days_diff <= 90:
-            discount = 0.20
-        elif 60 <= days_diff <= 79:
-            discount = 0.10
-        elif 45 <= days_diff <= 59:
-            discount = 0.05
+        try:
+            error, change = change_booking(booking_id, session['user_id'], new_date, new_seat_id)
+        except StaleDataError:
+            return "This booking is being changed elsewhere, please try again.", 409
+        if error:
+            return error, 409
 
-        base_price = journey.base_fare * new_seat.multiplier
-        final_price = round(base_price * (1 - discount), 2)
-
-        # Update the booking
-        booking.travel_date = new_date
-        booking.seat_type_id = new_seat_id
-        booking.final_price = final_price
-        db.session.commit()
+        booking_event_log.append([booking_event('updated', db.session.get(Booking, booking_id),
+                                                amount=change.price_change)])
+        booking_details.invalidate([booking_id])
+        leaderboard.record(change.user_id, change.journey_id, change.created_at, change.price_change, 0)
+        seat_feed.publish([(change.slot_id, change.old_date), (change.slot_id, change.new_date)])
 
         return render_template(
             'update_confirmation.html',
-            booking_id=booking.id,
+            booking_id=change.booking_id,
             travel_date=new_date.strftime('%Y-%m-%d'),
-            seat_type=new_seat.type_name,
-            final_price=final_price
+            seat_type=change.seat_type,
+            final_price=change.final_price
         )
 
 
@@ -929,44 +2799,38 @@ def manage_journeys():
         arr = request.form['arrival']
         fare = float(request.form['base_fare'])
 
-        existing = Journey.query.filter(
-            func.lower(Journey.departure_city) == dep.lower(),
-            func.lower(Journey.arrival_city) == arr.lower()
-        ).first()
+        existing = find_journey(dep, arr)
 
         if existing:
             error = "Journey already exists."
-            
-            journeys = Journey.query.all()
-            journey_data = []
-            for j in journeys:
-                first_slot = JourneySlot.query.filter_by(journey_id=j.id).first()
-                time_range = f"{first_slot.departure_time.strftime('%H:%M')} → {first_slot.arrival_time.strftime('%H:%M')}" if first_slot else "No slots added"
-                journey_data.append({
-                    'id': j.id,
-                    'from': j.departure_city,
-                    'to': j.arrival_city,
-                    'fare': j.base_fare,
-                    'time': time_range
-                })
-
-            return render_template('admin_journeys.html', journeys=journey_data, error=error)
-
-        new_journey = Journey(
-            departure_city=dep,
-            arrival_city=arr,
-            base_fare=fare
-        )
+            return render_template('admin_journeys.html', journeys=admin_journey_rows, error=error)
+
+        new_journey = Journey(base_fare=fare)
+        set_journey_cities(new_journey, dep, arr)
         db.session.add(new_journey)
         db.session.commit()
+        network_changed([new_journey.id])
         return redirect('/admin/journeys')
 
-    # ✅ Load all journeys along with at least one slot to show times
-    journeys = Journey.query.all()
-    journey_data = []
+    # Rows load lazily inside the template's cached fragment
+    return render_template('admin_journeys.html', journeys=admin_journey_rows)
+
 
-    for j in journeys:
-        first_slot = JourneySlot.query.filter_by(journey_id=j.id).first()
+def admin_journey_rows():
+    """Journeys with the times of their first slot, in one query."""
+    first_slot = db.select(
+        JourneySlot.journey_id, func.min(JourneySlot.id).label('slot_id')
+    ).group_by(JourneySlot.journey_id).subquery()
+
+    rows = db.session.execute(
+        db.select(Journey, JourneySlot)
+        .outerjoin(first_slot, first_slot.c.journey_id == Journey.id)
+        .outerjoin(JourneySlot, JourneySlot.id == first_slot.c.slot_id)
+        .order_by(Journey.id)
+    )
+
+    journey_data = []
+    for j, first_slot in rows:
         if first_slot:
             time_range = f"{first_slot.departure_time.strftime('%H:%M')} → {first_slot.arrival_time.strftime('%H:%M')}"
         else:
@@ -979,8 +2843,7 @@ def manage_journeys():
             'fare': j.base_fare,
             'time': time_range
         })
-
-    return render_template('admin_journeys.html', journeys=journey_data)
+    return journey_data
 
 
 @app.route('/make-admin')
@@ -999,9 +2862,8 @@ def clear_cancelled():
 
     user_id = session['user_id']
 
-    # Delete all cancelled bookings for this user
-    Booking.query.filter_by(user_id=user_id, status='cancelled').delete()
-    db.session.commit()
+    # Deleted in small chunks by the maintenance worker
+    enqueue_maintenance_job('clear_cancelled', user_id=user_id)
 
     return redirect('/my-bookings')
 
@@ -1028,6 +2890,7 @@ def delete_journey(journey_id):
         return "Journey not found", 404
     db.session.delete(journey)
     db.session.commit()
+    network_changed([journey_id])
     return redirect('/admin/journeys')
 
 @app.route('/admin/journeys/edit/<int:journey_id>', methods=['GET', 'POST'])
@@ -1056,14 +2919,20 @@ def edit_journey(journey_id):
             )
             db.session.add(new_slot)
             db.session.commit()
+            network_changed([journey.id])
             return redirect(url_for('edit_journey', journey_id=journey.id))
 
         else:
             # ✏️ Update journey details
-            journey.departure_city = request.form['departure']
-            journey.arrival_city = request.form['arrival']
+            dep, arr = request.form['departure'], request.form['arrival']
+            existing = find_journey(dep, arr)
+            if existing and existing.id != journey.id:
+                return render_template('edit_journey.html', journey=journey, slots=slots,
+                                       error=f"Journey #{existing.id} already runs this route.")
+            set_journey_cities(journey, dep, arr)
             journey.base_fare = float(request.form['base_fare'])
             db.session.commit()
+            network_changed([journey.id])
             return redirect('/admin/journeys')
 
     return render_template('edit_journey.html', journey=journey, slots=slots)
@@ -1078,6 +2947,7 @@ def delete_slot(slot_id):
     journey_id = slot.journey_id
     db.session.delete(slot)
     db.session.commit()
+    network_changed([journey_id])
     return redirect(url_for('edit_journey', journey_id=journey_id))
 
 
@@ -1088,23 +2958,8 @@ def search_booking():
 
     if request.method == 'POST':
         booking_id = request.form['booking_id']
-
-        result = db.session.query(
-            Booking.id,
-            Booking.travel_date,
-            Booking.final_price,
-            Booking.status,
-            User.name.label('user_name'),
-            SeatType.type_name.label('seat_type'),
-            Journey.departure_city,
-            Journey.arrival_city,
-            JourneySlot.departure_time,
-            JourneySlot.arrival_time
-        ).join(User, Booking.user_id == User.id)\
-         .join(Journey, Booking.journey_id == Journey.id)\
-         .join(SeatType, Booking.seat_type_id == SeatType.id)\
-         .join(JourneySlot, Booking.slot_id == JourneySlot.id)\
-         .filter(Booking.id == booking_id).first()
+        if booking_id.strip().isdigit():
+            result = booking_detail(int(booking_id))
 
     return render_template('search_book.html', result=result)
 
@@ -1114,36 +2969,25 @@ def search_booking():
 def reports_dashboard():
     return render_template('reports_dashboard.html')
 
-@app.route('/admin/reports/monthly-sales')
-@admin_required
-def report_monthly_sales():
-    sales = db.session.query(
+def monthly_sales_report():
+    return db.session.query(
         db.func.date_format(Booking.travel_date, "%Y-%m").label("month"),
         db.func.sum(Booking.final_price).label("total")
     ).filter(Booking.status == 'paid')\
      .group_by("month")\
      .order_by("month")\
      .all()
-    
-    return render_template('monthly_sales.html', sales=sales)
-
 
-@app.route('/admin/reports/top-customers')
-@admin_required
-def report_top_customers():
-    customers = db.session.query(
+def top_customers_report():
+    return db.session.query(
         User.name,
         db.func.sum(Booking.final_price).label("total_spent"),
         db.func.count(Booking.id).label("bookings")
     ).join(Booking).filter(Booking.status == 'paid')\
      .group_by(User.id).order_by(db.desc("total_spent")).limit(5).all()
-    
-    return render_template('top_customers.html', customers=customers)
 
-@app.route('/admin/reports/top-routes')
-@admin_required
-def report_top_routes():
-    routes = db.session.query(
+def top_routes_report():
+    return db.session.query(
         Journey.departure_city,
         Journey.arrival_city,
         db.func.sum(Booking.final_price).label("route_income"),
@@ -1152,17 +2996,423 @@ def report_top_routes():
      .group_by(Journey.id)\
      .order_by(db.desc("route_income")).all()
 
-    return render_template('top_routes.html', routes=routes)
+def cancellations_report():
+    return db.session.query(
+        db.func.count(Booking.id).label("total_cancelled"),
+        db.func.sum(Booking.final_price).label("value_lost")
+    ).filter(Booking.status == 'cancelled').first()
+
+@app.route('/admin/reports/monthly-sales')
+@admin_required
+def report_monthly_sales():
+    return render_template('monthly_sales.html', sales=monthly_sales_report())
+
+
+@app.route('/admin/reports/top-customers')
+@admin_required
+def report_top_customers():
+    return render_template('top_customers.html', customers=top_customers_report())
+
+@app.route('/admin/reports/top-routes')
+@admin_required
+def report_top_routes():
+    return render_template('top_routes.html', routes=top_routes_report())
 
 @app.route('/admin/reports/cancellations')
 @admin_required
 def report_cancellations():
-    cancelled = db.session.query(
-        db.func.count(Booking.id).label("total_cancelled"),
-        db.func.sum(Booking.final_price).label("value_lost")
-    ).filter(Booking.status == 'cancelled').first()
+    return render_template('cancellations.html', cancelled=cancellations_report())
+
+# 📊 Reports overview
+# All reports on one page. Each report runs on its own pool thread inside its
+# own app context, so it gets its own session and DB connection and the
+# aggregations run side by side; the page is streamed and each section is
+# sent as soon as its query finishes. ?format=json returns the same data.
+REPORTS = {
+    'monthly_sales': ('📅 Monthly Sales', monthly_sales_report),
+    'top_customers': ('🧑 Top 5 Customers', top_customers_report),
+    'top_routes': ('✈️ Most Profitable Routes', top_routes_report),
+    'cancellations': ('❌ Cancellations', cancellations_report),
+}
+ReportResult = namedtuple('ReportResult', 'key title rows ms error')
+_report_pool = None
+_report_pool_lock = threading.Lock()
+
+
+def report_pool():
+    global _report_pool
+    with _report_pool_lock:
+        if _report_pool is None:
+            _report_pool = ThreadPoolExecutor(app.config.get('REPORT_WORKERS', len(REPORTS)),
+                                              thread_name_prefix='report')
+        return _report_pool
+
+
+def run_report(key):
+    title, query = REPORTS[key]
+    started = time.perf_counter()
+    with app.app_context():  # own scoped session, removed (connection returned) on exit
+        try:
+            rows, error = query(), None
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Report {key} failed: {e}")
+            rows, error = None, str(e)
+    return ReportResult(key, title, rows, round((time.perf_counter() - started) * 1000, 1), error)
+
+
+def run_reports():
+    """Start every report on the pool; yields results in the order they finish."""
+    futures = [report_pool().submit(run_report, key) for key in REPORTS]
+    for future in as_completed(futures):
+        yield future.result()
+
+
+def _report_json(value):
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return [_report_json(row) for row in value]
+    return {k: float(v) if isinstance(v, Decimal) else v for k, v in value._asdict().items()}
+
+
+@app.route('/admin/reports/overview')
+@admin_required
+def reports_overview():
+    started = time.perf_counter()
+
+    def elapsed_ms():
+        return round((time.perf_counter() - started) * 1000, 1)
+
+    if request.args.get('format') == 'json':
+        reports = {
+            r.key: {'title': r.title, 'ms': r.ms, 'error': r.error, 'rows': _report_json(r.rows)}
+            for r in run_reports()
+        }
+        return jsonify({'reports': reports, 'total_ms': elapsed_ms()})
+
+    response = app.response_class(stream_template('reports_overview.html', results=run_reports(),
+                                                  elapsed_ms=elapsed_ms))
+    response.headers['X-Accel-Buffering'] = 'no'  # let nginx pass sections through as they arrive
+    return response
+
+# 🏆 Live leaderboards
+# Exact revenue/booking counters per customer and per route are kept in
+# memory for each window (today, last 7 days, all time), bucketed by booking
+# day so the short windows roll over at midnight. Each paid or cancelled
+# booking adjusts the counters and the cached top-K lists in O(K); a read
+# returns a cached list, and only a decrease that touches a cached list
+# forces it to be rebuilt from the counters. Counters are rebuilt from the
+# bookings table on first use and every LEADERBOARD_REBUILD_SECONDS (which
+# also picks up writes from other processes), and snapshotted to
+# leaderboard_snapshots so a restarted process can skip the full scan.
+LEADERBOARD_WINDOWS = {'today': 1, '7d': 7, 'all': None}
+LEADERBOARD_DIMENSIONS = ('customer', 'route')
+LEADERBOARD_METRICS = ('revenue', 'bookings')
+
+
+class Leaderboard:
+    def __init__(self, size=10):
+        self.size = size
+        self._lock = threading.RLock()
+        self.loaded_at = None
+        self._changed = False
+        self._persister = None
+        self._reset(datetime.utcnow().date())
+
+    def _reset(self, today):
+        self.today = today
+        # day -> dimension -> key -> [revenue, bookings], for the rolling windows
+        self.days = {}
+        self.counters = {w: {d: {} for d in LEADERBOARD_DIMENSIONS} for w in LEADERBOARD_WINDOWS}
+        self._top = {}  # (window, dimension, metric) -> [(score, key), ...] best first
+
+    def _windows_for(self, day):
+        age = (self.today - day).days
+        return [w for w, span in LEADERBOARD_WINDOWS.items() if span is None or 0 <= age < span]
+
+    def _roll_over(self):
+        today = datetime.utcnow().date()
+        if today == self.today:
+            return
+        self.today = today
+        oldest = today - timedelta(days=max(span for span in LEADERBOARD_WINDOWS.values() if span) - 1)
+        self.days = {day: bucket for day, bucket in self.days.items() if day >= oldest}
+        for window, span in LEADERBOARD_WINDOWS.items():
+            if span is None:
+                continue
+            counters = self.counters[window] = {d: {} for d in LEADERBOARD_DIMENSIONS}
+            for day, bucket in self.days.items():
+                if window in self._windows_for(day):
+                    for dimension, rows in bucket.items():
+                        for key, (revenue, count) in rows.items():
+                            _add_counter(counters[dimension], key, revenue, count)
+            for dimension in LEADERBOARD_DIMENSIONS:
+                for metric in LEADERBOARD_METRICS:
+                    self._top.pop((window, dimension, metric), None)
+
+    def _apply(self, day, keys, revenue, count):
+        windows = self._windows_for(day)
+        if '7d' in windows:
+            bucket = self.days.setdefault(day, {d: {} for d in LEADERBOARD_DIMENSIONS})
+            for dimension, key in keys.items():
+                _add_counter(bucket[dimension], key, revenue, count)
+        for window in windows:
+            for dimension, key in keys.items():
+                totals = _add_counter(self.counters[window][dimension], key, revenue, count)
+                for metric, delta, score in (('revenue', revenue, totals[0]), ('bookings', count, totals[1])):
+                    self._update_top((window, dimension, metric), key, delta, score)
+
+    def _update_top(self, top_key, key, delta, score):
+        top = self._top.get(top_key)
+        if top is None:
+            return
+        position = next((i for i, (_, k) in enumerate(top) if k == key), None)
+        if delta < 0:
+            if position is not None:
+                # Someone outside the list may now outrank it; rebuild on next read
+                del self._top[top_key]
+            return
+        if position is not None:
+            del top[position]
+        elif len(top) >= self.size and score <= top[-1][0]:
+            return
+        bisect.insort(top, (score, key), key=lambda item: -item[0])
+        del top[self.size:]
+
+    def record(self, user_id, journey_id, created_at, revenue, count):
+        with self._lock:
+            if self.loaded_at is None:
+                return  # nothing to update until the first read loads the counters
+            self._roll_over()
+            keys = {'customer': user_id, 'route': journey_id}
+            self._apply((created_at or datetime.utcnow()).date(), keys, revenue or 0.0, count)
+            self._changed = True
+
+    def top(self, window, dimension, metric, limit=None):
+        """Best ``limit`` (key, revenue, bookings) rows; O(K) unless a rebuild is pending."""
+        with self._lock:
+            self._roll_over()
+            top_key = (window, dimension, metric)
+            if top_key not in self._top:
+                index = LEADERBOARD_METRICS.index(metric)
+                counters = self.counters[window][dimension]
+                self._top[top_key] = [
+                    (totals[index], key) for key, totals in
+                    heapq.nlargest(self.size, counters.items(), key=lambda item: item[1][index])
+                    if totals[index] > 0
+                ]
+            counters = self.counters[window][dimension]
+            return [(key, *counters[key]) for _, key in self._top[top_key][:limit or self.size]]
+
+    def rebuild(self):
+        """Reload every counter from the paid bookings."""
+        today = datetime.utcnow().date()
+        since = today - timedelta(days=max(span for span in LEADERBOARD_WINDOWS.values() if span) - 1)
+        paid = Booking.status == 'paid'
+        totals = {
+            'customer': db.session.execute(
+                db.select(Booking.user_id, func.sum(Booking.final_price), func.count(Booking.id))
+                .where(paid).group_by(Booking.user_id)).all(),
+            'route': db.session.execute(
+                db.select(Booking.journey_id, func.sum(Booking.final_price), func.count(Booking.id))
+                .where(paid).group_by(Booking.journey_id)).all(),
+        }
+        day = func.date(Booking.created_at)
+        recent = db.session.execute(
+            db.select(day, Booking.user_id, Booking.journey_id, func.sum(Booking.final_price),
+                      func.count(Booking.id))
+            .where(paid, Booking.created_at >= datetime.combine(since, datetime.min.time()))
+            .group_by(day, Booking.user_id, Booking.journey_id)).all()
+
+        with self._lock:
+            self._reset(today)
+            for dimension, rows in totals.items():
+                for key, revenue, count in rows:
+                    self.counters['all'][dimension][key] = [float(revenue or 0), int(count)]
+            for booked_on, user_id, journey_id, revenue, count in recent:
+                if isinstance(booked_on, str):
+                    booked_on = date.fromisoformat(booked_on)
+                keys = {'customer': user_id, 'route': journey_id}
+                for window in self._windows_for(booked_on):
+                    if window != 'all':
+                        for dimension, key in keys.items():
+                            _add_counter(self.counters[window][dimension], key, float(revenue or 0), int(count))
+                bucket = self.days.setdefault(booked_on, {d: {} for d in LEADERBOARD_DIMENSIONS})
+                for dimension, key in keys.items():
+                    _add_counter(bucket[dimension], key, float(revenue or 0), int(count))
+            self.loaded_at = time.time()
+            self._changed = True
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'today': self.today.isoformat(),
+                'loaded_at': self.loaded_at,
+                'days': {day.isoformat(): bucket for day, bucket in self.days.items()},
+                'counters': self.counters,
+            }
+
+    def load_dict(self, data):
+        def keyed(rows):
+            return {int(key): totals for key, totals in rows.items()}
+
+        with self._lock:
+            self._reset(date.fromisoformat(data['today']))
+            self.days = {date.fromisoformat(day): {d: keyed(rows) for d, rows in bucket.items()}
+                         for day, bucket in data['days'].items()}
+            self.counters = {w: {d: keyed(rows) for d, rows in dims.items()}
+                             for w, dims in data['counters'].items()}
+            self.loaded_at = data['loaded_at']
+            self._roll_over()
+
+    def ensure_fresh(self):
+        """Load on first use (starting the snapshot timer) and rebuild when stale."""
+        rebuild_after = app.config.get('LEADERBOARD_REBUILD_SECONDS', 600)
+        if self.loaded_at is None:
+            snapshot = db.session.scalars(
+                db.select(LeaderboardSnapshot).order_by(LeaderboardSnapshot.id.desc()).limit(1)).first()
+            if snapshot is not None and time.time() - json.loads(snapshot.payload)['loaded_at'] < rebuild_after:
+                self.load_dict(json.loads(snapshot.payload))
+            else:
+                self.rebuild()
+            self.start_persisting()
+        elif time.time() - self.loaded_at >= rebuild_after:
+            self.rebuild()
+
+    def start_persisting(self):
+        """Snapshot changes every LEADERBOARD_PERSIST_SECONDS on a background thread, so
+        reads never write."""
+        with self._lock:
+            if self._persister is not None and self._persister.is_alive():
+                return
+            self._persister = threading.Thread(target=self._persist_loop, name='leaderboard-persist', daemon=True)
+            self._persister.start()
+
+    def _persist_loop(self):
+        while True:
+            time.sleep(app.config.get('LEADERBOARD_PERSIST_SECONDS', 30))
+            try:
+                with app.app_context():
+                    self.persist()
+            except Exception:
+                traceback.print_exc()
+
+    def persist(self):
+        """Write a snapshot if anything changed since the last one, keeping only the newest."""
+        if not self._changed:
+            return False
+        payload = json.dumps(self.to_dict())
+        self._changed = False
+        snapshot = LeaderboardSnapshot(payload=payload)
+        db.session.add(snapshot)
+        db.session.flush()
+        # Not "id < (SELECT max(id) ...)": MySQL can't read the table it deletes from
+        db.session.execute(db.delete(LeaderboardSnapshot).where(LeaderboardSnapshot.id != snapshot.id))
+        db.session.commit()
+        return True
+
+
+def _add_counter(rows, key, revenue, count):
+    totals = rows.get(key)
+    if totals is None:
+        totals = rows[key] = [0.0, 0]
+    totals[0] = round(totals[0] + revenue, 2)
+    totals[1] += count
+    if totals[1] <= 0:
+        del rows[key]
+    return totals
+
+
+leaderboard = Leaderboard(size=app.config.get('LEADERBOARD_SIZE', 10))
+
+
+def record_paid_booking(booking, sign=1):
+    """Count (sign=1) or uncount (sign=-1) a paid booking on the leaderboards."""
+    leaderboard.record(booking.user_id, booking.journey_id, booking.created_at,
+                       sign * booking.final_price, sign)
+
+
+def leaderboard_rows(window, limit=None):
+    """Named top customers and routes by revenue and by bookings for one window."""
+    leaderboard.ensure_fresh()
+    tables = {(dimension, metric): leaderboard.top(window, dimension, metric, limit)
+              for dimension in LEADERBOARD_DIMENSIONS for metric in LEADERBOARD_METRICS}
+
+    user_ids = {key for (dimension, _), rows in tables.items() if dimension == 'customer' for key, *_ in rows}
+    journey_ids = {key for (dimension, _), rows in tables.items() if dimension == 'route' for key, *_ in rows}
+    names = {'customer': {}, 'route': {}}
+    if user_ids:
+        names['customer'] = dict(db.session.execute(
+            db.select(User.id, User.name).where(User.id.in_(user_ids))).all())
+    if journey_ids:
+        names['route'] = {jid: f"{dep} → {arr}" for jid, dep, arr in db.session.execute(
+            db.select(Journey.id, Journey.departure_city, Journey.arrival_city)
+            .where(Journey.id.in_(journey_ids))).all()}
+
+    return {
+        f"{dimension}_{metric}": [
+            {'name': names[dimension].get(key, f"#{key}"), 'revenue': round(revenue, 2), 'bookings': count}
+            for key, revenue, count in rows
+        ]
+        for (dimension, metric), rows in tables.items()
+    }
+
+
+@app.route('/admin/reports/leaderboards')
+@admin_required
+def report_leaderboards():
+    window = request.args.get('window', 'today')
+    if window not in LEADERBOARD_WINDOWS:
+        window = 'today'
+    boards = leaderboard_rows(window)
+    if request.args.get('format') == 'json':
+        return jsonify({'window': window, **boards})
+    return render_template('leaderboards.html', window=window, boards=boards,
+                           refresh_seconds=app.config.get('LEADERBOARD_POLL_SECONDS', 5))
+
+
+@app.route('/api/seats/stream')
+def seat_availability_stream():
+    """Server-Sent Events stream of remaining seats for one slot on one date."""
+    slot_id = request.args.get('slot_id', type=int)
+    try:
+        travel_date = datetime.strptime(request.args.get('date', ''), '%Y-%m-%d').date()
+    except ValueError:
+        travel_date = None
+    if slot_id is None or travel_date is None:
+        return jsonify({'error': 'slot_id and date (YYYY-MM-DD) are required'}), 400
+
+    key = (slot_id, travel_date)
+    remaining = max(SLOT_CAPACITY - booked_seats([key]).get(key, 0), 0)
+    listener = seat_feed.subscribe(key)
+    heartbeat = app.config.get('SEAT_FEED_HEARTBEAT_SECONDS', 15)
+
+    def event(seats):
+        payload = json.dumps({'slot_id': slot_id, 'travel_date': travel_date.isoformat(), 'remaining': seats})
+        return f"event: seats\ndata: {payload}\n\n"
+
+    # The stream never touches the database, so the request's connection is
+    # returned to the pool as soon as this view returns.
+    def stream():
+        try:
+            yield "retry: 5000\n"
+            yield event(remaining)
+            while True:
+                try:
+                    seats = listener.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield event(seats)
+        finally:
+            seat_feed.unsubscribe(key, listener)
+
+    response = app.response_class(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
-    return render_template('cancellations.html', cancelled=cancelled)
 
 @app.route('/api/slots/<int:journey_id>')
 def get_slots_for_journey(journey_id):
@@ -1175,31 +3425,1049 @@ def get_slots_for_journey(journey_id):
         } for s in slots
     ])
 
+@app.route('/api/seatmap')
+def seat_map_api():
+    """Taken seats on a slot, date and seat type: ``?slot_id=&date=&seat_type_id=``."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        slot_id = int(request.args['slot_id'])
+        seat_type_id = int(request.args['seat_type_id'])
+        travel_date = date.fromisoformat(request.args['date'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'slot_id, date and seat_type_id are required'}), 400
+    today = date.today()
+    if not today <= travel_date <= today + timedelta(days=BOOKING_WINDOW_DAYS):
+        return jsonify({'error': f'date must be within the next {BOOKING_WINDOW_DAYS} days'}), 400
+    if db.session.get(JourneySlot, slot_id) is None or db.session.get(SeatType, seat_type_id) is None:
+        return jsonify({'error': 'Unknown slot or seat type'}), 404
+
+    # Read-only: a map is only stored once someone books on it
+    taken, capacity = peek_seat_map(db.session, slot_id, travel_date, seat_type_id)
+    taken = seat_numbers_of(taken)
+    return jsonify({
+        'slot_id': slot_id, 'travel_date': travel_date.isoformat(), 'seat_type_id': seat_type_id,
+        'capacity': capacity, 'row_width': app.config.get('SEAT_MAP_ROW_WIDTH', 4),
+        'taken': taken, 'available': capacity - len(taken),
+    })
+
+
+def seat_booked_slot_days(first, last):
+    """Create the missing seat maps of slot days from ``first`` to ``last`` that have paid
+    bookings, seating those bookings, one map at a time. Returns their keys."""
+    booked = set(db.session.execute(
+        db.select(Booking.slot_id, Booking.travel_date, Booking.seat_type_id).distinct()
+        .where(Booking.travel_date.between(first, last), Booking.status.in_(SEAT_HOLDING_STATUSES))
+    ).all()) - set(db.session.execute(
+        db.select(SeatMap.slot_id, SeatMap.travel_date, SeatMap.seat_type_id)
+        .where(SeatMap.travel_date.between(first, last))
+    ).all())
+    for key in sorted(booked):
+        retry_on_conflict(lambda: load_seat_map(db.session, *key))
+        db.session.commit()
+    return booked
+
+
+@app.cli.group()
+def seatmaps():
+    """Create seat maps ahead of time."""
+
+
+@seatmaps.command('init')
+@click.option('--days', default=BOOKING_WINDOW_DAYS, show_default=True, help='How many days ahead to cover.')
+@click.option('--batch-size', default=5000, show_default=True)
+def seatmaps_init(days, batch_size):
+    """Create every missing seat map from today to --days ahead."""
+    today = date.today()
+    last = today + timedelta(days=days)
+    slot_ids = db.session.scalars(db.select(JourneySlot.id).order_by(JourneySlot.id)).all()
+    seat_types = [(seat.id, seat_map_capacity(seat.type_name)) for seat in SeatType.query.order_by(SeatType.id)]
+    for seat_id, capacity in seat_types:
+        if not capacity:
+            click.echo(f"⚠️ Seat type {seat_id} is missing from SEAT_MAP_LAYOUT and can't be sold.")
+    seat_types = [(seat_id, capacity) for seat_id, capacity in seat_types if capacity]
+    booked = seat_booked_slot_days(today, last)
+    existing = set(db.session.execute(
+        db.select(SeatMap.slot_id, SeatMap.travel_date, SeatMap.seat_type_id)
+        .where(SeatMap.travel_date.between(today, last))
+    ).all())
+
+    created, size, rows = len(booked), 0, []
+    for slot_id in slot_ids:
+        for offset in range(days + 1):
+            travel_date = today + timedelta(days=offset)
+            for seat_type_id, capacity in seat_types:
+                if (slot_id, travel_date, seat_type_id) in existing or (slot_id, travel_date, seat_type_id) in booked:
+                    continue
+                rows.append({'slot_id': slot_id, 'travel_date': travel_date, 'seat_type_id': seat_type_id,
+                             'taken': encode_seats(0, capacity), 'version': 1})
+                size += (capacity + 7) // 8
+                if len(rows) >= batch_size:
+                    _bulk_insert(SeatMap, rows)
+                    db.session.commit()
+                    created, rows = created + len(rows), []
+    _bulk_insert(SeatMap, rows)
+    db.session.commit()
+    created += len(rows)
+    click.echo(f"Created {created} seat map(s) ({len(booked)} with existing bookings); "
+               f"{size} bytes of seat bits for the empty ones.")
+
+
+# 🧭 Connection search over the journey network
+RouteEdge = namedtuple('RouteEdge', 'departs arrives journey_id slot_id origin destination fare pence')
+
+
+def _minutes(t):
+    return t.hour * 60 + t.minute
+
+
+class RouteGraph:
+    """Time-dependent graph of the network with one edge per journey slot.
+
+    Slots run every day. Edges leaving a city are kept sorted by departure
+    minute so a search can bisect straight to the first usable connection,
+    and a single journey's edges can be swapped out without a full rebuild.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+        self._by_journey = {}      # journey_id -> [RouteEdge]
+        self._journeys_from = {}   # city key -> {journey_id}
+        self._out = {}             # city key -> [RouteEdge] sorted by departure
+        self._departs = {}         # city key -> [departure minute], parallel to _out
+        self.names = {}            # city key -> display name
+
+    def clear(self):
+        with self._lock:
+            self.loaded = False
+            self._by_journey = {}
+            self._journeys_from = {}
+            self._out = {}
+            self._departs = {}
+            self.names = {}
+
+    def load_rows(self, rows):
+        """Bulk load ``(journey_id, departure_city, arrival_city, fare, slot_id, dep_time, arr_time)`` rows."""
+        journeys = {}
+        for journey_id, dep_city, arr_city, fare, slot_id, dep_time, arr_time in rows:
+            entry = journeys.setdefault(journey_id, (dep_city, arr_city, fare, []))
+            if slot_id is not None:
+                entry[3].append((slot_id, dep_time, arr_time))
+
+        with self._lock:
+            self.clear()
+            for journey_id, (dep_city, arr_city, fare, slots) in journeys.items():
+                self._set_edges(journey_id, dep_city, arr_city, fare, slots)
+            for city in self._journeys_from:
+                self._reindex(city)
+            self.loaded = True
+
+    def set_journey(self, journey_id, dep_city, arr_city, fare, slots):
+        """Replace one journey's edges; ``slots`` is ``[(slot_id, dep_time, arr_time)]``."""
+        with self._lock:
+            touched = {edge.origin for edge in self._by_journey.get(journey_id, [])}
+            touched.update(self._set_edges(journey_id, dep_city, arr_city, fare, slots))
+            for city in touched:
+                self._reindex(city)
+
+    def _set_edges(self, journey_id, dep_city, arr_city, fare, slots):
+        for edge in self._by_journey.pop(journey_id, []):
+            self._journeys_from.get(edge.origin, set()).discard(journey_id)
+        if not dep_city or not arr_city or not slots:
+            return set()
+
+        origin, destination = normalize_city(dep_city), normalize_city(arr_city)
+        self.names.setdefault(origin, dep_city.strip())
+        self.names.setdefault(destination, arr_city.strip())
+
+        edges = []
+        for slot_id, dep_time, arr_time in slots:
+            departs, arrives = _minutes(dep_time), _minutes(arr_time)
+            if arrives <= departs:
+                arrives += 24 * 60  # overnight
+            edges.append(RouteEdge(departs, arrives, journey_id, slot_id, origin, destination,
+                                   fare or 0, int(round((fare or 0) * 100))))
+        self._by_journey[journey_id] = edges
+        self._journeys_from.setdefault(origin, set()).add(journey_id)
+        return {origin}
+
+    def _reindex(self, city):
+        edges = sorted(
+            (edge for jid in self._journeys_from.get(city, ()) for edge in self._by_journey[jid]),
+            key=lambda e: (e.departs, e.arrives)
+        )
+        # Swap in fresh lists so concurrent searches keep a consistent view
+        self._out[city] = edges
+        self._departs[city] = [edge.departs for edge in edges]
+
+    def search(self, origin, destination, start_minute=0, optimize='earliest',
+               min_connection=30, max_legs=3, max_days=2):
+        """Best itinerary from ``origin`` to ``destination`` as ``[(edge, day_offset)]``.
+
+        ``optimize`` is ``'earliest'`` (arrival time first, then fare) or
+        ``'cheapest'`` (fare first, then arrival). Times are minutes from
+        midnight of the travel date; connections need ``min_connection``
+        minutes between legs. Returns ``None`` when nothing connects.
+        """
+        origin, destination = normalize_city(origin), normalize_city(destination)
+        if origin == destination or origin not in self._out:
+            return None
+
+        out, departs = self._out, self._departs
+        horizon = start_minute + max_days * 24 * 60
+        cheapest = optimize == 'cheapest'
+        counter = itertools.count()
+        day_minutes = 24 * 60
+
+        # Labels are ranked by one integer packing (primary, secondary):
+        # (arrival, pence) for earliest and (pence, arrival) for cheapest.
+        scale = 10 ** 5 if cheapest else 10 ** 9
+        bound = float('inf')  # rank of the best label reaching the destination so far
+
+        # Per city, the best rank reached using at most n legs, so dominance
+        # is a single comparison. Fares don't depend on the time of day and
+        # slots repeat daily, so for cheapest a dearer label never needs
+        # keeping just because it arrives earlier.
+        best = {origin: [start_minute if cheapest else start_minute * scale] * (max_legs + 1)}
+        unreached = [float('inf')] * (max_legs + 1)
+
+        # (rank, tiebreak, arrival, cost, legs, city, path); cost is in pence
+        # and path is a linked list of (edge, day_offset, rest)
+        heap = [(best[origin][0], 0, start_minute, 0, 0, origin, None)]
+
+        while heap:
+            key, _, arrival, cost, legs, city, path = heapq.heappop(heap)
+            if city == destination:
+                itinerary = []
+                while path:
+                    edge, day, path = path
+                    itinerary.append((edge, day))
+                return itinerary[::-1]
+            if legs >= max_legs or city not in out:
+                continue
+            # Skip labels superseded after they were queued
+            if best[city][legs] < key:
+                continue
+
+            next_legs = legs + 1
+            ready = arrival + (min_connection if legs else 0)
+            first_day = ready // day_minutes
+            for day in (first_day, first_day + 1):
+                base = day * day_minutes
+                start = bisect.bisect_left(departs[city], ready - base) if day == first_day else 0
+                for edge in out[city][start:]:
+                    arrives = base + edge.arrives
+                    if arrives > horizon:
+                        continue
+                    new_cost = cost + edge.pence
+                    key = new_cost * scale + arrives if cheapest else arrives * scale + new_cost
+                    if key >= bound:  # legs only add time and fare, so it can't catch up
+                        continue
+                    keys = best.get(edge.destination)
+                    if keys is None:
+                        keys = best[edge.destination] = list(unreached)
+                    elif keys[next_legs] <= key:
+                        continue
+                    for n in range(next_legs, max_legs + 1):
+                        if key < keys[n]:
+                            keys[n] = key
+                    if edge.destination == destination:
+                        bound = key  # full rank, so a tie on the primary can still win on the secondary
+                    heapq.heappush(heap, (key, next(counter), arrives, new_cost, next_legs,
+                                          edge.destination, (edge, day, path)))
+        return None
+
+
+route_graph = RouteGraph()
+
+
+def ensure_route_graph():
+    if not route_graph.loaded:
+        rows = db.session.execute(
+            db.select(Journey.id, Journey.departure_city, Journey.arrival_city, Journey.base_fare,
+                      JourneySlot.id, JourneySlot.departure_time, JourneySlot.arrival_time)
+            .outerjoin(JourneySlot, JourneySlot.journey_id == Journey.id)
+        )
+        route_graph.load_rows(rows)
+    return route_graph
+
+
+def network_changed(journey_ids=None):
+    """Refresh network caches after journeys or slots change, here and (through the
+    cache bus) in every other worker.
+
+    Pass the affected journey ids for an incremental refresh, or nothing to
+    have everything rebuilt on next use.
+    """
+    cache_bus.bump('network')
+    refresh_network_caches(journey_ids)
+
+
+def refresh_network_caches(journey_ids=None):
+    """Refresh this process's network caches."""
+    global reference_data_version
+    reference_data_version += 1
+    city_index.clear()
+    booking_details.clear()
+
+    if journey_ids is None or not route_graph.loaded:
+        route_graph.clear()
+        return
+
+    journey_ids = set(journey_ids)
+    journeys = {j.id: j for j in Journey.query.filter(Journey.id.in_(journey_ids))}
+    slots = {}
+    for slot in JourneySlot.query.filter(JourneySlot.journey_id.in_(journey_ids)):
+        slots.setdefault(slot.journey_id, []).append((slot.id, slot.departure_time, slot.arrival_time))
+
+    for journey_id in journey_ids:
+        journey = journeys.get(journey_id)
+        if journey is None:
+            route_graph.set_journey(journey_id, None, None, 0, [])
+        else:
+            route_graph.set_journey(journey_id, journey.departure_city, journey.arrival_city,
+                                    journey.base_fare, slots.get(journey_id, []))
+
+
+cache_bus.subscribe('network', refresh_network_caches)
+
+
+# 🔤 City autocomplete
+class CityIndex:
+    """Sorted-array prefix index over every departure and arrival city.
+
+    Each city is stored once; the sorted key array holds the full normalized
+    name plus the start of every later word (so "york" finds "New York"), and
+    a prefix lookup is two bisects over it. Suggestions rank exact matches
+    first, then name-prefix matches, then the busiest cities.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._keys = []          # sorted normalized name / word-suffix keys
+        self._key_city = []      # city index for each key
+        self._key_rank = []      # 1 for a full name, 2 for a later word
+        self._names = []         # display name per city
+        self._weights = []       # number of routes touching each city
+        self._departures = []    # routes leaving each city
+        self._destinations = {}  # origin city index -> destination city indexes, busiest first
+
+    def clear(self):
+        self.loaded = False
+
+    def load_pairs(self, pairs):
+        """Build from ``(departure_city, arrival_city)`` rows."""
+        ids = {}
+        names, weights, departures = [], [], []
+        edges = {}
+
+        def city_id(name):
+            key = normalize_city(name)
+            if key not in ids:
+                ids[key] = len(names)
+                names.append(' '.join(name.split()))
+                weights.append(0)
+                departures.append(0)
+            return ids[key]
+
+        for dep, arr in pairs:
+            if not dep or not arr:
+                continue
+            o, d = city_id(dep), city_id(arr)
+            weights[o] += 1
+            weights[d] += 1
+            departures[o] += 1
+            edges.setdefault(o, set()).add(d)
+
+        keyed = []
+        for key, idx in ids.items():
+            keyed.append((key, idx, 1))
+            keyed.extend((key[pos + 1:], idx, 2) for pos, ch in enumerate(key) if ch == ' ')
+        keyed.sort()
+
+        self._keys = [k for k, _, _ in keyed]
+        self._key_city = [idx for _, idx, _ in keyed]
+        self._key_rank = [rank for _, _, rank in keyed]
+        self._names, self._weights, self._departures = names, weights, departures
+        self._destinations = {
+            o: sorted(ds, key=lambda d: (-weights[d], names[d])) for o, ds in edges.items()
+        }
+        self._ids = ids
+        self.loaded = True
+
+    def lookup(self, query, origin=None, limit=10):
+        """Ranked ``(name, routes)`` suggestions for ``query``.
+
+        With ``origin`` only cities reachable directly from it are returned,
+        and an empty query lists its destinations.
+        """
+        q = normalize_city(query)
+        allowed = None
+        if origin is not None:
+            origin_id = self._ids.get(normalize_city(origin))
+            if origin_id is None:
+                return []
+            allowed = self._destinations.get(origin_id, [])
+            if not q:
+                return [(self._names[c], self._weights[c]) for c in allowed[:limit]]
+            allowed = set(allowed)
+        elif not q:
+            return []
+
+        lo = bisect.bisect_left(self._keys, q)
+        hi = bisect.bisect_left(self._keys, q + '\uffff', lo)
+        weights = self._weights
+        # Rank 0 = exact name, 1 = name starts with the query, 2 = a later word does
+        matches = {}
+        for city, rank in zip(self._key_city[lo:hi], self._key_rank[lo:hi]):
+            if allowed is not None and city not in allowed:
+                continue
+            if rank < matches.get(city, 3):
+                matches[city] = rank
+        i = lo
+        while i < hi and self._keys[i] == q:
+            if self._key_rank[i] == 1 and self._key_city[i] in matches:
+                matches[self._key_city[i]] = 0
+            i += 1
+
+        top = heapq.nsmallest(limit, matches, key=lambda c: (matches[c], -weights[c], self._names[c]))
+        return [(self._names[c], weights[c]) for c in top]
+
+    def is_departure(self, name):
+        idx = self._ids.get(normalize_city(name))
+        return idx is not None and self._departures[idx] > 0
+
+
+city_index = CityIndex()
+
+
+def ensure_city_index():
+    if not city_index.loaded:
+        city_index.load_pairs(db.session.execute(db.select(Journey.departure_city, Journey.arrival_city)))
+    return city_index
+
+
+@app.route('/api/cities')
+def city_suggestions():
+    query = request.args.get('q', '')
+    origin = request.args.get('from') or None
+    limit = max(1, min(request.args.get('limit', type=int, default=10), 50))
+
+    index = ensure_city_index()
+    return jsonify([
+        {'name': name, 'routes': routes, 'departures': index.is_departure(name)}
+        for name, routes in index.lookup(query, origin=origin, limit=limit)
+    ])
+
+
+def format_itinerary(itinerary, travel_date, names):
+    legs = []
+    for edge, day in itinerary:
+        leg_date = travel_date + timedelta(days=day)
+        departs = datetime.combine(leg_date, datetime.min.time()) + timedelta(minutes=edge.departs)
+        arrives = datetime.combine(leg_date, datetime.min.time()) + timedelta(minutes=edge.arrives)
+        legs.append({
+            'journey_id': edge.journey_id,
+            'slot_id': edge.slot_id,
+            'from': names.get(edge.origin, edge.origin),
+            'to': names.get(edge.destination, edge.destination),
+            'travel_date': leg_date.isoformat(),
+            'departure': departs.isoformat(timespec='minutes'),
+            'arrival': arrives.isoformat(timespec='minutes'),
+            'fare': edge.fare
+        })
+
+    first, last = legs[0], legs[-1]
+    duration = datetime.fromisoformat(last['arrival']) - datetime.fromisoformat(first['departure'])
+    return {
+        'legs': legs,
+        'changes': len(legs) - 1,
+        'total_fare': round(sum(leg['fare'] for leg in legs), 2),
+        'departure': first['departure'],
+        'arrival': last['arrival'],
+        'duration_minutes': int(duration.total_seconds() // 60)
+    }
+
+
+@app.route('/api/routes')
+def search_routes():
+    origin = request.args.get('from', '').strip()
+    destination = request.args.get('to', '').strip()
+    optimize = request.args.get('optimize', 'earliest')
+
+    if not origin or not destination:
+        return jsonify({'success': False, 'message': 'Both from and to are required'}), 400
+    if optimize not in ('earliest', 'cheapest'):
+        return jsonify({'success': False, 'message': 'optimize must be earliest or cheapest'}), 400
+
+    try:
+        travel_date = datetime.strptime(request.args['date'], '%Y-%m-%d').date() \
+            if request.args.get('date') else date.today()
+        after = datetime.strptime(request.args['after'], '%H:%M').time() \
+            if request.args.get('after') else None
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Use YYYY-MM-DD for date and HH:MM for after'}), 400
+
+    min_connection = request.args.get('min_connection', type=int,
+                                      default=app.config.get('ROUTE_MIN_CONNECTION_MINUTES', 30))
+    max_legs = min(request.args.get('max_legs', type=int, default=3), 5)
+
+    graph = ensure_route_graph()
+    started = time.perf_counter()
+    itinerary = graph.search(origin, destination, _minutes(after) if after else 0, optimize,
+                             min_connection=max(min_connection, 0), max_legs=max(max_legs, 1))
+    search_ms = round((time.perf_counter() - started) * 1000, 3)
+
+    if not itinerary:
+        return jsonify({'success': False, 'message': 'No connection found', 'search_ms': search_ms}), 404
+
+    return jsonify({
+        'success': True,
+        'optimize': optimize,
+        'search_ms': search_ms,
+        **format_itinerary(itinerary, travel_date, graph.names)
+    })
+
+
+@app.cli.group()
+def bench():
+    """Micro-benchmarks for hot code paths."""
+
+
+def synthetic_city_names(rng, count):
+    """Made-up, mostly unique city names such as "Kirkmarton" or "Newley Castle"."""
+    syllables = ['ar', 'bel', 'cas', 'dor', 'en', 'fal', 'gran', 'ham', 'ing', 'kirk', 'ley', 'mar',
+                 'new', 'or', 'port', 'ros', 'st', 'ton', 'ville', 'wick']
+    return list({
+        ' '.join(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).title()
+                 for _ in range(rng.choice((1, 1, 1, 2))))
+        for _ in range(count)
+    })
+
+
+@bench.command('routes')
+@click.option('--cities', default=500, show_default=True)
+@click.option('--routes', default=5000, show_default=True)
+@click.option('--slots', default=12, show_default=True, help='Slots per route.')
+@click.option('--searches', default=500, show_default=True)
+@click.option('--seed', default=1, show_default=True)
+def bench_routes(cities, routes, slots, searches, seed):
+    """Time connection searches on a synthetic network (no database needed)."""
+    rng = Random(seed)
+    names = [f"City {i}" for i in range(cities)]
+    rows = []
+    slot_id = 0
+    for journey_id in range(1, routes + 1):
+        dep, arr = rng.sample(names, 2)
+        fare = round(rng.uniform(10, 200), 2)
+        for _ in range(slots):
+            slot_id += 1
+            start = rng.randrange(5 * 60, 23 * 60)
+            length = rng.randrange(30, 300)
+            rows.append((journey_id, dep, arr, fare, slot_id,
+                         (datetime.min + timedelta(minutes=start)).time(),
+                         (datetime.min + timedelta(minutes=start + length)).time()))
+
+    graph = RouteGraph()
+    started = time.perf_counter()
+    graph.load_rows(rows)
+    click.echo(f"Built graph: {routes} routes, {len(rows)} slots in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    for optimize in ('earliest', 'cheapest'):
+        timings = []
+        found = 0
+        for _ in range(searches):
+            origin, destination = rng.sample(names, 2)
+            started = time.perf_counter()
+            found += graph.search(origin, destination, optimize=optimize) is not None
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        click.echo(f"{optimize:>8}: mean {sum(timings) / len(timings):.2f} ms, "
+                   f"p95 {timings[int(len(timings) * 0.95)]:.2f} ms, max {timings[-1]:.2f} ms, "
+                   f"{found}/{searches} connected")
+
+    started = time.perf_counter()
+    graph.set_journey(1, names[0], names[1], 50, [(0, datetime.min.time(), datetime.min.time())])
+    click.echo(f"Incremental journey refresh: {(time.perf_counter() - started) * 1000:.2f} ms")
+
+
+@bench.command('cities')
+@click.option('--cities', default=20000, show_default=True)
+@click.option('--routes', default=100000, show_default=True)
+@click.option('--lookups', default=20000, show_default=True)
+@click.option('--seed', default=1, show_default=True)
+def bench_cities(cities, routes, lookups, seed):
+    """Time city autocomplete lookups on a synthetic network (no database needed)."""
+    rng = Random(seed)
+    names = synthetic_city_names(rng, cities)
+    pairs = [tuple(rng.sample(names, 2)) for _ in range(routes)]
+
+    index = CityIndex()
+    started = time.perf_counter()
+    index.load_pairs(pairs)
+    click.echo(f"Built index: {len(names)} cities, {routes} routes in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    queries = [normalize_city(rng.choice(names))[:rng.randint(1, 5)] for _ in range(lookups)]
+    for label, origin in (('prefix', None), ('prefix + origin', names[0])):
+        timings = []
+        for q in queries:
+            started = time.perf_counter()
+            index.lookup(q, origin=origin)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        click.echo(f"{label:>16}: mean {sum(timings) / len(timings):.3f} ms, "
+                   f"p95 {timings[int(len(timings) * 0.95)]:.3f} ms, max {timings[-1]:.3f} ms")
+
+
+@bench.command('queries')
+@click.option('--iterations', default=2000, show_default=True)
+@click.option('--user-id', type=int, help='Defaults to the user with the most bookings.')
+def bench_queries(iterations, user_id):
+    """Per-call Python overhead of the prebuilt hot queries vs. rebuilding them as ORM queries.
+
+    "prepare" is building the statement and its cache key (what each request
+    pays before SQLAlchemy can reuse the compiled SQL); "compile" is a cold
+    compile, the cost the cache avoids; "execute" includes the database.
+    """
+    user_id = user_id or db.session.scalar(
+        db.select(Booking.user_id).group_by(Booking.user_id).order_by(func.count().desc()).limit(1)
+    )
+    booking = db.session.scalars(db.select(Booking).where(Booking.user_id == user_id).limit(1)).first()
+    if booking is None:
+        raise click.ClickException("No bookings to query; run 'flask seed' first.")
+    slot_id, travel_date, booking_ids = booking.slot_id, booking.travel_date, [booking.id]
+    db.session.expunge_all()
+
+    def orm_seats_held():
+        return db.session.query(func.sum(Booking.seats_booked)).filter(
+            Booking.slot_id == slot_id, Booking.travel_date == travel_date, Booking.status.in_(SEAT_HOLDING_STATUSES)
+        ).statement
+
+    def orm_cart_count():
+        return Booking.query.filter_by(user_id=user_id, status='unpaid').with_entities(func.count(Booking.id)) \
+            .statement
+
+    def orm_my_bookings():
+        return db.session.query(
+            Booking.id, Booking.travel_date, Booking.final_price, Booking.status, Journey.departure_city,
+            Journey.arrival_city, JourneySlot.departure_time.label('slot_departure'),
+            JourneySlot.arrival_time.label('slot_arrival'), SeatType.type_name.label('seat_type')
+        ).join(Journey, Booking.journey_id == Journey.id) \
+         .join(JourneySlot, Booking.slot_id == JourneySlot.id) \
+         .join(SeatType, Booking.seat_type_id == SeatType.id) \
+         .filter(Booking.user_id == user_id).order_by(Booking.created_at.desc()).statement
+
+    def orm_booking_details():
+        return db.select(
+            Booking.id, Booking.user_id, User.name, User.email, Booking.journey_id, Journey.departure_city,
+            Journey.arrival_city, Booking.slot_id, JourneySlot.departure_time, JourneySlot.arrival_time,
+            Booking.seat_type_id, SeatType.type_name, Booking.travel_date, Booking.final_price,
+            Booking.seats_booked, Booking.status, Booking.created_at, Booking.seat_numbers,
+        ).join(User, Booking.user_id == User.id).join(Journey, Booking.journey_id == Journey.id) \
+         .join(SeatType, Booking.seat_type_id == SeatType.id).join(JourneySlot, Booking.slot_id == JourneySlot.id) \
+         .where(Booking.id.in_(booking_ids))
+
+    cases = [
+        ('seats held (booking)', orm_seats_held, SEATS_HELD, {'slot_id': slot_id, 'travel_date': travel_date}),
+        ('cart count (every page)', orm_cart_count, CART_COUNT, {'user_id': user_id}),
+        ('my bookings', orm_my_bookings, MY_BOOKINGS, {'user_id': user_id}),
+        ('booking detail (receipt)', orm_booking_details, BOOKING_DETAILS, {'booking_ids': booking_ids}),
+    ]
+
+    def per_call_us(fn, n=iterations):
+        fn()  # warm up caches
+        started = time.perf_counter()
+        for _ in range(n):
+            fn()
+        return (time.perf_counter() - started) / n * 1e6
+
+    dialect = db.engine.dialect
+    click.echo(f"{'query':<26}{'compile':>10}{'prepare ORM':>13}{'prebuilt':>10}{'execute ORM':>13}{'prebuilt':>10}"
+               "  (µs/call)")
+    saved = 0.0
+    for name, orm, prebuilt, params in cases:
+        compile_us = per_call_us(lambda: orm().compile(dialect=dialect), max(iterations // 10, 1))
+        prepare_orm = per_call_us(lambda: orm()._generate_cache_key())
+        prepare_fast = per_call_us(lambda: prebuilt._generate_cache_key())
+        execute_orm = per_call_us(lambda: db.session.execute(orm()).all())
+        execute_fast = per_call_us(lambda: db.session.execute(prebuilt, params).all())
+        saved += execute_orm - execute_fast
+        click.echo(f"{name:<26}{compile_us:>10.1f}{prepare_orm:>13.1f}{prepare_fast:>10.1f}"
+                   f"{execute_orm:>13.1f}{execute_fast:>10.1f}")
+    click.echo(f"Saved per request running all four: {saved:.1f} µs")
+
+
+def _add_sqlite_latency(engine, latency_ms):
+    """Sleep ``latency_ms`` inside every SQLite statement, as a stand-in for a networked database."""
+    def pause(statement):
+        time.sleep(latency_ms / 1000)
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        if hasattr(dbapi_connection, 'run_async'):  # aiosqlite adapter
+            dbapi_connection.run_async(lambda conn: conn.set_trace_callback(pause))
+        else:
+            dbapi_connection.set_trace_callback(pause)
+
+
+@bench.command('serve', hidden=True)
+@click.option('--mode', type=click.Choice(['sync', 'async']), required=True)
+@click.option('--port', type=int, required=True)
+@click.option('--threads', default=8)
+@click.option('--latency-ms', default=0.0)
+def bench_serve(mode, port, threads, latency_ms):
+    """Run one server for ``bench serving``."""
+    from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+    app.config['RATE_LIMIT_ENABLED'] = False
+    if mode == 'async':
+        import uvicorn
+        import asgi
+        if latency_ms and asgi.engine.dialect.name == 'sqlite':
+            _add_sqlite_latency(asgi.engine.sync_engine, latency_ms)
+        uvicorn.run(asgi.application, host='127.0.0.1', port=port, workers=1, log_level='warning',
+                    backlog=2048)
+        return
+
+    if latency_ms and db.engine.dialect.name == 'sqlite':
+        _add_sqlite_latency(db.engine, latency_ms)
+
+    class PooledWSGIServer(BaseWSGIServer):
+        """A WSGI server with a fixed number of worker threads (like gunicorn --threads)."""
+        request_queue_size = 2048
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.pool = ThreadPoolExecutor(threads)
+
+        def process_request(self, request, client_address):
+            self.pool.submit(self._handle, request, client_address)
+
+        def _handle(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    PooledWSGIServer('127.0.0.1', port, app, handler=QuietHandler).serve_forever()
+
+
+async def _http_load(port, path, concurrency, total):
+    """Issue ``total`` GETs with ``concurrency`` clients; returns (latencies in ms, errors)."""
+    import asyncio
+
+    latencies, errors, remaining = [], 0, total
+    request_bytes = f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n".encode()
+
+    async def client():
+        nonlocal errors, remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(request_bytes)
+                await writer.drain()
+                response = await reader.read()
+                writer.close()
+                if not response.startswith(b'HTTP/1.1 200') and not response.startswith(b'HTTP/1.0 200'):
+                    errors += 1
+                    continue
+            except OSError:
+                errors += 1
+                continue
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, errors
+
+
+@bench.command('serving')
+@click.option('--threads', default=8, show_default=True, help='Worker threads for the sync server.')
+@click.option('--concurrency', default=64, show_default=True, help='Concurrent clients.')
+@click.option('--requests', 'total', default=2000, show_default=True)
+@click.option('--latency-ms', default=20.0, show_default=True,
+              help='Simulated per-query database latency (SQLite only).')
+@click.option('--journey-id', type=int, help='Journey to fetch slots for; defaults to the first one.')
+@click.option('--port', default=5077, show_default=True)
+def bench_serving(threads, concurrency, total, latency_ms, journey_id, port):
+    """Compare /api/slots/<id> on the sync Flask path and the async ASGI path.
+
+    Both servers run as a single process: the sync one with a fixed pool of
+    --threads threads, the async one as one uvicorn worker.
+    """
+    import asyncio
+    import socket
+    import subprocess
+
+    journey_id = journey_id or db.session.scalar(db.select(func.min(Journey.id)))
+    if journey_id is None:
+        raise click.ClickException("No journeys to query; run 'flask seed' first.")
+    if latency_ms and db.engine.dialect.name != 'sqlite':
+        click.echo("--latency-ms only applies to SQLite; using the real database latency.")
+
+    for mode in ('sync', 'async'):
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'flask', '--app', os.path.join(app.root_path, 'app.py'), 'bench', 'serve',
+             '--mode', mode, '--port', str(port), '--threads', str(threads), '--latency-ms', str(latency_ms)],
+            cwd=app.root_path
+        )
+        try:
+            for _ in range(100):
+                try:
+                    socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            asyncio.run(_http_load(port, f'/api/slots/{journey_id}', concurrency, min(total, 50)))  # warm up
+
+            started = time.perf_counter()
+            latencies, errors = asyncio.run(_http_load(port, f'/api/slots/{journey_id}', concurrency, total))
+            elapsed = time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait()
+
+        latencies.sort()
+        if not latencies:
+            click.echo(f"{mode:>5}: all {errors} requests failed")
+            continue
+        click.echo(f"{mode:>5}: {len(latencies) / elapsed:8.1f} req/s, p50 {latencies[len(latencies) // 2]:.1f} ms, "
+                   f"p95 {latencies[int(len(latencies) * 0.95)]:.1f} ms, {errors} errors "
+                   f"({concurrency} clients, {'%d threads' % threads if mode == 'sync' else '1 event loop'})")
+
+
+# 🌱 Synthetic data
+# ``flask seed`` fills a database with a realistic network and booking
+# history for load and query testing. Everything is drawn from one seeded
+# RNG relative to --today, so the same options always give the same rows,
+# and rows are written with batched executemany inserts and explicit ids
+# (continuing after the current maximum) so no ids need reading back.
+SEED_SEAT_TYPES = [('Economy', 1.0), ('Business', 1.6), ('First', 2.4)]
+SEED_SEAT_MIX = [80, 15, 5]  # % of bookings per seat type
+SEED_DISCOUNTS = [(45, 5), (60, 10), (80, 20), (91, 30)]  # days before, % off
+SEED_CANCELLATIONS = [(0, 100), (7, 50), (30, 20), (60, 0)]  # days before, % charged
+SEED_FIRST_NAMES = ['Olivia', 'Amelia', 'Isla', 'Ava', 'Mia', 'Noah', 'Oliver', 'George', 'Arthur',
+                    'Leo', 'Muhammad', 'Harry', 'Priya', 'Sofia', 'Aisha', 'Jack', 'Ella', 'Lily']
+SEED_LAST_NAMES = ['Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson', 'Davies',
+                   'Patel', 'Wright', 'Khan', 'Evans', 'Thomas', 'Roberts', 'Walker', 'Perera']
+
+
+def _next_id(model):
+    return (db.session.scalar(db.select(func.max(model.id))) or 0) + 1
+
+
+def _bulk_insert(model, rows):
+    if rows:
+        db.session.execute(insert(model.__table__), rows)  # Core executemany, no ORM bookkeeping
+
+
+def _cumulative(weights):
+    return list(itertools.accumulate(weights))
+
+
+def seed_reference_data():
+    """Seat types and discount/cancellation rules, only where the tables are empty."""
+    if not db.session.scalar(db.select(func.count(SeatType.id))):
+        _bulk_insert(SeatType, [{'type_name': n, 'multiplier': m} for n, m in SEED_SEAT_TYPES])
+    if not db.session.scalar(db.select(func.count(Discount.id))):
+        _bulk_insert(Discount, [{'days_before': d, 'discount_percent': p} for d, p in SEED_DISCOUNTS])
+    if not db.session.scalar(db.select(func.count(Cancellation.id))):
+        _bulk_insert(Cancellation, [{'days_before': d, 'charge_percent': p} for d, p in SEED_CANCELLATIONS])
+    db.session.commit()
+
+
+def seed_network(rng, cities, routes, slots_per_route):
+    """Journeys between made-up cities (a few busy hubs, a long tail) and their slots."""
+    names = synthetic_city_names(rng, cities)
+    popularity = _cumulative(1 / (rank + 1) for rank in range(len(names)))
+    journey_id, slot_id = _next_id(Journey), _next_id(JourneySlot)
+    ids = city_ids(names)
+    ids = {name: ids[normalize_city(name)] for name in names}
+    existing = set(db.session.execute(db.select(Journey.departure_city_id, Journey.arrival_city_id)).all())
+
+    seen, journeys, slots = set(), [], []
+    while len(journeys) < routes and len(seen) < len(names) * (len(names) - 1):
+        dep, arr = rng.choices(names, cum_weights=popularity, k=2)
+        if dep == arr or (dep, arr) in seen:
+            continue
+        seen.add((dep, arr))
+        if (ids[dep], ids[arr]) in existing:
+            continue
+        journeys.append({'id': journey_id, 'departure_city': dep, 'arrival_city': arr,
+                         'departure_city_id': ids[dep], 'arrival_city_id': ids[arr],
+                         'base_fare': round(rng.uniform(15, 250), 2)})
+        duration = rng.randrange(45, 300, 5)
+        for start in sorted(rng.sample(range(6 * 60, 22 * 60, 15), slots_per_route)):
+            slots.append({'id': slot_id, 'journey_id': journey_id,
+                          'departure_time': (datetime.min + timedelta(minutes=start)).time(),
+                          'arrival_time': (datetime.min + timedelta(minutes=start + duration)).time()})
+            slot_id += 1
+        journey_id += 1
+
+    _bulk_insert(Journey, journeys)
+    _bulk_insert(JourneySlot, slots)
+    db.session.commit()
+    return journeys, slots
+
+
+def seed_users(rng, count, batch_size):
+    password = generate_password_hash('password')  # hashing is slow; every seeded user shares it
+    first_id = _next_id(User)
+    for start in range(0, count, batch_size):
+        _bulk_insert(User, [
+            {'id': user_id, 'name': f"{rng.choice(SEED_FIRST_NAMES)} {rng.choice(SEED_LAST_NAMES)}",
+             'email': f"user{user_id}@example.com", 'password': password, 'role': 'user'}
+            for user_id in range(first_id + start, first_id + min(start + batch_size, count))
+        ])
+        db.session.commit()
+    return range(first_id, first_id + count)
+
+
+def seed_bookings(rng, count, user_ids, journeys, slots, today, history_days, pay_later_rate,
+                  cancel_rate, batch_size, progress=None):
+    """Bookings made over the last ``history_days``.
+
+    Customers and routes follow long-tailed popularity, lead times are
+    mostly short (exponential, capped at the 120-day booking window), and
+    bookings for future dates can still be in a cart (unpaid) or cancelled.
+    Each batch is committed with its 'created' events, as ``events backfill``
+    would write them.
+    """
+    seat_types = db.session.execute(db.select(SeatType.id, SeatType.multiplier).order_by(SeatType.id)).all()
+    seat_mix = _cumulative(SEED_SEAT_MIX[i] if i < len(SEED_SEAT_MIX) else 1 for i in range(len(seat_types)))
+    discounts = sorted(db.session.execute(db.select(Discount.days_before, Discount.discount_percent)).all(),
+                       reverse=True)
+    discount_for = [next((pct for days, pct in discounts if days <= lead), 0) / 100 for lead in range(121)]
+
+    user_ids = list(user_ids)
+    user_weights = _cumulative(rng.paretovariate(1.2) for _ in user_ids)
+    route_weights = _cumulative(1 / (rank + 1) ** 0.8 for rank in range(len(journeys)))
+    route_slots = {}
+    for slot in slots:
+        route_slots.setdefault(slot['journey_id'], []).append(slot['id'])
+    seat_counts, seat_count_weights = [1, 2, 3, 4], _cumulative([70, 20, 6, 4])
+
+    now = datetime.combine(today, datetime.min.time()) + timedelta(hours=12)
+    history_seconds = history_days * 86400
+    booking_id = _next_id(Booking)
+    random, choices, expovariate = rng.random, rng.choices, rng.expovariate
+
+    written = 0
+    while written < count:
+        size = min(batch_size, count - written)
+        customers = choices(user_ids, cum_weights=user_weights, k=size)
+        routes = choices(journeys, cum_weights=route_weights, k=size)
+        seats = choices(seat_types, cum_weights=seat_mix, k=size)
+        party = choices(seat_counts, cum_weights=seat_count_weights, k=size)
+        rows = []
+        for i in range(size):
+            journey = routes[i]
+            created_at = now - timedelta(seconds=int(random() * history_seconds))
+            lead = min(int(expovariate(1 / 21)), 120)
+            travel_date = created_at.date() + timedelta(days=lead)
+            seat_type_id, multiplier = seats[i]
+
+            roll = random()
+            if travel_date >= today and roll < pay_later_rate:
+                status = 'unpaid'
+            elif roll > 1 - cancel_rate:
+                status = 'cancelled'
+            else:
+                status = 'paid'
+
+            rows.append({
+                'id': booking_id,
+                'user_id': customers[i],
+                'journey_id': journey['id'],
+                'seat_type_id': seat_type_id,
+                'slot_id': rng.choice(route_slots[journey['id']]),
+                'travel_date': travel_date,
+                'final_price': round(journey['base_fare'] * multiplier * party[i] * (1 - discount_for[lead]), 2),
+                'seats_booked': party[i],
+                'status': status,
+                'created_at': created_at,
+            })
+            booking_id += 1
+        _bulk_insert(Booking, rows)
+        db.session.execute(booking_events_from_select(
+            'created', Booking.id.between(rows[0]['id'], rows[-1]['id'])))
+        db.session.commit()
+        written += size
+        if progress:
+            progress(written)
+    return written
+
+
+@app.cli.command('seed')
+@click.option('--cities', default=200, show_default=True)
+@click.option('--routes', default=2000, show_default=True)
+@click.option('--slots', default=12, show_default=True, help='Slots per route.')
+@click.option('--users', default=10000, show_default=True)
+@click.option('--bookings', default=100000, show_default=True)
+@click.option('--history-days', default=365, show_default=True, help='How far back bookings were made.')
+@click.option('--pay-later-rate', default=0.08, show_default=True,
+              help='Share of future bookings still unpaid in a cart.')
+@click.option('--cancel-rate', default=0.07, show_default=True)
+@click.option('--batch-size', default=20000, show_default=True)
+@click.option('--seed', 'seed_value', default=1, show_default=True, help='RNG seed.')
+@click.option('--today', type=click.DateTime(formats=['%Y-%m-%d']), help='Anchor date; defaults to today.')
+def seed_command(cities, routes, slots, users, bookings, history_days, pay_later_rate, cancel_rate,
+                 batch_size, seed_value, today):
+    """Fill the database with synthetic journeys, users and bookings."""
+    rng = Random(seed_value)
+    today = today.date() if today else date.today()
+    db.create_all()
+
+    started = time.perf_counter()
+    seed_reference_data()
+    journeys, slot_rows = seed_network(rng, cities, routes, min(slots, 64))
+    click.echo(f"{len(journeys)} journeys, {len(slot_rows)} slots")
+    user_ids = seed_users(rng, users, batch_size)
+    click.echo(f"{users} users ({time.perf_counter() - started:.1f}s)")
+
+    def progress(written):
+        elapsed = time.perf_counter() - started
+        click.echo(f"{written}/{bookings} bookings ({elapsed:.1f}s)")
+
+    seed_bookings(rng, bookings, user_ids, journeys, slot_rows, today, history_days, pay_later_rate,
+                  cancel_rate, batch_size, progress=progress if bookings > batch_size else None)
+    seated = seat_booked_slot_days(today, today + timedelta(days=BOOKING_WINDOW_DAYS))
+    click.echo(f"{len(seated)} seat maps for booked slot days ({time.perf_counter() - started:.1f}s)")
+    # Leaderboards are rebuilt from the bookings on next use instead of loading an older snapshot
+    db.session.execute(db.delete(LeaderboardSnapshot))
+    db.session.commit()
+    network_changed()
+    click.echo(f"Seeded {bookings} bookings in {time.perf_counter() - started:.1f}s "
+               f"(seed {seed_value}, today {today}); seeded users log in with password 'password'.")
+
+
 @app.route('/add-to-cart', methods=['POST'])
+@idempotent
 def add_to_cart():
     if 'user_id' not in session:
         return jsonify({'success': False, 'message': 'Unauthorized'}), 401
 
     data = request.get_json()
     try:
-        booking = Booking(
-            user_id=session['user_id'],
-            journey_id=int(data['journey_id']),
-            seat_type_id=int(data['seat_type_id']),
-            travel_date=datetime.strptime(data['travel_date'], '%Y-%m-%d').date(),
-            final_price=float(data['final_price']),
-            slot_id=int(data['slot_id']),
-            seats_booked=int(data['seats_booked']),
-            status='unpaid'
-        )
+        booking = booking_from_json(session['user_id'], data, 'unpaid')
         db.session.add(booking)
         db.session.commit()
+        mark_committed()
+        booking_saved(booking)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
 @app.route('/cart')
-def cart():
+def cart(error=None):
     if 'user_id' not in session:
         return redirect('/login')
 
@@ -1220,47 +4488,153 @@ def cart():
      .filter(Booking.user_id == session['user_id'], Booking.status == 'unpaid') \
      .all()
 
-    return render_template('cart.html', bookings=bookings)
+    return render_template('cart.html', bookings=bookings, error=error)
 
 
 
 @app.route('/remove-from-cart/<int:booking_id>', methods=['POST'])
 def remove_from_cart(booking_id):
-    booking = Booking.query.get_or_404(booking_id)
+    booking = db.get_or_404(Booking, booking_id)
     if booking.user_id != session['user_id'] or booking.status != 'unpaid':
         return "Unauthorized", 403
 
+    key = (booking.slot_id, booking.travel_date)
+    event = booking_event('cart_removed', booking)
     db.session.delete(booking)
     db.session.commit()
+    booking_event_log.append([event])
+    booking_details.invalidate([booking_id])
+    seat_feed.publish([key])
     return redirect('/cart')
 
 @app.route('/checkout/<int:booking_id>', methods=['POST'])
 def checkout(booking_id):
-    booking = Booking.query.get_or_404(booking_id)
+    booking = db.get_or_404(Booking, booking_id)
     if booking.user_id != session['user_id'] or booking.status != 'unpaid':
         return "Unauthorized", 403
 
-    booking.status = 'paid'
-    db.session.commit()
+    def attempt():
+        booking = _fresh_booking(booking_id)
+        if booking is None or booking.status != 'unpaid':
+            return "Booking already paid", None
+        error = assign_booking_seats(db.session, booking)
+        if error:
+            db.session.rollback()
+            return error, None
+        if not _compare_and_swap(booking, {'status': 'paid', 'seat_numbers': booking.seat_numbers},
+                                 Booking.status == 'unpaid'):
+            return "Booking already paid", None
+        return None, booking
 
-    # Reuse email receipt logic
-    user = db.session.get(User, session['user_id'])
-    journey = db.session.get(Journey, booking.journey_id)
-    seat = db.session.get(SeatType, booking.seat_type_id)
-    slot = db.session.get(JourneySlot, booking.slot_id)
+    try:
+        error, booking = retry_on_conflict(attempt)
+    except StaleDataError:
+        return cart(error="Seats are changing fast, please try again.")
+    if error:
+        return cart(error=error)
+    booking_event_log.append([booking_event('paid', booking)])
+    booking_details.invalidate([booking.id])
+    publish_seat_changes([booking])
+    record_paid_booking(booking)
 
+    # Reuse email receipt logic
+    detail = booking_detail(booking.id)
     buffer = BytesIO()
-    generate_pdf_receipt(buffer, booking, user, journey, seat, slot)
-    buffer.seek(0)
-    send_email(user.email, buffer.read(), booking.id)
+    generate_pdf_receipt(buffer, detail)
+    send_email(detail.user_email, buffer.read(), detail.id)
 
     return redirect(f"/receipt/{booking.id}")
 
+@app.route('/checkout', methods=['POST'])
+def checkout_cart():
+    """Pay every unpaid booking in the cart (or the ticked ones) in one go."""
+    if 'user_id' not in session:
+        return redirect('/login')
+
+    selected = {int(b) for b in request.form.getlist('booking_ids')}
+    if request.form.get('mode') == 'selected' and not selected:
+        return cart(error="Select at least one booking to pay for.")
+
+    query = db.select(Booking, User, Journey, SeatType, JourneySlot) \
+        .join(User, Booking.user_id == User.id) \
+        .join(Journey, Booking.journey_id == Journey.id) \
+        .join(SeatType, Booking.seat_type_id == SeatType.id) \
+        .join(JourneySlot, Booking.slot_id == JourneySlot.id) \
+        .where(Booking.user_id == session['user_id'], Booking.status == 'unpaid') \
+        .order_by(Booking.travel_date, Booking.id) \
+        .with_for_update(of=Booking)
+    if selected:
+        query = query.where(Booking.id.in_(selected))
+    items = db.session.execute(query).all()
+
+    if not items:
+        return redirect('/cart')
+    if selected and len(items) != len(selected):
+        db.session.rollback()
+        return "Unauthorized", 403
+
+    # Re-check seats for every (slot, date) in the basket with one query
+    requested = {}
+    for booking, user, journey, seat, slot in items:
+        key = (booking.slot_id, booking.travel_date)
+        requested[key] = requested.get(key, 0) + booking.seats_booked
+    held = booked_seats(requested)
+
+    full = []
+    for booking, user, journey, seat, slot in items:
+        key = (booking.slot_id, booking.travel_date)
+        if held.get(key, 0) + requested[key] > SLOT_CAPACITY:
+            full.append(f"{journey.departure_city} → {journey.arrival_city} on {booking.travel_date} "
+                        f"({max(SLOT_CAPACITY - held.get(key, 0), 0)} seat(s) left)")
+    if full:
+        db.session.rollback()
+        return cart(error="Not enough seats left for: " + "; ".join(full))
+
+    # Seat everyone, then flip them all to paid if none changed since we read them
+    # (FOR UPDATE doesn't lock anything on SQLite)
+    versions = [(booking.id, booking.version) for booking, *_ in items]
+    try:
+        for booking, user, journey, seat, slot in items:
+            error = assign_booking_seats(db.session, booking)
+            if error:
+                db.session.rollback()
+                return cart(error=f"{journey.departure_city} → {journey.arrival_city} on {booking.travel_date}: "
+                                  f"{error}")
+    except StaleDataError:
+        db.session.rollback()
+        return cart(error="Seats are changing fast, please try again.")
+    details = [booking_detail_from(*item)._replace(status='paid') for item in items]
+    booking_ids = [detail.id for detail in details]
+
+    result = db.session.execute(
+        update(Booking).where(tuple_(Booking.id, Booking.version).in_(versions), Booking.status == 'unpaid')
+        .values(status='paid', version=Booking.version + 1),
+        execution_options={'synchronize_session': False}
+    )
+    if result.rowcount != len(booking_ids):
+        db.session.rollback()
+        return cart(error="Your cart changed while paying, please try again.")
+    db.session.commit()
+    booking_event_log.append(booking_event('paid', detail) for detail in details)
+    booking_details.invalidate(booking_ids)
+    seat_feed.publish(requested)
+    for d in details:
+        leaderboard.record(d.user_id, d.journey_id, d.created_at, d.final_price, 1)
+
+    # The receipt is built once the rows are committed and unlocked
+    buffer = BytesIO()
+    generate_combined_pdf_receipt(buffer, details)
+    send_combined_email(details[0].user_email, buffer.read(), booking_ids)
+
+    if len(booking_ids) == 1:
+        return redirect(f"/receipt/{booking_ids[0]}")
+    return redirect('/my-bookings')
+
 @app.context_processor
 def inject_cart_count():
     count = 0
     if 'user_id' in session:
-        count = Booking.query.filter_by(user_id=session['user_id'], status='unpaid').count()
+        count = db.session.scalar(CART_COUNT, {'user_id': session['user_id']})
     return dict(cart_count=count)
 
 @app.route('/admin/journeys/<int:journey_id>/add-slot', methods=['POST'])
@@ -1283,9 +4657,403 @@ def add_slot(journey_id):
     )
     db.session.add(new_slot)
     db.session.commit()
+    network_changed([journey_id])
 
     return redirect(url_for('edit_journey', journey_id=journey_id))
 
+
+# 🗓 Timetable generator
+def build_timetable(journey_ids, first_departure, last_departure, every_minutes, duration_minutes):
+    """Expand a recurrence pattern into slot rows for every journey in ``journey_ids``.
+
+    Departures run from ``first_departure`` to ``last_departure`` (inclusive)
+    every ``every_minutes``; arrivals are ``duration_minutes`` later and wrap
+    past midnight.
+    """
+    if every_minutes <= 0 or duration_minutes <= 0:
+        raise ValueError("Interval and duration must be positive.")
+
+    start = first_departure.hour * 60 + first_departure.minute
+    end = last_departure.hour * 60 + last_departure.minute
+    if end < start:
+        raise ValueError("Last departure must not be before the first departure.")
+
+    midnight = datetime.min
+    times = [
+        ((midnight + timedelta(minutes=minute)).time(),
+         (midnight + timedelta(minutes=minute + duration_minutes)).time())
+        for minute in range(start, end + 1, every_minutes)
+    ]
+
+    return [
+        {
+            'journey_id': journey_id,
+            'departure_time': dep_time,
+            'arrival_time': arr_time,
+            'available_seats': 140
+        }
+        for journey_id in journey_ids
+        for dep_time, arr_time in times
+    ]
+
+
+def generate_timetable(journey_ids, first_departure, last_departure, every_minutes, duration_minutes,
+                       dry_run=False):
+    """Build a timetable, drop slots that already exist and bulk insert the rest.
+
+    Everything is written with one executemany ``INSERT`` in a single
+    transaction. Returns ``(new_rows, skipped_count)``.
+    """
+    journey_ids = sorted(set(journey_ids))
+    known = set(db.session.scalars(db.select(Journey.id).where(Journey.id.in_(journey_ids))))
+    missing = [jid for jid in journey_ids if jid not in known]
+    if missing:
+        raise ValueError(f"Unknown journey id(s): {', '.join(map(str, missing))}")
+
+    rows = build_timetable(journey_ids, first_departure, last_departure, every_minutes, duration_minutes)
+
+    existing = set(db.session.execute(
+        db.select(JourneySlot.journey_id, JourneySlot.departure_time)
+        .where(JourneySlot.journey_id.in_(journey_ids))
+    ).all())
+    new_rows = [r for r in rows if (r['journey_id'], r['departure_time']) not in existing]
+
+    if new_rows and not dry_run:
+        db.session.execute(insert(JourneySlot), new_rows)
+        db.session.commit()
+        network_changed(journey_ids)
+
+    return new_rows, len(rows) - len(new_rows)
+
+
+@app.route('/admin/timetable', methods=['GET', 'POST'])
+@admin_required
+def timetable_generator():
+    journeys = Journey.query.order_by(Journey.departure_city, Journey.arrival_city).all()
+    form = request.form
+    preview = None
+    skipped = 0
+    message = None
+    error = None
+
+    if request.method == 'POST':
+        try:
+            journey_ids = [j.id for j in journeys] if form.get('all_routes') else \
+                [int(jid) for jid in form.getlist('journey_ids')]
+            if not journey_ids:
+                raise ValueError("Select at least one route.")
+
+            new_rows, skipped = generate_timetable(
+                journey_ids,
+                datetime.strptime(form['first_departure'], '%H:%M').time(),
+                datetime.strptime(form['last_departure'], '%H:%M').time(),
+                int(form['every_minutes']),
+                int(form['duration_minutes']),
+                dry_run=form.get('action') != 'generate'
+            )
+        except ValueError as e:
+            error = str(e)
+        else:
+            if form.get('action') == 'generate':
+                message = f"Added {len(new_rows)} slot(s), skipped {skipped} existing."
+            else:
+                routes = {j.id: f"{j.departure_city} → {j.arrival_city}" for j in journeys}
+                preview = [dict(r, route=routes[r['journey_id']]) for r in new_rows]
+
+    return render_template('admin_timetable.html', journeys=journeys, form=form, preview=preview,
+                           skipped=skipped, message=message, error=error)
+
+
+@app.cli.command('generate-timetable')
+@click.option('--route', 'routes', multiple=True, type=int, help='Journey id (repeatable).')
+@click.option('--all-routes', is_flag=True, help='Generate for every journey.')
+@click.option('--first', default='06:00', show_default=True, help='First departure (HH:MM).')
+@click.option('--last', default='22:00', show_default=True, help='Last departure (HH:MM).')
+@click.option('--every', default=30, show_default=True, help='Minutes between departures.')
+@click.option('--duration', type=int, required=True, help='Journey duration in minutes.')
+@click.option('--dry-run', is_flag=True, help='Only show what would be added.')
+def generate_timetable_command(routes, all_routes, first, last, every, duration, dry_run):
+    """Bulk create recurring journey slots."""
+    journey_ids = db.session.scalars(db.select(Journey.id)).all() if all_routes else list(routes)
+    if not journey_ids:
+        raise click.UsageError("Pass --route at least once or --all-routes.")
+
+    try:
+        new_rows, skipped = generate_timetable(
+            journey_ids,
+            datetime.strptime(first, '%H:%M').time(),
+            datetime.strptime(last, '%H:%M').time(),
+            every,
+            duration,
+            dry_run=dry_run
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    if dry_run:
+        for r in new_rows:
+            click.echo(f"journey {r['journey_id']}: {r['departure_time']:%H:%M} → {r['arrival_time']:%H:%M}")
+        click.echo(f"Would add {len(new_rows)} slot(s), skipping {skipped} existing.")
+    else:
+        click.echo(f"Added {len(new_rows)} slot(s), skipped {skipped} existing.")
+
+
+# 🏙 Cities
+# Journeys point at rows in ``cities`` by integer id. Cities are matched on
+# their normalized name (``name_key``, unique), and a route is found with a
+# seek on the (departure_city_id, arrival_city_id) unique index instead of
+# comparing lower() of the text columns across the table. The text columns
+# stay on journeys as the display names every booking list reads.
+def normalize_city(name):
+    """Key used to compare city names: trimmed, single-spaced and case-folded."""
+    return ' '.join(name.split()).casefold()
+
+
+def city_ids(names, create=True):
+    """Map the normalized key of each name to its city id, adding missing cities."""
+    wanted = {}
+    for name in names:
+        name = ' '.join((name or '').split())
+        if name:
+            wanted.setdefault(normalize_city(name), name)
+
+    def load(keys):
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):
+            found.update(db.session.execute(
+                db.select(City.name_key, City.id).where(City.name_key.in_(keys[i:i + 1000]))
+            ).all())
+        return found
+
+    ids = load(wanted)
+    missing = [key for key in wanted if key not in ids]
+    if missing and create:
+        rows = [{'name': wanted[key], 'name_key': key} for key in missing]
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(City), rows)
+        except IntegrityError:
+            # Another request added some of these cities first; insert the rest one by one
+            for row in rows:
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(insert(City), [row])
+                except IntegrityError:
+                    pass
+        ids.update(load(missing))
+    return ids
+
+
+def find_journey(departure, arrival):
+    """The journey from ``departure`` to ``arrival`` (any case or spacing), or None."""
+    ids = city_ids([departure, arrival], create=False)
+    dep_id, arr_id = ids.get(normalize_city(departure)), ids.get(normalize_city(arrival))
+    if dep_id is None or arr_id is None:
+        return None
+    return Journey.query.filter_by(departure_city_id=dep_id, arrival_city_id=arr_id).first()
+
+
+def set_journey_cities(journey, departure, arrival):
+    """Set a journey's cities (adding them if new) and its display names."""
+    departure, arrival = ' '.join(departure.split()), ' '.join(arrival.split())
+    ids = city_ids([departure, arrival])
+    journey.departure_city, journey.arrival_city = departure, arrival
+    journey.departure_city_id = ids[normalize_city(departure)]
+    journey.arrival_city_id = ids[normalize_city(arrival)]
+
+
+def backfill_journey_cities(batch_size=None):
+    """Link journeys that have no city ids yet to their cities; returns how many were linked."""
+    batch_size = batch_size or app.config.get('MAINTENANCE_CHUNK_SIZE', 500)
+    rows = db.session.execute(
+        db.select(Journey.id, Journey.departure_city, Journey.arrival_city).where(db.or_(
+            Journey.departure_city_id.is_(None), Journey.arrival_city_id.is_(None)
+        ))
+    ).all()
+    ids = city_ids(name for _, dep, arr in rows for name in (dep, arr))
+    updates = [
+        {'id': journey_id,
+         'departure_city_id': ids.get(normalize_city(dep or '')),
+         'arrival_city_id': ids.get(normalize_city(arr or ''))}
+        for journey_id, dep, arr in rows
+    ]
+    for i in range(0, len(updates), batch_size):
+        db.session.execute(update(Journey), updates[i:i + batch_size])
+        db.session.commit()
+    return len(updates)
+
+
+def duplicate_routes():
+    """Lists of journey ids that share a departure and arrival city."""
+    routes = {}
+    for journey_id, dep_id, arr_id in db.session.execute(
+        db.select(Journey.id, Journey.departure_city_id, Journey.arrival_city_id)
+        .where(Journey.departure_city_id.is_not(None), Journey.arrival_city_id.is_not(None))
+        .order_by(Journey.id)
+    ):
+        routes.setdefault((dep_id, arr_id), []).append(journey_id)
+    return [ids for ids in routes.values() if len(ids) > 1]
+
+
+# 📥 Bulk journey / fare import
+IMPORT_BATCH_SIZE = 5000
+IMPORT_FIELD_ALIASES = {
+    'departure': ('departure', 'departure_city', 'from'),
+    'arrival': ('arrival', 'arrival_city', 'to'),
+    'base_fare': ('base_fare', 'fare'),
+}
+
+
+def read_journey_rows(stream, fmt):
+    """Yield ``(line_no, row_dict)`` from a CSV (with header) or JSONL text stream."""
+    if fmt == 'jsonl':
+        for line_no, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_no, row if isinstance(row, dict) else None
+    else:
+        # Header is line 1, so data starts at line 2
+        for line_no, row in enumerate(csv.DictReader(stream), start=2):
+            yield line_no, row
+
+
+def import_journeys(rows, dry_run=False, batch_size=IMPORT_BATCH_SIZE):
+    """Upsert journeys keyed on their (departure, arrival) city ids and set their fares.
+
+    Existing routes are looked up by city ids a batch at a time, then new
+    routes are inserted and changed fares updated with batched executemany
+    statements, all in one transaction. Returns a summary dict with
+    ``inserted``, ``updated``, ``unchanged`` and ``rejected`` counts plus the
+    first few rejection reasons in ``errors``.
+    """
+    result = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'rejected': 0, 'errors': []}
+
+    def reject(line_no, reason):
+        result['rejected'] += 1
+        if len(result['errors']) < 50:
+            result['errors'].append(f"Line {line_no}: {reason}")
+
+    incoming = {}
+    for line_no, row in rows:
+        if row is None:
+            reject(line_no, "not a valid record")
+            continue
+
+        values = {}
+        for field, aliases in IMPORT_FIELD_ALIASES.items():
+            values[field] = next((row[a] for a in aliases if row.get(a) not in (None, '')), None)
+
+        dep = ' '.join(str(values['departure'] or '').split())
+        arr = ' '.join(str(values['arrival'] or '').split())
+        if not dep or not arr:
+            reject(line_no, "departure and arrival are required")
+            continue
+        if normalize_city(dep) == normalize_city(arr):
+            reject(line_no, "departure and arrival are the same city")
+            continue
+        try:
+            fare = round(float(values['base_fare']), 2)
+        except (TypeError, ValueError):
+            reject(line_no, "base_fare must be a number")
+            continue
+        if fare < 0:
+            reject(line_no, "base_fare must not be negative")
+            continue
+
+        # Later rows for the same route win
+        incoming[(normalize_city(dep), normalize_city(arr))] = (dep, arr, fare)
+
+    # A dry run doesn't add cities; a route to a city that doesn't exist yet is new
+    ids = city_ids((name for dep, arr, _ in incoming.values() for name in (dep, arr)), create=not dry_run)
+    routes = {key: (ids.get(key[0]), ids.get(key[1])) for key in incoming}
+    pairs = sorted({route for route in routes.values() if None not in route})
+    existing = {}
+    for i in range(0, len(pairs), batch_size):
+        for jid, dep_id, arr_id, fare in db.session.execute(
+            db.select(Journey.id, Journey.departure_city_id, Journey.arrival_city_id, Journey.base_fare)
+            .where(tuple_(Journey.departure_city_id, Journey.arrival_city_id).in_(pairs[i:i + batch_size]))
+        ):
+            existing[(dep_id, arr_id)] = (jid, fare)
+
+    inserts = []
+    updates = []
+    for key, (dep, arr, fare) in incoming.items():
+        dep_id, arr_id = route = routes[key]
+        if route not in existing:
+            inserts.append({'departure_city': dep, 'arrival_city': arr, 'base_fare': fare,
+                            'departure_city_id': dep_id, 'arrival_city_id': arr_id})
+        elif existing[route][1] != fare:
+            updates.append({'id': existing[route][0], 'base_fare': fare})
+        else:
+            result['unchanged'] += 1
+
+    result['inserted'] = len(inserts)
+    result['updated'] = len(updates)
+
+    if not dry_run:
+        for i in range(0, len(inserts), batch_size):
+            db.session.execute(insert(Journey), inserts[i:i + batch_size])
+        for i in range(0, len(updates), batch_size):
+            db.session.execute(update(Journey), updates[i:i + batch_size])
+        db.session.commit()
+        network_changed()
+
+    return result
+
+
+def _import_format(filename, fmt=None):
+    if fmt:
+        return fmt
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+@app.route('/admin/journeys/import', methods=['GET', 'POST'])
+@admin_required
+def import_journeys_upload():
+    result = None
+    error = None
+
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            error = "Choose a CSV or JSONL file to upload."
+        else:
+            stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+            rows = read_journey_rows(stream, _import_format(upload.filename))
+            started = time.perf_counter()
+            result = import_journeys(rows, dry_run='dry_run' in request.form)
+            result['seconds'] = round(time.perf_counter() - started, 2)
+
+    return render_template('admin_import.html', result=result, error=error)
+
+
+@app.cli.command('import-journeys')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension.')
+@click.option('--dry-run', is_flag=True, help='Validate and count without writing.')
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True)
+def import_journeys_command(path, fmt, dry_run, batch_size):
+    """Bulk upsert journeys and fares from a CSV or JSONL file."""
+    started = time.perf_counter()
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        result = import_journeys(read_journey_rows(f, _import_format(path, fmt)),
+                                 dry_run=dry_run, batch_size=batch_size)
+    elapsed = time.perf_counter() - started
+
+    for err in result['errors']:
+        click.echo(err, err=True)
+    total = result['inserted'] + result['updated'] + result['unchanged'] + result['rejected']
+    click.echo(
+        f"{'[dry run] ' if dry_run else ''}Inserted {result['inserted']}, "
+        f"updated {result['updated']}, unchanged {result['unchanged']}, rejected {result['rejected']} "
+        f"({total} rows in {elapsed:.2f}s, {total / elapsed if elapsed else total:.0f} rows/s)"
+    )
+
 @app.route('/admin/users/update-role', methods=['POST'])
 @admin_required
 def update_user_role():
@@ -1305,13 +5073,467 @@ def delete_user():
     user = db.session.get(User, int(user_id))
 
     if user:
-        # Optional: Delete their bookings too if needed:
-        Booking.query.filter_by(user_id=user.id).delete()
-        db.session.delete(user)
+        # Locked out now; bookings are deleted in small chunks, then the user, by the maintenance worker
+        user.role = 'deleted'
         db.session.commit()
+        enqueue_maintenance_job('delete_user', user_id=user.id)
     return redirect('/admin/users')
 
 
+# 🧹 Maintenance jobs
+# Large deletes and archival run as resumable jobs: each step handles one
+# chunk of bookings by id, commits it together with the job's progress and
+# pauses, so the live table is never locked for long and an interrupted job
+# carries on from its last id.
+def _archive_bookings_chunk(job, params, limit):
+    cutoff = date.fromisoformat(params['before'])
+    ids = db.session.scalars(
+        db.select(Booking.id)
+        .where(Booking.travel_date < cutoff, Booking.id > job.last_id)
+        .order_by(Booking.id).limit(limit)
+    ).all()
+    if ids:
+        columns = ['id', 'user_id', 'journey_id', 'seat_type_id', 'slot_id', 'travel_date',
+                   'final_price', 'seats_booked', 'status', 'created_at', 'version', 'seat_numbers']
+        db.session.execute(
+            insert(BookingArchive).from_select(
+                columns, db.select(*[getattr(Booking, c) for c in columns]).where(Booking.id.in_(ids))
+            )
+        )
+        db.session.execute(booking_events_from_select('archived', Booking.id.in_(ids)))
+        db.session.execute(db.delete(Booking).where(Booking.id.in_(ids)))
+        booking_details.invalidate(ids)
+    return ids
+
+
+def _delete_user_chunk(job, params, limit):
+    ids = db.session.scalars(
+        db.select(Booking.id).where(Booking.user_id == params['user_id'])
+        .order_by(Booking.id).limit(limit)
+    ).all()
+    seated = db.session.execute(
+        db.select(Booking.slot_id, Booking.travel_date, Booking.seat_type_id, Booking.seat_numbers)
+        .where(Booking.id.in_(ids), Booking.status.in_(SEAT_HOLDING_STATUSES), Booking.seat_numbers.is_not(None),
+               Booking.travel_date >= date.today())
+    ).all()
+    for slot_id, travel_date, seat_type_id, seat_numbers in seated:
+        release_seats(db.session, slot_id, travel_date, seat_type_id, seat_numbers)
+    if ids:
+        db.session.execute(booking_events_from_select('deleted', Booking.id.in_(ids)))
+        db.session.execute(db.delete(Booking).where(Booking.id.in_(ids)))
+        booking_details.invalidate(ids)
+    else:
+        db.session.execute(db.delete(User).where(User.id == params['user_id']))
+    return ids
+
+
+def _clear_cancelled_chunk(job, params, limit):
+    ids = db.session.scalars(
+        db.select(Booking.id)
+        .where(Booking.user_id == params['user_id'], Booking.status == 'cancelled', Booking.id > job.last_id)
+        .order_by(Booking.id).limit(limit)
+    ).all()
+    if ids:
+        db.session.execute(booking_events_from_select('deleted', Booking.id.in_(ids)))
+        db.session.execute(db.delete(Booking).where(Booking.id.in_(ids)))
+        booking_details.invalidate(ids)
+    return ids
+
+
+def disrupted_bookings(params):
+    """Active bookings on the slot (or any slot of the journey) between the job's dates."""
+    conditions = [
+        Booking.status.in_(('paid', 'unpaid')),
+        Booking.travel_date.between(date.fromisoformat(params['date_from']), date.fromisoformat(params['date_to'])),
+    ]
+    if params.get('slot_id'):
+        conditions.append(Booking.slot_id == params['slot_id'])
+    else:
+        conditions.append(Booking.journey_id == params['journey_id'])
+    return db.and_(*conditions)
+
+
+def _cancel_service_chunk(job, params, limit):
+    # A booking paid or cancelled between the read and the update makes the whole
+    # chunk re-read, so charges, seats, events and emails match what was cancelled
+    return retry_on_conflict(lambda: _cancel_service_rows(job.last_id, params, limit))
+
+
+def _cancel_service_rows(after_id, params, limit):
+    rows = db.session.execute(
+        db.select(Booking.id, Booking.version, *[getattr(Booking, f) for f in BOOKING_EVENT_FIELDS],
+                  Booking.seat_numbers, Booking.created_at, User.email, User.name, Journey.departure_city,
+                  Journey.arrival_city)
+        .join(User, User.id == Booking.user_id).join(Journey, Journey.id == Booking.journey_id)
+        .where(disrupted_bookings(params), Booking.id > after_id)
+        .order_by(Booking.id).limit(limit).with_for_update(of=Booking)
+    ).all()
+    if not rows:
+        return []
+
+    # Same rules as cancel_booking: the highest days_before the travel date has reached
+    rules = db.session.execute(
+        db.select(Cancellation.days_before, Cancellation.charge_percent).order_by(Cancellation.days_before.desc())
+    ).all()
+    today = date.today()
+    charges = {}
+    for row in rows:
+        if row.status != 'paid':
+            charges[row.id] = 0
+            continue
+        days_left = (row.travel_date - today).days
+        percent = next((pct for days, pct in rules if days <= days_left), 100)
+        charges[row.id] = round((percent / 100) * row.final_price, 2)
+
+    ids = list(charges)
+    # FOR UPDATE doesn't lock anything on SQLite, so only cancel rows still as we read them
+    result = db.session.execute(
+        update(Booking).where(tuple_(Booking.id, Booking.version).in_([(row.id, row.version) for row in rows]),
+                              Booking.status.in_(('paid', 'unpaid')))
+        .values(status='cancelled', version=Booking.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != len(ids):
+        raise StaleDataError(f"Bookings after {after_id} changed while cancelling the service")
+    seats = {}
+    for row in rows:
+        if row.status in SEAT_HOLDING_STATUSES and row.seat_numbers and row.travel_date >= today:
+            seats.setdefault((row.slot_id, row.travel_date, row.seat_type_id), []).append(row.seat_numbers)
+    for (slot_id, travel_date, seat_type_id), numbers in seats.items():
+        release_seats(db.session, slot_id, travel_date, seat_type_id, ','.join(numbers))
+    db.session.execute(insert(BookingEvent), [
+        booking_event('cancelled', row, amount=charges[row.id], status='cancelled') for row in rows
+    ])
+    booking_details.invalidate(ids)
+    db.session.info.setdefault('after_chunk', []).append(
+        lambda: _service_cancelled(rows, charges, params.get('reason'))
+    )
+    return ids
+
+
+def _service_cancelled(rows, charges, reason):
+    """Side effects of a committed cancel_service chunk."""
+    seat_feed.publish({(row.slot_id, row.travel_date) for row in rows})
+    for row in rows:
+        if row.status == 'paid':
+            record_paid_booking(row, sign=-1)
+        # Queued: the mail thread sends them MAIL_BATCH_SIZE to an SMTP connection
+        send_cancellation_email(row.email, row.name, row.id, f"{row.departure_city} → {row.arrival_city}",
+                                row.travel_date.strftime('%Y-%m-%d'), charges[row.id], reason)
+
+
+MAINTENANCE_TASKS = {
+    'archive_bookings': _archive_bookings_chunk,
+    'delete_user': _delete_user_chunk,
+    'clear_cancelled': _clear_cancelled_chunk,
+    'cancel_service': _cancel_service_chunk,
+}
+
+_maintenance_lock = threading.Lock()
+
+
+def enqueue_maintenance_job(kind, start_worker=True, total=None, **params):
+    job = MaintenanceJob(kind=kind, params=json.dumps(params, default=str), total=total)
+    db.session.add(job)
+    db.session.commit()
+    if start_worker:
+        start_maintenance_worker()
+    return job
+
+
+def claim_maintenance_job(job_id, stale_after=None):
+    """Mark a job as running; only one worker can win. Stale running jobs can be re-claimed."""
+    claimable = MaintenanceJob.status == 'pending'
+    if stale_after is not None:
+        claimable = db.or_(claimable, db.and_(
+            MaintenanceJob.status == 'running',
+            MaintenanceJob.updated_at < datetime.utcnow() - timedelta(seconds=stale_after)
+        ))
+    result = db.session.execute(
+        update(MaintenanceJob).where(MaintenanceJob.id == job_id, claimable)
+        .values(status='running', updated_at=datetime.utcnow())
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def run_maintenance_job(job_id, chunk_size=None, pause=None, progress=None):
+    """Work through a claimed job chunk by chunk until it is done."""
+    chunk_size = chunk_size or app.config.get('MAINTENANCE_CHUNK_SIZE', 500)
+    pause = app.config.get('MAINTENANCE_PAUSE_SECONDS', 0.2) if pause is None else pause
+
+    job = db.session.get(MaintenanceJob, job_id)
+    task = MAINTENANCE_TASKS[job.kind]
+    params = json.loads(job.params or '{}')
+
+    try:
+        while True:
+            ids = task(job, params, chunk_size)
+            job.updated_at = datetime.utcnow()
+            if not ids:
+                job.status = 'done'
+                job.finished_at = job.updated_at
+                db.session.commit()
+                break
+
+            job.processed += len(ids)
+            job.last_id = max(ids)
+            db.session.commit()
+            for callback in db.session.info.pop('after_chunk', []):
+                callback()
+            if progress:
+                progress(job)
+            time.sleep(pause)
+    except Exception as e:
+        db.session.rollback()
+        db.session.info.pop('after_chunk', None)
+        job = db.session.get(MaintenanceJob, job_id)
+        job.status = 'failed'
+        job.error = str(e)
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+        traceback.print_exc()
+    return job
+
+
+def run_pending_maintenance_jobs(stale_after=None, **kwargs):
+    ran = []
+    while True:
+        candidates = db.select(MaintenanceJob.id).order_by(MaintenanceJob.id)
+        if stale_after is None:
+            candidates = candidates.where(MaintenanceJob.status == 'pending')
+        else:
+            candidates = candidates.where(MaintenanceJob.status.in_(('pending', 'running')))
+        job_id = next((jid for jid in db.session.scalars(candidates)
+                       if claim_maintenance_job(jid, stale_after)), None)
+        if job_id is None:
+            return ran
+        ran.append(run_maintenance_job(job_id, **kwargs))
+
+
+def enqueue_service_cancellation(journey_id=None, slot_id=None, date_from=None, date_to=None, reason=None,
+                                 start_worker=True):
+    """Queue a cancel_service job for a slot or a whole journey. Returns ``(error, job)``."""
+    if slot_id:
+        slot = db.session.get(JourneySlot, slot_id)
+        if slot is None or (journey_id and slot.journey_id != journey_id):
+            return "No such slot on that journey.", None
+        journey_id = slot.journey_id
+    elif not journey_id or db.session.get(Journey, journey_id) is None:
+        return "Pick a journey or a slot.", None
+    if date_from is None:
+        return "Pick the travel date.", None
+    date_to = date_to or date_from
+    if date_to < date_from:
+        return "The end date is before the start date.", None
+
+    params = {'journey_id': journey_id, 'slot_id': slot_id, 'date_from': date_from.isoformat(),
+              'date_to': date_to.isoformat(), 'reason': reason or None}
+    total = db.session.scalar(db.select(func.count(Booking.id)).where(disrupted_bookings(params)))
+    return None, enqueue_maintenance_job('cancel_service', start_worker=start_worker, total=total, **params)
+
+
+def start_maintenance_worker():
+    """Run pending jobs on a background thread (one per process)."""
+    if not _maintenance_lock.acquire(blocking=False):
+        return False
+
+    def work():
+        while True:
+            try:
+                with app.app_context():
+                    run_pending_maintenance_jobs()
+            finally:
+                _maintenance_lock.release()
+            # A job enqueued after our last check but before the release found the worker
+            # busy and didn't start one; pick it up instead of leaving it pending
+            with app.app_context():
+                pending = db.session.scalar(
+                    db.select(MaintenanceJob.id).where(MaintenanceJob.status == 'pending').limit(1))
+            if pending is None or not _maintenance_lock.acquire(blocking=False):
+                return
+
+    threading.Thread(target=work, name='maintenance-worker', daemon=True).start()
+    return True
+
+
+@app.route('/admin/maintenance', methods=['GET', 'POST'])
+@admin_required
+def maintenance_dashboard():
+    error = None
+    if request.method == 'POST':
+        action = request.form.get('action')
+        if action == 'archive':
+            days = int(request.form.get('retention_days') or app.config.get('BOOKING_RETENTION_DAYS', 365))
+            enqueue_maintenance_job('archive_bookings', before=(date.today() - timedelta(days=days)).isoformat())
+        elif action == 'cancel_service':
+            try:
+                date_from = date.fromisoformat(request.form['date_from'])
+                date_to = date.fromisoformat(request.form['date_to']) if request.form.get('date_to') else None
+            except (KeyError, ValueError):
+                date_from = date_to = None
+            error, _ = enqueue_service_cancellation(
+                request.form.get('journey_id', type=int), request.form.get('slot_id', type=int),
+                date_from, date_to, request.form.get('reason', '').strip()
+            )
+        else:
+            start_maintenance_worker()
+        if not error:
+            return redirect('/admin/maintenance')
+
+    jobs = MaintenanceJob.query.order_by(MaintenanceJob.id.desc()).limit(50).all()
+    return render_template('admin_maintenance.html', jobs=jobs, error=error, form=request.form,
+                           journeys=Journey.query.order_by(Journey.departure_city, Journey.arrival_city).all(),
+                           retention_days=app.config.get('BOOKING_RETENTION_DAYS', 365))
+
+
+@app.route('/admin/profiles')
+@admin_required
+def profiles_dashboard():
+    per_route = int(request.args.get('per_route', 5))
+    routes = {}
+    for profile in list_profiles():
+        routes.setdefault((profile['method'], profile['route']), []).append(profile)
+    slowest = sorted(
+        ((method, route, len(runs), sorted(runs, key=lambda p: p['ms'], reverse=True)[:per_route])
+         for (method, route), runs in routes.items()),
+        key=lambda row: row[3][0]['ms'], reverse=True
+    )
+    return render_template('admin_profiles.html', routes=slowest, per_route=per_route,
+                           sample_every=app.config.get('PROFILE_SAMPLE_EVERY', 0),
+                           profiler='pyinstrument' if InstrumentProfiler is not None else 'stack sampler')
+
+
+@app.route('/admin/profiles/<path:name>')
+@admin_required
+def view_profile(name):
+    if not _PROFILE_NAME.fullmatch(name):
+        return "Profile not found", 404
+    return send_from_directory(profile_dir(), name, as_attachment=name.endswith('.json'))
+
+
+@app.cli.group()
+def maintenance():
+    """Archive old bookings and run chunked maintenance jobs."""
+
+
+def _echo_progress(job):
+    done = f"{job.processed}/{job.total}" if job.total is not None else job.processed
+    click.echo(f"job {job.id} ({job.kind}): {done} rows, last id {job.last_id}")
+
+
+@maintenance.command('archive')
+@click.option('--days', type=int, help='Retention window; defaults to BOOKING_RETENTION_DAYS.')
+@click.option('--chunk-size', type=int, help='Defaults to MAINTENANCE_CHUNK_SIZE.')
+@click.option('--pause', type=float, help='Seconds between chunks; defaults to MAINTENANCE_PAUSE_SECONDS.')
+def maintenance_archive(days, chunk_size, pause):
+    """Move bookings that travelled before the retention window to bookings_archive."""
+    days = days or app.config.get('BOOKING_RETENTION_DAYS', 365)
+    job = enqueue_maintenance_job('archive_bookings', start_worker=False,
+                                  before=(date.today() - timedelta(days=days)).isoformat())
+    if claim_maintenance_job(job.id):
+        job = run_maintenance_job(job.id, chunk_size, pause, progress=_echo_progress)
+    click.echo(f"job {job.id}: {job.status}, {job.processed} booking(s) archived")
+
+
+@maintenance.command('cancel-service')
+@click.option('--journey', 'journey_id', type=int, help='Cancel every slot of this journey.')
+@click.option('--slot', 'slot_id', type=int, help='Cancel only this slot.')
+@click.option('--date', 'date_from', type=click.DateTime(['%Y-%m-%d']), required=True, help='Travel date (or first date).')
+@click.option('--to', 'date_to', type=click.DateTime(['%Y-%m-%d']), help='Last travel date; defaults to --date.')
+@click.option('--reason', help='Added to the e-mail each customer gets.')
+@click.option('--chunk-size', type=int, help='Defaults to MAINTENANCE_CHUNK_SIZE.')
+@click.option('--pause', type=float, help='Seconds between chunks; defaults to MAINTENANCE_PAUSE_SECONDS.')
+def maintenance_cancel_service(journey_id, slot_id, date_from, date_to, reason, chunk_size, pause):
+    """Cancel every booking on a disrupted slot or journey, charging per the cancellation rules."""
+    error, job = enqueue_service_cancellation(journey_id, slot_id, date_from.date(),
+                                              date_to.date() if date_to else None, reason, start_worker=False)
+    if error:
+        raise click.ClickException(error)
+    click.echo(f"job {job.id}: {job.total} booking(s) to cancel")
+    if claim_maintenance_job(job.id):
+        job = run_maintenance_job(job.id, chunk_size, pause, progress=_echo_progress)
+    mail_queue.wait()
+    click.echo(f"job {job.id}: {job.status}, {job.processed} booking(s) cancelled")
+
+
+@maintenance.command('run')
+@click.option('--resume-after', default=300, show_default=True,
+              help='Also resume running jobs with no progress for this many seconds.')
+@click.option('--chunk-size', type=int)
+@click.option('--pause', type=float)
+def maintenance_run(resume_after, chunk_size, pause):
+    """Run pending jobs and resume interrupted ones."""
+    jobs = run_pending_maintenance_jobs(stale_after=resume_after, chunk_size=chunk_size, pause=pause,
+                                        progress=_echo_progress)
+    for job in jobs:
+        click.echo(f"job {job.id} ({job.kind}): {job.status}, {job.processed} row(s)")
+    if not jobs:
+        click.echo("No jobs to run.")
+
+
+@maintenance.command('status')
+def maintenance_status():
+    """List recent maintenance jobs."""
+    for job in MaintenanceJob.query.order_by(MaintenanceJob.id.desc()).limit(20):
+        click.echo(f"{job.id:>5} {job.kind:<18} {job.status:<8} {job.processed:>8} rows  "
+                   f"updated {job.updated_at:%Y-%m-%d %H:%M:%S}" + (f"  error: {job.error}" if job.error else ""))
+
+
+# Columns added to existing tables after they were first created:
+# (table, column, DDL type and default)
+SCHEMA_COLUMNS = [
+    ('bookings', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('bookings', 'seat_numbers', 'VARCHAR(255)'),
+    ('bookings_archive', 'version', 'INTEGER'),
+    ('bookings_archive', 'seat_numbers', 'VARCHAR(255)'),
+    ('journeys', 'departure_city_id', 'INTEGER'),
+    ('journeys', 'arrival_city_id', 'INTEGER'),
+    ('maintenance_jobs', 'total', 'INTEGER'),
+]
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create any tables that don't exist yet and add missing columns."""
+    db.create_all()
+    inspector = db.inspect(db.engine)
+    for table, column, ddl in SCHEMA_COLUMNS:
+        if column not in {c['name'] for c in inspector.get_columns(table)}:
+            db.session.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+            db.session.commit()
+            click.echo(f"Added {table}.{column}")
+    upgrade_journey_cities()
+    click.echo("Database schema is up to date.")
+
+
+def upgrade_journey_cities():
+    """Backfill journey city ids, then add the route index and (on MySQL) the foreign keys."""
+    linked = backfill_journey_cities()
+    if linked:
+        click.echo(f"Linked {linked} journey(s) to cities")
+
+    inspector = db.inspect(db.engine)
+    route_index = next(i for i in Journey.__table__.indexes if i.name == 'ix_journeys_route')
+    if route_index.name not in {i['name'] for i in inspector.get_indexes('journeys')}:
+        duplicates = duplicate_routes()
+        if duplicates:
+            for journey_ids in duplicates:
+                click.echo(f"⚠️ Journeys {', '.join(map(str, journey_ids))} run the same route")
+            click.echo("Not adding ix_journeys_route: merge or delete the duplicates and run upgrade-db again.")
+        else:
+            route_index.create(db.engine)
+            click.echo("Added index ix_journeys_route")
+
+    if db.engine.dialect.name == 'mysql':  # SQLite can't add a foreign key to an existing table
+        keyed = {fk['constrained_columns'][0] for fk in inspector.get_foreign_keys('journeys')}
+        for column in ('departure_city_id', 'arrival_city_id'):
+            if column not in keyed:
+                db.session.execute(db.text(f"ALTER TABLE journeys ADD FOREIGN KEY ({column}) REFERENCES cities (id)"))
+                db.session.commit()
+                click.echo(f"Added foreign key journeys.{column}")
+
+
 # ✅ MOVE THIS TO THE END!
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,336 @@
+# asgi.py
+#
+# ASGI entry point. The JSON endpoints the booking pages call most
+# (/api/slots/<id>, /confirm-booking, /add-to-cart, /register) are served
+# by asyncio handlers on SQLAlchemy's async engine, so a worker keeps
+# serving other requests while these wait on the database. Everything else
+# is passed through to the Flask app unchanged.
+#
+#     uvicorn asgi:application --workers 4
+#
+# Sessions, idempotency keys, rate limits, live seat updates, leaderboards
+# and receipt e-mails behave exactly as on the Flask routes.
+import asyncio
+import contextvars
+import json
+import math
+import re
+import time
+import traceback
+from datetime import datetime, timedelta
+from http import HTTPStatus
+from http.cookies import SimpleCookie
+
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.security import generate_password_hash
+
+from app import (
+    app as flask_app, db, Booking, IdempotencyKey, JourneySlot, User, add_booking, booking_from_json,
+    booking_saved, parse_seat_numbers, rate_limit_wait, send_thank_you_email, _idempotency_request_hash,
+)
+
+ASYNC_DRIVERS = {
+    'mysql': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_database_uri():
+    uri = flask_app.config.get('ASYNC_DATABASE_URI')
+    if uri:
+        return uri
+    url = make_url(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+
+def _engine_options(uri):
+    url = make_url(uri)
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            return {}
+        return {'pool_size': flask_app.config.get('ASYNC_POOL_SIZE', 20)}
+    return {'pool_size': flask_app.config.get('ASYNC_POOL_SIZE', 20), 'pool_recycle': 3600, 'pool_pre_ping': True}
+
+
+_uri = async_database_uri()
+engine = create_async_engine(_uri, **_engine_options(_uri))
+Session = async_sessionmaker(engine, expire_on_commit=False)
+flask_asgi = WsgiToAsgi(flask_app)
+
+
+# Request / response plumbing
+class Request:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.body = body
+        self.headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+        self.remote_addr = (scope.get('client') or ('', 0))[0]
+
+    def json(self):
+        try:
+            return json.loads(self.body or b'null')
+        except ValueError:
+            return None
+
+    def session(self):
+        """The Flask session, read from the same signed cookie the Flask app uses."""
+        cookie = SimpleCookie(self.headers.get('cookie', ''))
+        morsel = cookie.get(flask_app.config.get('SESSION_COOKIE_NAME', 'session'))
+        if morsel is None:
+            return {}
+        serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        try:
+            return serializer.loads(morsel.value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return {}
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_response(send, status, body, headers=None):
+    payload = body if isinstance(body, (bytes, str)) else json.dumps(body)
+    payload = payload.encode() if isinstance(payload, str) else payload
+    raw_headers = [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode())]
+    raw_headers += [(k.lower().encode(), str(v).encode()) for k, v in (headers or {}).items()]
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+def run_in_flask(fn, *args):
+    """Run sync app code (publishers, PDF receipts) on a worker thread inside an app context."""
+    def call():
+        with flask_app.app_context():
+            return fn(*args)
+    return asyncio.to_thread(call)
+
+
+# Idempotency (same table and rules as the ``idempotent`` decorator)
+_last_purge = 0.0
+# Set once a handler has committed its change (see app.mark_committed)
+committed = contextvars.ContextVar('committed', default=False)
+
+
+async def purge_expired_idempotency_keys(session):
+    global _last_purge
+    now = time.monotonic()
+    if now - _last_purge < 60:
+        return
+    _last_purge = now
+    cutoff = datetime.utcnow() - timedelta(hours=flask_app.config.get('IDEMPOTENCY_TTL_HOURS', 24))
+    await session.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < cutoff))
+    await session.commit()
+
+
+async def idempotent(request, user_id, endpoint, payload, handler):
+    key = request.headers.get('idempotency-key') or (payload or {}).get('idempotency_key')
+    if not key or user_id is None:
+        return await handler()
+    if len(key) > 100:
+        return 400, {'success': False, 'message': 'Idempotency-Key too long'}, {}
+
+    request_hash = _idempotency_request_hash(payload or {})
+    in_progress = 409, {'success': False, 'message': 'Request in progress, retry shortly'}, {'Retry-After': '1'}
+    async with Session() as session:
+        await purge_expired_idempotency_keys(session)
+        record = IdempotencyKey(user_id=user_id, endpoint=endpoint, key=key, request_hash=request_hash)
+        session.add(record)
+        try:
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            existing = (await session.execute(select(IdempotencyKey).where(
+                IdempotencyKey.user_id == user_id, IdempotencyKey.endpoint == endpoint, IdempotencyKey.key == key
+            ))).scalar_one_or_none()
+            if existing is None or existing.status_code is None:
+                return in_progress
+            if existing.request_hash != request_hash:
+                return 422, {'success': False, 'message': 'Idempotency-Key reused for a different request'}, {}
+            return existing.status_code, existing.response_body, {'Idempotent-Replayed': 'true'}
+
+        record_id = record.id
+        committed.set(False)
+        try:
+            status, body, headers = await handler()
+        except Exception:
+            if committed.get():
+                status, body, headers = 500, {'success': False, 'message': 'Internal server error'}, {}
+            else:
+                await session.execute(delete(IdempotencyKey).where(IdempotencyKey.id == record_id))
+                await session.commit()
+                raise
+
+        if status >= 500 and not committed.get():
+            # Let the client retry failures instead of replaying them, unless something was
+            # committed: a retry would then do it twice
+            await session.execute(delete(IdempotencyKey).where(IdempotencyKey.id == record_id))
+        else:
+            await session.execute(update(IdempotencyKey).where(IdempotencyKey.id == record_id)
+                                  .values(status_code=status, response_body=json.dumps(body)))
+        await session.commit()
+        return status, body, headers
+
+
+# Handlers: each returns (status, JSON body, extra headers)
+async def slots_for_journey(request, journey_id, user_id):
+    async with Session() as session:
+        rows = await session.execute(
+            select(JourneySlot.id, JourneySlot.departure_time, JourneySlot.arrival_time)
+            .where(JourneySlot.journey_id == journey_id)
+        )
+        return 200, [
+            {'id': slot_id, 'departure_time': departs.strftime('%H:%M'), 'arrival_time': arrives.strftime('%H:%M')}
+            for slot_id, departs, arrives in rows
+        ], {}
+
+
+async def _save_booking(user_id, data, status):
+    """Insert (and, if paid, seat) a booking; returns ``(error, booking)``."""
+    wanted = parse_seat_numbers(data.get('seat_numbers'))
+    retries = flask_app.config.get('BOOKING_UPDATE_RETRIES', 3)
+    for attempt in range(retries):
+        booking = booking_from_json(user_id, data, status)
+        async with Session() as session:
+            try:
+                error = await session.run_sync(add_booking, booking, wanted)
+                if error:
+                    await session.rollback()
+                    return error, None
+                await session.commit()
+                committed.set(True)
+                break
+            except StaleDataError:  # a seat map changed under us
+                await session.rollback()
+                if attempt == retries - 1:
+                    raise
+    await run_in_flask(lambda booking_id: booking_saved(db.session.get(Booking, booking_id)), booking.id)
+    return None, booking
+
+
+async def confirm_booking(request, user_id):
+    if user_id is None:
+        return 401, {'success': False, 'message': 'Unauthorized'}, {}
+    data = request.json()
+    if not data:
+        return 400, {'success': False, 'message': 'Invalid data'}, {}
+
+    async def handler():
+        try:
+            is_pay_later = data.get('pay_later') == 'true'
+            if not data.get('slot_id') or not data.get('seats_booked'):
+                return 400, {'success': False, 'message': 'Missing slot or seat count'}, {}
+            error, booking = await _save_booking(user_id, data, 'unpaid' if is_pay_later else 'paid')
+            if error:
+                return 409, {'success': False, 'message': error}, {}
+            if is_pay_later:
+                return 200, {'success': True, 'redirect_url': '/cart'}, {}
+            return 200, {'success': True, 'redirect_url': f'/receipt/{booking.id}'}, {}
+        except StaleDataError:
+            return 409, {'success': False, 'message': 'Seats are changing fast, please try again.'}, {}
+        except Exception as e:
+            traceback.print_exc()
+            return 500, {'success': False, 'message': str(e)}, {}
+
+    return await idempotent(request, user_id, 'confirm_booking', data, handler)
+
+
+async def add_to_cart(request, user_id):
+    if user_id is None:
+        return 401, {'success': False, 'message': 'Unauthorized'}, {}
+    data = request.json()
+
+    async def handler():
+        try:
+            await _save_booking(user_id, data, 'unpaid')
+            return 200, {'success': True}, {}
+        except Exception as e:
+            return 500, {'success': False, 'message': str(e)}, {}
+
+    return await idempotent(request, user_id, 'add_to_cart', data, handler)
+
+
+async def register(request, user_id):
+    data = request.json() or {}
+    name, email, password = data.get('name'), data.get('email'), data.get('password')
+    if not name or not email or not password:
+        return 400, {'success': False, 'message': 'Missing fields'}, {}
+
+    email_taken = 409, {'success': False, 'redirect': '/email-exists'}, {}
+    async with Session() as session:
+        if await session.scalar(select(func.count(User.id)).where(User.email == email)):
+            return email_taken
+        password_hash = await asyncio.to_thread(generate_password_hash, password)  # CPU-bound
+        try:
+            await session.execute(insert(User).values(name=name, email=email, password=password_hash))
+            await session.commit()
+        except IntegrityError:
+            return email_taken
+
+    send_thank_you_email(email, name)  # queued, doesn't wait on SMTP
+    return 200, {'success': True}, {}
+
+
+# (method, path pattern, Flask endpoint name used for rate limits, handler)
+ROUTES = [
+    ('GET', re.compile(r'/api/slots/(\d+)'), 'get_slots_for_journey', slots_for_journey),
+    ('POST', re.compile(r'/confirm-booking'), 'confirm_booking', confirm_booking),
+    ('POST', re.compile(r'/add-to-cart'), 'add_to_cart', add_to_cart),
+    ('POST', re.compile(r'/register'), 'register', register),
+]
+
+
+def match_route(method, path):
+    for route_method, pattern, endpoint, handler in ROUTES:
+        match = pattern.fullmatch(path)
+        if match and method == route_method:
+            return endpoint, handler, match.groups()
+    return None
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    route = match_route(scope.get('method'), scope.get('path', '')) if scope['type'] == 'http' else None
+    if route is None:
+        return await flask_asgi(scope, receive, send)
+
+    endpoint, handler, args = route
+    request = Request(scope, await read_body(receive))
+    user_id = request.session().get('user_id')
+
+    wait = await asyncio.to_thread(rate_limit_wait, endpoint, request.method, user_id, request.remote_addr)
+    if wait:
+        return await send_response(send, HTTPStatus.TOO_MANY_REQUESTS,
+                                   {'success': False, 'message': 'Too many requests, please slow down.'},
+                                   {'Retry-After': str(math.ceil(wait))})
+
+    try:
+        status, body, headers = await handler(request, *(int(a) for a in args), user_id)
+    except Exception:
+        traceback.print_exc()
+        status, body, headers = 500, {'success': False, 'message': 'Internal server error'}, {}
+    await send_response(send, status, body, headers)
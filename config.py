@@ -3,6 +3,88 @@
 SQLALCHEMY_DATABASE_URI = 'mysql+pymysql://root@localhost/ht_booking'
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SECRET_KEY = 'your_secret_key'
+# Query monitor (always on in debug mode, set True to force it on e.g. in CI)
+QUERY_MONITOR = False
+SLOW_QUERY_MS = 100
+N_PLUS_ONE_THRESHOLD = 5
+# How long booking idempotency keys are kept for replays
+IDEMPOTENCY_TTL_HOURS = 24
+# Connection search: minimum minutes between legs
+ROUTE_MIN_CONNECTION_MINUTES = 30
+# Rate limits per endpoint: (burst, requests per minute) per user and per IP.
+# Buckets are kept in a SQLite file shared by all workers on the host
+# (defaults to instance/ratelimit.sqlite).
+RATE_LIMIT_ENABLED = True
+RATE_LIMIT_STORE = None
+RATE_LIMITS = {
+    'download_receipt': {'per_user': (10, 10), 'per_ip': (30, 30)},
+    'confirm_booking': {'per_user': (5, 5), 'per_ip': (20, 20)},
+    'register': {'methods': ['POST'], 'per_ip': (3, 1)},
+    'profile': {'methods': ['POST'], 'per_user': (3, 1), 'per_ip': (10, 5)},
+}
+# Gzip dynamic HTML/JSON responses (leave off when a proxy already compresses)
+COMPRESS_RESPONSES = False
+COMPRESS_MIN_SIZE = 500
+COMPRESS_LEVEL = 6
+# Compiled Jinja templates shared by all workers (defaults to instance/jinja_cache)
+JINJA_BYTECODE_CACHE_DIR = None
+# Maintenance jobs: bookings older than this are moved to bookings_archive,
+# and large deletes run in chunks with a pause between them
+BOOKING_RETENTION_DAYS = 365
+MAINTENANCE_CHUNK_SIZE = 500
+MAINTENANCE_PAUSE_SECONDS = 0.2
+# Live seat availability (SSE): keep-alive interval for idle streams, and how
+# often watched slots are re-read to pick up writes from other processes
+# (0 disables the refresh)
+SEAT_FEED_HEARTBEAT_SECONDS = 15
+SEAT_FEED_REFRESH_SECONDS = 10
+# Live leaderboards: entries per list, how often the admin page refreshes,
+# how often the counters are rebuilt from bookings and snapshotted
+LEADERBOARD_SIZE = 10
+LEADERBOARD_POLL_SECONDS = 5
+LEADERBOARD_REBUILD_SECONDS = 600
+LEADERBOARD_PERSIST_SECONDS = 30
+# Booking detail cache (receipts, booking search, receipt e-mails)
+BOOKING_DETAIL_CACHE_SIZE = 10000
+BOOKING_DETAIL_TTL_SECONDS = 60
+# Booking changes are compare-and-swap updates; how often to retry on a conflict
+BOOKING_UPDATE_RETRIES = 3
+# Async serving (asgi.py): defaults to SQLALCHEMY_DATABASE_URI with the
+# async driver (aiomysql / aiosqlite)
+ASYNC_DATABASE_URI = None
+ASYNC_POOL_SIZE = 20
+# Outgoing mail is sent by a background thread, up to MAIL_BATCH_SIZE
+# messages per SMTP connection (False = send inline)
+MAIL_QUEUE_ENABLED = True
+MAIL_BATCH_SIZE = 20
+# Request profiler: admins add ?profile=1 (or an X-Profile: 1 header) to
+# profile a request; PROFILE_SAMPLE_EVERY = N also profiles 1 in N requests
+# (0 = off). The newest PROFILE_MAX_FILES profiles are kept in PROFILE_DIR
+# (defaults to instance/profiles).
+PROFILER_ENABLED = True
+PROFILE_SAMPLE_EVERY = 0
+PROFILE_INTERVAL_MS = 1
+PROFILE_DIR = None
+PROFILE_MAX_FILES = 200
+# Booking event log: one writer thread per process commits queued events in
+# batches (up to BOOKING_EVENTS_BATCH_SIZE rows, waiting BOOKING_EVENTS_LINGER_MS
+# for more); False = each request commits its own. Readers skip events newer
+# than BOOKING_EVENTS_SETTLE_SECONDS so offsets are never passed over.
+BOOKING_EVENTS_GROUP_COMMIT = True
+BOOKING_EVENTS_BATCH_SIZE = 500
+BOOKING_EVENTS_LINGER_MS = 2
+BOOKING_EVENTS_TIMEOUT_SECONDS = 5
+BOOKING_EVENTS_SETTLE_SECONDS = 2
+# Seat maps: seats per seat type on every slot (by seat type name; they add up
+# to the slot's capacity, and types not listed can't be sold) and seats per row.
+# Blocks of adjacent seats are kept within one row.
+SEAT_MAP_LAYOUT = {'Economy': 100, 'Business': 28, 'First': 12}
+SEAT_MAP_ROW_WIDTH = 4
+# Cache invalidation bus: how often each worker checks cache_versions for
+# admin edits made in other workers or on other nodes (0 = every request)
+CACHE_BUS_POLL_SECONDS = 1
+# Reports overview: how many reports run at once (each holds a DB connection)
+REPORT_WORKERS = 4
 # Email settings
 MAIL_SERVER = 'smtp.gmail.com'
 MAIL_PORT = 587
@@ -0,0 +1,95 @@
+import itertools
+import os
+import sys
+import tempfile
+from datetime import date, time, timedelta
+
+import pytest
+from werkzeug.security import generate_password_hash
+
+# The app builds its engine at import time, so point it at a throwaway SQLite
+# database (and a mail server that refuses connections) before importing it
+_tmp = tempfile.mkdtemp(prefix='booking-tests-')
+_settings = os.path.join(_tmp, 'settings.py')
+with open(_settings, 'w') as f:
+    f.write(f"""
+TESTING = True
+SQLALCHEMY_DATABASE_URI = 'sqlite:///{os.path.join(_tmp, 'test.db')}'
+RATE_LIMIT_ENABLED = False
+RATE_LIMIT_STORE = {os.path.join(_tmp, 'ratelimit.sqlite')!r}
+JINJA_BYTECODE_CACHE_DIR = {os.path.join(_tmp, 'jinja_cache')!r}
+PROFILE_DIR = {os.path.join(_tmp, 'profiles')!r}
+MAIL_SERVER = '127.0.0.1'
+MAIL_PORT = 1
+""")
+os.environ['APP_SETTINGS'] = _settings
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as booking_app  # noqa: E402
+
+_dates = itertools.count(10)
+
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app = booking_app.app
+    db = booking_app.db
+    with flask_app.app_context():
+        db.create_all()
+        db.session.add_all([
+            booking_app.User(name='Una', email='user@example.com', password=generate_password_hash('pw')),
+            booking_app.User(name='Ada', email='admin@example.com', password=generate_password_hash('pw'),
+                             role='admin'),
+        ])
+        for name, multiplier in [('Economy', 1.0), ('Business', 1.5), ('First', 2.0)]:
+            db.session.add(booking_app.SeatType(type_name=name, multiplier=multiplier))
+        for days, charge in [(60, 0), (30, 40), (0, 100)]:
+            db.session.add(booking_app.Cancellation(days_before=days, charge_percent=charge))
+        journey = booking_app.Journey(departure_city='Bristol', arrival_city='Manchester', base_fare=80)
+        db.session.add(journey)
+        db.session.flush()
+        db.session.add(booking_app.JourneySlot(journey_id=journey.id, departure_time=time(8),
+                                               arrival_time=time(9, 30), available_seats=140))
+        db.session.commit()
+        booking_app.backfill_journey_cities()
+    return flask_app
+
+
+@pytest.fixture
+def ctx(app):
+    with app.app_context():
+        yield
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    response = client.post('/login', data={'email': 'user@example.com', 'password': 'pw'})
+    assert response.status_code == 302
+    return client
+
+
+@pytest.fixture
+def travel_date():
+    """A date no other test books on, so seat maps and seat counts start empty."""
+    return date.today() + timedelta(days=next(_dates))
+
+
+@pytest.fixture
+def make_booking(ctx):
+    """Insert a booking for the test user and return its id."""
+    def make(travel_date, status='unpaid', seats=1, seat_type_id=1, seat_numbers=None):
+        booking = booking_app.Booking(user_id=1, journey_id=1, slot_id=1, seat_type_id=seat_type_id,
+                                      travel_date=travel_date, final_price=80.0, seats_booked=seats,
+                                      status=status, seat_numbers=seat_numbers)
+        booking_app.db.session.add(booking)
+        booking_app.db.session.commit()
+        return booking.id
+    return make
+
+
+def booking_json(travel_date, **extra):
+    payload = {'journey_id': 1, 'slot_id': 1, 'seat_type_id': 1, 'travel_date': travel_date.isoformat(),
+               'final_price': 80.0, 'seats_booked': 1}
+    payload.update(extra)
+    return payload
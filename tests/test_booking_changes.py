@@ -0,0 +1,94 @@
+import pytest
+from sqlalchemy import update
+from sqlalchemy.orm.exc import StaleDataError
+
+import app as booking_app
+from app import Booking, _compare_and_swap, _fresh_booking, db, retry_on_conflict
+
+
+def bump_version(booking_id):
+    """Change and commit the booking on another connection, as a concurrent request would."""
+    with db.engine.begin() as conn:
+        conn.execute(update(Booking).where(Booking.id == booking_id).values(version=Booking.version + 1))
+
+
+def test_compare_and_swap_applies_and_bumps_version(ctx, make_booking, travel_date):
+    booking = _fresh_booking(make_booking(travel_date))
+    assert _compare_and_swap(booking, {'status': 'paid'}, Booking.status == 'unpaid') is True
+    booking = _fresh_booking(booking.id)
+    assert (booking.status, booking.version) == ('paid', 2)
+
+
+def test_compare_and_swap_returns_false_when_a_condition_fails(ctx, make_booking, travel_date):
+    booking = _fresh_booking(make_booking(travel_date, status='cancelled'))
+    assert _compare_and_swap(booking, {'status': 'paid'}, Booking.status == 'unpaid') is False
+    assert _fresh_booking(booking.id).version == 1
+
+
+def test_compare_and_swap_raises_on_a_concurrent_change(ctx, make_booking, travel_date):
+    booking = _fresh_booking(make_booking(travel_date))
+    bump_version(booking.id)
+    with pytest.raises(StaleDataError):
+        _compare_and_swap(booking, {'status': 'paid'})
+    assert _fresh_booking(booking.id).status == 'unpaid'
+
+
+def test_retry_on_conflict_retries_until_the_swap_lands(ctx, make_booking, travel_date):
+    booking_id = make_booking(travel_date)
+    attempts = []
+
+    def attempt():
+        booking = _fresh_booking(booking_id)
+        attempts.append(booking.version)
+        if len(attempts) == 1:
+            bump_version(booking_id)
+        return _compare_and_swap(booking, {'status': 'paid'})
+
+    assert retry_on_conflict(attempt) is True
+    assert attempts == [1, 2]
+    assert _fresh_booking(booking_id).version == 3
+
+
+def test_retry_on_conflict_gives_up_after_the_configured_retries(ctx, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'BOOKING_UPDATE_RETRIES', 2)
+    calls = []
+
+    def attempt():
+        calls.append(1)
+        raise StaleDataError('always stale')
+
+    with pytest.raises(StaleDataError):
+        retry_on_conflict(attempt)
+    assert len(calls) == 2
+
+
+def test_cancel_booking_retries_after_a_concurrent_change(client, make_booking, travel_date, monkeypatch):
+    booking_id = make_booking(travel_date, status='paid')
+    release_seats = booking_app.release_seats
+    calls = []
+
+    def release_then_race(*args):
+        release_seats(*args)
+        if not calls:
+            bump_version(booking_id)  # after the attempt read the booking, before its swap
+        calls.append(1)
+
+    monkeypatch.setattr(booking_app, 'release_seats', release_then_race)
+    response = client.post(f'/cancel-booking/{booking_id}')
+    assert response.status_code == 200
+    assert len(calls) == 2
+    booking = _fresh_booking(booking_id)
+    assert booking.status == 'cancelled'
+
+
+def test_cancel_booking_twice_is_a_conflict(client, make_booking, travel_date):
+    booking_id = make_booking(travel_date, status='paid')
+    assert client.post(f'/cancel-booking/{booking_id}').status_code == 200
+    response = client.post(f'/cancel-booking/{booking_id}')
+    assert response.status_code == 409
+    assert _fresh_booking(booking_id).version == 2
+
+
+def test_missing_bookings_are_not_found(client):
+    assert client.post('/cancel-booking/999999').status_code == 404
+    assert client.get('/update-booking/999999').status_code == 404
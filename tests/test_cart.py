@@ -0,0 +1,54 @@
+from sqlalchemy import update
+
+import app as booking_app
+from app import Booking, _fresh_booking, db
+
+
+def test_checkout_pays_and_seats_the_whole_cart(client, make_booking, travel_date):
+    ids = [make_booking(travel_date, seats=2), make_booking(travel_date, seats=1)]
+    response = client.post('/checkout')
+
+    assert response.status_code == 302
+    bookings = [_fresh_booking(booking_id) for booking_id in ids]
+    assert [b.status for b in bookings] == ['paid', 'paid']
+    assert [b.version for b in bookings] == [2, 2]
+    seats = [n for b in bookings for n in b.seat_numbers.split(',')]
+    assert len(seats) == len(set(seats)) == 3
+
+
+def test_checkout_of_selected_bookings_leaves_the_rest(client, make_booking, travel_date):
+    paid, left = make_booking(travel_date), make_booking(travel_date)
+    client.post('/checkout', data={'mode': 'selected', 'booking_ids': [str(paid)]})
+
+    assert _fresh_booking(paid).status == 'paid'
+    assert _fresh_booking(left).status == 'unpaid'
+
+
+def test_checkout_backs_out_when_the_cart_changes_mid_payment(client, make_booking, travel_date, monkeypatch):
+    ids = [make_booking(travel_date), make_booking(travel_date)]
+    assign_booking_seats = booking_app.assign_booking_seats
+
+    def assign_then_race(session, booking, wanted=None):
+        if booking.id == ids[1]:
+            # e.g. the booking was edited in another tab after the cart was read
+            session.execute(update(Booking).where(Booking.id == ids[1]).values(version=Booking.version + 1),
+                            execution_options={'synchronize_session': False})
+        return assign_booking_seats(session, booking, wanted)
+
+    monkeypatch.setattr(booking_app, 'assign_booking_seats', assign_then_race)
+    response = client.post('/checkout')
+
+    assert b'Your cart changed while paying' in response.data
+    for booking_id in ids:
+        booking = _fresh_booking(booking_id)
+        assert (booking.status, booking.seat_numbers) == ('unpaid', None)
+    taken, capacity = booking_app.peek_seat_map(db.session, 1, travel_date, 1)
+    assert taken == 0
+
+
+def test_checkout_of_an_empty_cart_goes_back_to_the_cart(client, ctx):
+    db.session.execute(update(Booking).where(Booking.status == 'unpaid').values(status='cancelled'))
+    db.session.commit()
+    response = client.post('/checkout')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/cart')
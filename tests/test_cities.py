@@ -0,0 +1,39 @@
+from app import City, Journey, city_ids, db, find_journey, import_journeys, normalize_city
+
+
+def rows(*records):
+    return [(line_no, record) for line_no, record in enumerate(records, start=2)]
+
+
+def city_count():
+    return db.session.scalar(db.select(db.func.count(City.id)))
+
+
+def test_city_ids_adds_each_city_once(ctx):
+    ids = city_ids(['  New   York', 'new york', 'Boston'])
+    db.session.commit()
+    assert set(ids) == {normalize_city('New York'), normalize_city('Boston')}
+    assert city_ids(['NEW YORK'], create=False) == {normalize_city('New York'): ids[normalize_city('New York')]}
+
+
+def test_import_matches_existing_routes_on_city_ids(ctx):
+    result = import_journeys(rows({'from': 'bristol ', 'to': 'MANCHESTER', 'fare': '95'},
+                                  {'from': 'York', 'to': 'Leeds', 'fare': '12.5'}))
+    assert (result['inserted'], result['updated']) == (1, 1)
+
+    bristol = find_journey('Bristol', 'Manchester')
+    assert (bristol.id, bristol.base_fare) == (1, 95)
+    york = find_journey('york', 'leeds')
+    assert york.departure_city_id is not None and york.base_fare == 12.5
+
+    again = import_journeys(rows({'from': 'YORK', 'to': 'leeds', 'fare': '12.5'}))
+    assert (again['inserted'], again['unchanged']) == (0, 1)
+
+
+def test_import_dry_run_adds_no_cities_or_journeys(ctx):
+    cities, journeys = city_count(), db.session.scalar(db.select(db.func.count(Journey.id)))
+    result = import_journeys(rows({'from': 'Oban', 'to': 'Mallaig', 'fare': '30'}), dry_run=True)
+    db.session.commit()
+    assert result['inserted'] == 1
+    assert city_count() == cities
+    assert db.session.scalar(db.select(db.func.count(Journey.id))) == journeys
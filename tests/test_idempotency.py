@@ -0,0 +1,53 @@
+import app as booking_app
+from app import Booking, IdempotencyKey, db
+from conftest import booking_json
+
+
+def count_bookings(travel_date):
+    return db.session.scalar(db.select(db.func.count(Booking.id)).where(Booking.travel_date == travel_date))
+
+
+def test_a_retried_booking_is_replayed_not_booked_twice(client, ctx, travel_date):
+    headers = {'Idempotency-Key': f'book-{travel_date}'}
+    first = client.post('/confirm-booking', json=booking_json(travel_date), headers=headers)
+    second = client.post('/confirm-booking', json=booking_json(travel_date), headers=headers)
+
+    assert first.status_code == second.status_code == 200
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.get_json() == first.get_json()
+    assert count_bookings(travel_date) == 1
+
+
+def test_a_key_reused_for_another_request_is_rejected(client, ctx, travel_date):
+    headers = {'Idempotency-Key': f'reuse-{travel_date}'}
+    client.post('/add-to-cart', json=booking_json(travel_date), headers=headers)
+    response = client.post('/add-to-cart', json=booking_json(travel_date, seats_booked=2), headers=headers)
+
+    assert response.status_code == 422
+    assert count_bookings(travel_date) == 1
+
+
+def test_a_failure_before_commit_frees_the_key(client, ctx, travel_date):
+    headers = {'Idempotency-Key': f'fail-{travel_date}'}
+    bad = booking_json(travel_date, final_price='not a price')
+    assert client.post('/confirm-booking', json=bad, headers=headers).status_code == 500
+    assert db.session.scalar(db.select(IdempotencyKey.id).where(IdempotencyKey.key == headers['Idempotency-Key'])) \
+        is None
+
+    response = client.post('/confirm-booking', json=booking_json(travel_date), headers=headers)
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+    assert count_bookings(travel_date) == 1
+
+
+def test_a_failure_after_commit_keeps_the_key(client, ctx, travel_date, monkeypatch):
+    def broken(booking):
+        raise RuntimeError('follow-up failed')
+
+    monkeypatch.setattr(booking_app, 'booking_saved', broken)
+    headers = {'Idempotency-Key': f'saved-{travel_date}'}
+    assert client.post('/confirm-booking', json=booking_json(travel_date), headers=headers).status_code == 500
+
+    response = client.post('/confirm-booking', json=booking_json(travel_date), headers=headers)
+    assert response.headers['Idempotent-Replayed'] == 'true'
+    assert count_bookings(travel_date) == 1
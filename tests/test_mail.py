@@ -0,0 +1,14 @@
+import app as booking_app
+
+
+def test_verification_codes_go_through_the_mail_queue(app, monkeypatch):
+    queued = []
+    monkeypatch.setattr(booking_app.mail_queue, 'send', lambda msg, *notes: queued.append(msg))
+    monkeypatch.setattr(booking_app, 'SMTP', None)  # an inline send would fail
+
+    with app.app_context():
+        booking_app.send_verification_code('user@example.com', 'Una', '482913')
+
+    [msg] = queued
+    assert msg['To'] == 'user@example.com'
+    assert '482913' in msg.get_content()
@@ -0,0 +1,71 @@
+from datetime import date, timedelta
+
+from sqlalchemy import event, update
+
+from app import (Booking, BookingArchive, BookingEvent, Cancellation, _fresh_booking, db,
+                 enqueue_maintenance_job, enqueue_service_cancellation, run_maintenance_job)
+
+
+def cancelled_events(booking_id):
+    return db.session.execute(
+        db.select(BookingEvent.status, BookingEvent.amount)
+        .where(BookingEvent.booking_id == booking_id, BookingEvent.event_type == 'cancelled')
+    ).all()
+
+
+def test_cancel_service_cancels_active_bookings_once(ctx, make_booking, travel_date):
+    paid = make_booking(travel_date, status='paid')
+    unpaid = make_booking(travel_date)
+    already = make_booking(travel_date, status='cancelled')
+
+    error, job = enqueue_service_cancellation(slot_id=1, date_from=travel_date, start_worker=False)
+    job = run_maintenance_job(job.id, pause=0)
+
+    assert error is None and job.status == 'done' and job.processed == 2
+    assert [_fresh_booking(b).status for b in (paid, unpaid, already)] == ['cancelled'] * 3
+    assert [len(cancelled_events(b)) for b in (paid, unpaid, already)] == [1, 1, 0]
+
+
+def test_cancel_service_rereads_a_booking_paid_mid_chunk(ctx, make_booking, travel_date):
+    booking_id = make_booking(travel_date)
+    error, job = enqueue_service_cancellation(slot_id=1, date_from=travel_date, start_worker=False)
+    session = db.session()
+    raced = []
+
+    @event.listens_for(session, 'do_orm_execute')
+    def pay_after_the_read(state):
+        # The charge rules are read after the chunk; the customer pays just then
+        if raced or not state.is_select:
+            return
+        if Cancellation in [d.get('entity') for d in state.statement.column_descriptions]:
+            raced.append(True)
+            with db.engine.begin() as conn:
+                conn.execute(update(Booking).where(Booking.id == booking_id)
+                             .values(status='paid', version=Booking.version + 1))
+
+    try:
+        job = run_maintenance_job(job.id, pause=0)
+    finally:
+        event.remove(session, 'do_orm_execute', pay_after_the_read)
+
+    booking = _fresh_booking(booking_id)
+    assert raced and job.status == 'done'
+    assert (booking.status, booking.version) == ('cancelled', 3)
+    # Charged as the paid booking it had become, and logged once
+    [(status, amount)] = cancelled_events(booking_id)
+    assert status == 'cancelled' and amount > 0
+
+
+def test_archiving_keeps_seat_numbers_and_version(ctx, make_booking):
+    travelled = date.today() - timedelta(days=400)
+    booking_id = make_booking(travelled, status='paid', seats=2, seat_numbers='7,8')
+    db.session.execute(update(Booking).where(Booking.id == booking_id).values(version=4))
+    db.session.commit()
+
+    job = enqueue_maintenance_job('archive_bookings', start_worker=False,
+                                  before=(travelled + timedelta(days=1)).isoformat())
+    assert run_maintenance_job(job.id, pause=0).status == 'done'
+
+    archived = db.session.get(BookingArchive, booking_id)
+    assert (archived.seat_numbers, archived.version, archived.status) == ('7,8', 4, 'paid')
+    assert _fresh_booking(booking_id) is None
@@ -0,0 +1,50 @@
+import pytest
+
+from app import Booking, db, query_budget, report_queries
+
+
+def test_query_budget_counts_statements(ctx):
+    with query_budget(2) as queries:
+        db.session.scalar(db.select(Booking.id).limit(1))
+        db.session.scalar(db.select(Booking.id).limit(1))
+    assert len(queries) == 2
+    assert all(q['sql'].startswith('SELECT') for q in queries)
+
+
+def test_query_budget_fails_when_exceeded(ctx):
+    with pytest.raises(AssertionError, match='Expected at most 1 queries, got 3'):
+        with query_budget(1):
+            for _ in range(3):
+                db.session.scalar(db.select(Booking.id).limit(1))
+
+
+def test_my_bookings_query_count_does_not_grow_with_bookings(client, make_booking, travel_date):
+    with query_budget(10) as before:
+        assert client.get('/my-bookings').status_code == 200
+    for _ in range(5):
+        make_booking(travel_date, status='paid')
+    with query_budget(len(before)):
+        assert client.get('/my-bookings').status_code == 200
+
+
+def test_repeated_and_slow_statements_are_reported(ctx, app, monkeypatch, caplog):
+    monkeypatch.setitem(app.config, 'N_PLUS_ONE_THRESHOLD', 5)
+    monkeypatch.setitem(app.config, 'SLOW_QUERY_MS', 0)  # every statement counts as slow
+    with query_budget(10) as queries:
+        for booking_id in range(5):
+            db.session.scalar(db.select(Booking.id).where(Booking.id == booking_id))
+
+    warnings = report_queries(queries, 'loop')
+    n_plus_one = [w for w in warnings if w.startswith('N+1 suspected in loop: 5x')]
+    slow = [w for w in warnings if w.startswith('Slow query in loop')]
+    assert len(n_plus_one) == 1
+    assert len(slow) == 5
+    assert 'N+1 suspected in loop' in caplog.text
+
+
+def test_query_monitor_adds_the_query_count_header(client, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'QUERY_MONITOR', True)
+    response = client.get('/my-bookings')
+    assert int(response.headers['X-Query-Count']) > 0
+    monkeypatch.setitem(app.config, 'QUERY_MONITOR', False)
+    assert 'X-Query-Count' not in client.get('/my-bookings').headers
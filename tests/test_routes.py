@@ -0,0 +1,54 @@
+from datetime import time
+
+from app import RouteGraph
+
+
+def graph(*legs):
+    """A graph from ``(journey_id, from, to, fare, departs, arrives)`` legs, one slot each."""
+    route_graph = RouteGraph()
+    route_graph.load_rows([(journey_id, dep, arr, fare, journey_id, departs, arrives)
+                           for journey_id, dep, arr, fare, departs, arrives in legs])
+    return route_graph
+
+
+def journeys(itinerary):
+    return [edge.journey_id for edge, day in itinerary]
+
+
+def test_earliest_prefers_the_cheaper_of_two_itineraries_arriving_together():
+    route_graph = graph(
+        (1, 'Bristol', 'Glasgow', 50, time(8), time(10)),
+        (2, 'Bristol', 'Manchester', 10, time(7), time(8)),
+        (3, 'Manchester', 'Glasgow', 10, time(9), time(10)),
+    )
+    assert journeys(route_graph.search('Bristol', 'Glasgow', optimize='earliest')) == [2, 3]
+
+
+def test_cheapest_prefers_the_earlier_of_two_itineraries_costing_the_same():
+    route_graph = graph(
+        (1, 'Bristol', 'Glasgow', 20, time(8), time(12)),
+        (2, 'Bristol', 'Manchester', 10, time(7), time(8)),
+        (3, 'Manchester', 'Glasgow', 10, time(9), time(10)),
+    )
+    assert journeys(route_graph.search('Bristol', 'Glasgow', optimize='cheapest')) == [2, 3]
+
+
+def test_earliest_still_beats_cheaper_but_later_itineraries():
+    route_graph = graph(
+        (1, 'Bristol', 'Glasgow', 50, time(8), time(10)),
+        (2, 'Bristol', 'Manchester', 10, time(7), time(8)),
+        (3, 'Manchester', 'Glasgow', 10, time(9), time(11)),
+    )
+    assert journeys(route_graph.search('Bristol', 'Glasgow', optimize='earliest')) == [1]
+    assert journeys(route_graph.search('Bristol', 'Glasgow', optimize='cheapest')) == [2, 3]
+
+
+def test_connections_need_the_minimum_change_time():
+    route_graph = graph(
+        (1, 'Bristol', 'Manchester', 10, time(7), time(8, 45)),
+        (2, 'Manchester', 'Glasgow', 10, time(9), time(10)),
+    )
+    tight = route_graph.search('Bristol', 'Glasgow', min_connection=15)
+    assert [(edge.journey_id, day) for edge, day in tight] == [(1, 0), (2, 0)]
+    next_day = route_graph.search('Bristol', 'Glasgow', min_connection=30)
+    assert [(edge.journey_id, day) for edge, day in next_day] == [(1, 0), (2, 1)]
@@ -0,0 +1,81 @@
+from app import (SLOT_CAPACITY, Booking, SeatMap, SeatType, app, assign_seats, db, decode_seats, load_seat_map,
+                 peek_seat_map, pick_seats, release_seats, seat_map_capacity, seat_numbers_of, seats_mask)
+
+
+def test_pick_seats_prefers_a_block_in_one_row():
+    taken = seats_mask([1, 2, 3])  # row 1 has only seat 4 free
+    assert seat_numbers_of(pick_seats(taken, 12, 2, 4)) == [5, 6]
+
+
+def test_pick_seats_splits_the_party_when_no_block_fits():
+    taken = seats_mask([2, 3, 5, 6])
+    assert seat_numbers_of(pick_seats(taken, 6, 2, 4)) == [1, 4]
+
+
+def test_pick_seats_returns_none_when_full():
+    assert pick_seats(seats_mask([1, 2, 3]), 4, 2, 4) is None
+
+
+def test_slot_capacity_is_the_seat_map_layout_added_up():
+    assert seat_map_capacity('Economy') == app.config['SEAT_MAP_LAYOUT']['Economy']
+    assert SLOT_CAPACITY == sum(app.config['SEAT_MAP_LAYOUT'].values())
+
+
+def test_seat_types_missing_from_the_layout_are_not_sold(ctx, travel_date):
+    sleeper = SeatType(type_name='Sleeper', multiplier=3.0)
+    db.session.add(sleeper)
+    db.session.commit()
+    assert seat_map_capacity('Sleeper') == 0
+    error, numbers = assign_seats(db.session, 1, travel_date, sleeper.id, 1)
+    db.session.rollback()
+    assert numbers is None and "isn't sold" in error
+
+
+def test_assign_seats_never_hands_out_a_seat_twice(ctx, travel_date):
+    handed_out = []
+    for count in (2, 3, 1):
+        error, numbers = assign_seats(db.session, 1, travel_date, 1, count)
+        db.session.commit()
+        assert error is None
+        handed_out += [int(n) for n in numbers.split(',')]
+    assert len(handed_out) == len(set(handed_out)) == 6
+
+
+def test_assign_seats_rejects_taken_and_out_of_range_seats(ctx, travel_date):
+    assert assign_seats(db.session, 1, travel_date, 1, 2, [5, 6]) == (None, '5,6')
+    db.session.commit()
+    error, numbers = assign_seats(db.session, 1, travel_date, 1, 2, [6, 7])
+    assert numbers is None and 'taken' in error
+    error, numbers = assign_seats(db.session, 1, travel_date, 1, 1, [999])
+    assert numbers is None and 'between 1 and' in error
+    db.session.rollback()
+
+
+def test_release_seats_frees_them_for_the_next_booking(ctx, travel_date):
+    assign_seats(db.session, 1, travel_date, 1, 2, [1, 2])
+    db.session.commit()
+    release_seats(db.session, 1, travel_date, 1, '1,2')
+    db.session.commit()
+    assert assign_seats(db.session, 1, travel_date, 1, 2) == (None, '1,2')
+    db.session.commit()
+
+
+def test_new_map_seats_paid_bookings_made_before_seat_maps(ctx, make_booking, travel_date):
+    seated = make_booking(travel_date, status='paid', seats=2, seat_numbers='1,2')
+    unseated = make_booking(travel_date, status='paid', seats=2)
+    make_booking(travel_date, status='unpaid', seats=4)
+
+    seat_map, capacity = load_seat_map(db.session, 1, travel_date, 1)
+    db.session.commit()
+    assert db.session.get(Booking, unseated).seat_numbers == '3,4'
+    assert db.session.get(Booking, seated).seat_numbers == '1,2'
+    assert seat_numbers_of(decode_seats(seat_map.taken)) == [1, 2, 3, 4]
+
+
+def test_peek_seat_map_does_not_write(ctx, make_booking, travel_date):
+    booking_id = make_booking(travel_date, status='paid', seats=2)
+    taken, capacity = peek_seat_map(db.session, 1, travel_date, 1)
+    db.session.commit()
+    assert seat_numbers_of(taken) == [1, 2]
+    assert db.session.get(Booking, booking_id).seat_numbers is None
+    assert db.session.scalar(db.select(SeatMap.id).where(SeatMap.travel_date == travel_date)) is None